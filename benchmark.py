@@ -0,0 +1,287 @@
+"""
+End-to-end latency benchmarks against the local mock OpenAI server (see mock_openai.py).
+
+Usage:
+    python benchmark.py ["<course name>"] [--students 20] [--questions 5] [--latency-ms 300] [--json benchmark.json]
+
+Covers PDF ingestion, chunking, embedding, index building and search, and N students
+running a recap session at the same time. Every benchmark reports p50/p95 latency,
+throughput, the tokens served by the mock and the peak RSS of the process, so the JSON
+files of two commits can be compared directly.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import concurrent.futures
+import numpy as np
+
+import embedding_cache
+from config import (
+    AI_MODELS, COURSES, CHUNK_SIZE, EMBEDDING_MODEL, QUESTION_TYPES, DIFFICULTY_LEVELS, SETUP_INSTRUCTIONS,
+    SUMMARY_TOKEN_BUDGET
+)
+from course_assets import get_course_assets, retrieve_content
+from mock_openai import MockOpenAIServer
+from openai_client import OpenAIClient
+from question_history import QuestionHistory
+from session_summary import ObjectiveScores, match_objective
+from structured_questions import CodeQuestion
+from pdf_rag import (
+    create_faiss_index,
+    embed_chunks_openai,
+    process_pdf_for_rag,
+    search_many,
+    tokenize_and_chunk
+)
+
+###############################################################################
+#                               MEASUREMENT
+###############################################################################
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(latencies, elapsed, mock, counters_before, **extra):
+    """
+    Build the report entry of one benchmark from its latencies (seconds) and wall time.
+    """
+    counters = mock.counters()
+    latencies_ms = np.asarray(latencies, dtype=np.float64) * 1000
+    return {
+        "count": len(latencies),
+        "p50_ms": float(np.percentile(latencies_ms, 50)) if len(latencies) else None,
+        "p95_ms": float(np.percentile(latencies_ms, 95)) if len(latencies) else None,
+        "mean_ms": float(latencies_ms.mean()) if len(latencies) else None,
+        "elapsed_s": elapsed,
+        "throughput_per_s": len(latencies) / elapsed if elapsed else None,
+        "tokens": {
+            key: counters[key] - counters_before[key]
+            for key in ("prompt_tokens", "completion_tokens", "embedding_tokens")
+        },
+        "requests": counters["requests"] - counters_before["requests"],
+        "errors": counters["errors"] - counters_before["errors"],
+        "peak_rss_mb": peak_rss_mb(),
+        **extra,
+    }
+
+
+def run_benchmark(mock, function, repeats=1):
+    """
+    Call ``function`` ``repeats`` times and summarize the call latencies.
+    Returns the summary and the result of the last call.
+    """
+    counters_before = mock.counters()
+    latencies, result = [], None
+    start = time.perf_counter()
+    for _ in range(repeats):
+        call_start = time.perf_counter()
+        result = function()
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start, mock, counters_before), result
+
+
+###############################################################################
+#                               BENCHMARKS
+###############################################################################
+
+def bench_ingestion(mock, course, chunks, repeats, include_pdf=True):
+    report = {}
+    if include_pdf:
+        try:
+            report["process_pdf_for_rag"], pdf_chunks = run_benchmark(
+                mock, lambda: process_pdf_for_rag(course["PDF_FILE_PATH"], chunk_size=CHUNK_SIZE)
+            )
+            report["process_pdf_for_rag"]["chunks"] = len(pdf_chunks)
+        except Exception as error:
+            report["process_pdf_for_rag"] = {"error": str(error)}
+
+    text = "\n".join(chunks)
+    report["tokenize_and_chunk"], text_chunks = run_benchmark(
+        mock, lambda: tokenize_and_chunk(text, chunk_size=CHUNK_SIZE), repeats=repeats
+    )
+    report["tokenize_and_chunk"]["chunks"] = len(text_chunks)
+    return report
+
+
+def bench_embedding_and_search(mock, course, chunks, num_queries, top_k):
+    report = {}
+    report["embed_chunks_openai"], embeddings = run_benchmark(
+        mock, lambda: embed_chunks_openai(chunks, model=EMBEDDING_MODEL, use_cache=False)
+    )
+    report["embed_chunks_openai"]["chunks"] = len(chunks)
+
+    index_config = course.get("INDEX")
+    report["create_faiss_index"], index = run_benchmark(mock, lambda: create_faiss_index(embeddings, index_config))
+    report["create_faiss_index"]["index"] = dict(index_config or {"type": "flat"})
+
+    rng = random.Random(0)
+    objectives = course.get("OBJECTIVES") or ["Python"]
+    queries = iter([f"{rng.choice(objectives)} {rng.randint(0, 10**6)}" for _ in range(num_queries)])
+    report["search_many"], _ = run_benchmark(
+        mock, lambda: search_many([next(queries)], index, embeddings=embeddings, top_k=top_k), repeats=num_queries
+    )
+    return report
+
+
+def simulate_student(course_name, course, model_config, questions, seed):
+    """
+    Run one recap session the way main.py does: retrieve, generate a structured question,
+    answer, grade it locally (streaming the explanation of a wrong code answer), and finally
+    stream the summary.
+    Returns the latencies of every step, in seconds.
+    """
+    rng = random.Random(seed)
+    ai_client = OpenAIClient(model=model_config["model"], setup_instructions=SETUP_INSTRUCTIONS, course_name=course_name)
+    kwargs = {key: model_config[key] for key in ("temperature", "max_tokens", "frequency_penalty") if key in model_config}
+    objectives = course.get("OBJECTIVES", [])
+    selected_objectives = rng.sample(objectives, k=min(2, len(objectives)))
+    question_type, difficulty = rng.choice(QUESTION_TYPES), rng.choice(DIFFICULTY_LEVELS)
+    timings = {"retrieve": [], "question": [], "feedback": [], "summary": [], "session": []}
+
+    def consume(request):
+        start, first_token, parts = time.perf_counter(), None, []
+        for delta in request():
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            parts.append(delta)
+        return "".join(parts), first_token, time.perf_counter() - start
+
+    session_start = time.perf_counter()
+    question_history, objective_scores = QuestionHistory(), ObjectiveScores()
+    for _ in range(questions):
+        start = time.perf_counter()
+        content, chunk_ids = retrieve_content(course_name, selected_objectives, question_type, difficulty, labeled=True)
+        timings["retrieve"].append(time.perf_counter() - start)
+
+        # Structured questions arrive whole and carry their answer key, so there is no
+        # first-token latency to report (older reports' "question_first_token" is not comparable)
+        start = time.perf_counter()
+        answer_key = ai_client.question_generator(
+            content, question_type, difficulty, question_history.prompt_items(), objectives, selected_objectives,
+            chunk_ids=chunk_ids, **kwargs
+        )
+        question = str(answer_key)
+        timings["question"].append(time.perf_counter() - start)
+        question_history.add(question)
+
+        # MCQ choices and code answers are graded locally; wrong code answers get an explanation
+        answer = rng.choice(["A", "B", "C", "D"]) if question_type == "Multiple-Choice Questions" else "print(sum(range(3)))"
+        start = time.perf_counter()
+        correctness, report = answer_key.grade(answer)
+        if isinstance(answer_key, CodeQuestion) and correctness == "student answered incorrectly":
+            consume(lambda: ai_client.explain_execution_result(question, answer, report, stream=True, **kwargs))
+        timings["feedback"].append(time.perf_counter() - start)
+        objective_scores.record(match_objective(question, selected_objectives or objectives, course.get("OBJECTIVE_KEYWORDS")),
+                               correctness)
+
+    start = time.perf_counter()
+    summary_content = retrieve_content(
+        course_name, objective_scores.focus_objectives(selected_objectives or objectives), token_budget=SUMMARY_TOKEN_BUDGET
+    )
+    consume(lambda: ai_client.completion_message(
+        summary_content, objective_scores, objectives, selected_objectives, stream=True, **kwargs
+    ))
+    timings["summary"].append(time.perf_counter() - start)
+    timings["session"].append(time.perf_counter() - session_start)
+    return timings
+
+
+def bench_sessions(mock, course_name, course, model_name, students, questions):
+    counters_before = mock.counters()
+    get_course_assets(course_name)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=students) as executor:
+        results = list(executor.map(
+            lambda seed: simulate_student(course_name, course, AI_MODELS[model_name], questions, seed),
+            range(students)
+        ))
+    elapsed = time.perf_counter() - start
+
+    report = {}
+    for step in results[0]:
+        latencies = [latency for timings in results for latency in timings[step]]
+        report[step] = summarize(latencies, elapsed, mock, counters_before)
+    report["students"] = students
+    report["questions_per_student"] = questions
+    report["model"] = model_name
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("course", nargs="?", default=next(iter(COURSES)), choices=list(COURSES.keys()))
+    parser.add_argument("--model", default="gpt-4o mini", choices=list(AI_MODELS.keys()))
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=6)
+    parser.add_argument("--repeats", type=int, default=5, help="Repetitions of the fast ingestion benchmarks.")
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=80)
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--skip-pdf", action="store_true", help="Skip process_pdf_for_rag (OCR of the whole PDF).")
+    parser.add_argument("--json", default=None, help="Write the report to this JSON file instead of stdout.")
+    args = parser.parse_args()
+
+    mock = MockOpenAIServer(
+        latency_ms=args.latency_ms,
+        tokens_per_second=args.tokens_per_second,
+        embedding_latency_ms=args.embedding_latency_ms,
+        error_rate=args.error_rate
+    ).start()
+    # The shared clients of openai_pool are created on first use, after this point.
+    os.environ["OPENAI_BASE_URL"] = mock.base_url
+    os.environ["OPENAI_API_KEY"] = "mock"
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Start from an empty embedding cache so runs do not depend on earlier ones.
+        embedding_cache._cache = embedding_cache.EmbeddingCache(os.path.join(cache_dir, "embeddings.sqlite3"))
+
+        course = COURSES[args.course]
+        chunks = list(get_course_assets(args.course).chunks)
+        report = {
+            "commit": git_commit(),
+            "course": args.course,
+            "mock": {
+                "latency_ms": args.latency_ms,
+                "tokens_per_second": args.tokens_per_second,
+                "embedding_latency_ms": args.embedding_latency_ms,
+                "error_rate": args.error_rate,
+            },
+        }
+        report["ingestion"] = bench_ingestion(mock, course, chunks, args.repeats, include_pdf=not args.skip_pdf)
+        report["index"] = bench_embedding_and_search(mock, course, chunks, args.queries, args.top_k)
+        report["sessions"] = bench_sessions(mock, args.course, course, args.model, args.students, args.questions)
+        report["peak_rss_mb"] = peak_rss_mb()
+        embedding_cache._cache = None
+    mock.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"[INFO] Benchmark report written to {args.json}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
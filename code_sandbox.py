@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import secrets
+import tempfile
+import threading
+import subprocess
+import collections
+
+from config import (
+    SANDBOX_CPU_SECONDS,
+    SANDBOX_MEMORY_MB,
+    SANDBOX_OUTPUT_CHARS,
+    SANDBOX_TIMEOUT_SECONDS,
+    SANDBOX_WORKERS
+)
+from metrics import record_span
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+
+###############################################################################
+#                       PRE-WARMED SUBPROCESS SANDBOXES
+###############################################################################
+
+class SandboxPool:
+    """
+    Runs untrusted snippets (reference solutions and student answers) in separate Python
+    processes (see sandbox_worker.py).
+
+    Every worker runs exactly one job in its own empty temporary directory, with a clean
+    environment, CPU, memory, file and output limits, and an audit hook that blocks network
+    access, new processes and files outside its directory. Starting the interpreter is the slow
+    part, so ``size`` workers are kept started and waiting; a used worker is replaced in the
+    background. The hooks contain honest mistakes and casual misuse; they are not a security
+    boundary against deliberate escapes, which need OS-level isolation (containers).
+    """
+    def __init__(self, size=SANDBOX_WORKERS, timeout_seconds=SANDBOX_TIMEOUT_SECONDS, cpu_seconds=SANDBOX_CPU_SECONDS,
+                 memory_mb=SANDBOX_MEMORY_MB, output_chars=SANDBOX_OUTPUT_CHARS):
+        self.size = size
+        self.timeout_seconds = timeout_seconds
+        self.limits = json.dumps({"cpu_seconds": cpu_seconds, "memory_mb": memory_mb, "output_chars": output_chars})
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+        self._closed = False
+        self._start_refill()
+
+    def _spawn(self):
+        """
+        Start a worker in a new temporary directory. Returns (process, directory).
+        """
+        directory = tempfile.mkdtemp(prefix="sandbox-")
+        process = subprocess.Popen(
+            [sys.executable, "-I", "-B", WORKER_PATH, self.limits],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=directory,
+            env={"PYTHONIOENCODING": "utf-8", "PATH": os.defpath},
+            text=True,
+            encoding="utf-8"
+        )
+        return process, directory
+
+    def _refill(self):
+        with self._refill_lock:
+            while not self._closed:
+                with self._lock:
+                    if len(self._idle) >= self.size:
+                        return
+                process, directory = self._spawn()
+                with self._lock:
+                    if not self._closed:
+                        self._idle.append((process, directory))
+                        continue
+                process.kill()
+                process.communicate()
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def _start_refill(self):
+        threading.Thread(target=self._refill, name="sandbox-refill", daemon=True).start()
+
+    def _take_worker(self):
+        with self._lock:
+            worker = self._idle.popleft() if self._idle else None
+        self._start_refill()
+        return worker or self._spawn()
+
+    def run(self, code, tests=(), stdin=""):
+        """
+        Run ``code`` and then each test statement of ``tests`` in the same namespace.
+
+        Returns a dict with ``stdout`` (the printed output), ``error`` (the last traceback line
+        of an exception, or why the run was stopped), ``tests`` (a list of
+        {"test", "passed", "error"}), ``stopped`` (killed by a limit), ``timed_out`` and ``truncated``.
+        """
+        start = time.perf_counter()
+        process, directory = self._take_worker()
+        # Only a result line tagged with this job's nonce counts, so printed text cannot pose as one
+        nonce = secrets.token_hex(16)
+        job = json.dumps({"code": code, "tests": list(tests), "stdin": stdin, "nonce": nonce}) + "\n"
+        result = {"stdout": "", "error": None, "tests": [], "stopped": False, "timed_out": False, "truncated": False}
+        try:
+            output, _ = process.communicate(job, timeout=self.timeout_seconds)
+            lines = output.strip().splitlines()
+            try:
+                tag, line = lines[-1].split(" ", 1) if process.returncode == 0 else ("", "")
+                if tag != nonce:
+                    raise ValueError("no result of this job")
+                result.update(json.loads(line))
+            except (IndexError, ValueError):
+                # The worker died without a result, e.g. for a resource limit
+                result["stopped"] = True
+                result["error"] = f"The program was stopped (exit code {process.returncode}), e.g. for using too much CPU time or memory."
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            result["stopped"] = result["timed_out"] = True
+            result["error"] = f"The program did not finish within {self.timeout_seconds}s."
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        record_span("sandbox", None, time.perf_counter() - start, path="run",
+                    error="timeout" if result["timed_out"] else None, tests=len(result["tests"]))
+        return result
+
+    def close(self):
+        """
+        Stop the idle workers and remove their directories.
+        """
+        self._closed = True
+        with self._lock:
+            workers, self._idle = list(self._idle), collections.deque()
+        for process, directory in workers:
+            process.kill()
+            process.communicate()
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool():
+    """
+    Return the process-wide sandbox pool, starting its workers on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+            atexit.register(_pool.close)
+        return _pool
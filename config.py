@@ -48,6 +48,57 @@ AI_MODELS = {
 }
 
 
+QUESTION_TYPES = ["Multiple-Choice Questions", "Code Tracing and Correction", "Code Completion"]
+DIFFICULTY_LEVELS = ["Easy", "Medium", "Hard"]
+
+# Model (key of AI_MODELS) used by the offline question bank job (python question_bank.py).
+QUESTION_BANK_MODEL = "gpt-4o mini"
+
+# Threads generating the next question in the background, shared by all sessions.
+PREFETCH_WORKERS = 8
+# "Next Question" waits at most this long for a prefetch that is being generated; one still
+# queued behind other sessions' prefetches is dropped and the question is generated inline.
+PREFETCH_WAIT_SECONDS = 10
+
+# Earlier questions (shortened) sent with a question prompt as the do-not-repeat list.
+QUESTION_HISTORY_PROMPT_ITEMS = 5
+QUESTION_HISTORY_ITEM_CHARS = 160
+# Estimated similarity (shared word 3-grams) above which a new question counts as a repeat.
+QUESTION_REPEAT_THRESHOLD = 0.6
+# Regenerations of a repeated question before it is accepted anyway.
+QUESTION_REPEAT_RETRIES = 2
+
+####### OPENAI CLIENT #############
+
+# All modules share one pooled OpenAI client per process (see openai_pool.py).
+OPENAI_TIMEOUT_SECONDS = 60
+OPENAI_CONNECT_TIMEOUT_SECONDS = 5
+OPENAI_MAX_RETRIES = 2
+# Maximum number of requests in flight at once through openai_pool.gather.
+OPENAI_MAX_CONCURRENCY = 16
+
+####### METRICS #############
+
+# Every LLM, embedding and search call is recorded as a JSON line here (None disables the file).
+METRICS_PATH = ".cache/metrics.jsonl"
+# Above this size the span file is renamed to METRICS_PATH + ".1" (replacing the previous one)
+# and a new file is started, so at most twice this much is kept.
+METRICS_MAX_MB = 50
+# Port of the Prometheus /metrics endpoint started by main.py (None disables it). The endpoint is
+# unauthenticated and includes per-course usage and cost, so it only listens on METRICS_HOST;
+# expose it beyond this machine (e.g. "0.0.0.0") only behind a firewall or proxy.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+# USD per million tokens, used to estimate the cost of every call.
+MODEL_PRICES = {
+    "gpt-4o": {"prompt": 2.50, "completion": 10.00},
+    "gpt-4o-mini": {"prompt": 0.15, "completion": 0.60},
+    "gpt-4-turbo": {"prompt": 10.00, "completion": 30.00},
+    "gpt-3.5-turbo": {"prompt": 0.50, "completion": 1.50},
+    "text-embedding-ada-002": {"prompt": 0.10},
+}
+
+
 ####### COURSE CONFIGURATION #############
 COURSES = {
     "Python – schnell und intensiv Programmieren lernen": {
@@ -55,12 +106,91 @@ COURSES = {
         "CHUNKS_JSON_PATH": "python_2024/lecture_chunks.json",
         "EMBEDDINGS_NPY_PATH": "python_2024/lecture_embeddings.npy",
         "FAISS_INDEX_PATH": "python_2024/lecture.index",
+        "MANIFEST_PATH": "python_2024/lecture_manifest.json",
+        # Single memory-mapped file served instead of the three files above once it is built
+        # (python ingest.py or python course_bundle.py). BUNDLE_DTYPE "float16" halves the vectors.
+        "BUNDLE_PATH": "python_2024/lecture.bundle",
+        "BUNDLE_DTYPE": "float32",
+        # BM25 index over the chunks, built by python ingest.py (see lexical_index.py)
+        "LEXICAL_INDEX_PATH": "python_2024/lecture_lexical.npz",
+        "QUESTION_BANK_PATH": "python_2024/question_bank.jsonl.gz",
+        # FAISS index built for this course, see pdf_rag.create_faiss_index. Small courses are
+        # fastest with an exact "flat" index; for large ones use e.g.
+        # {"type": "hnsw", "metric": "cosine", "M": 32, "ef_search": 64} or
+        # {"type": "ivfpq", "metric": "cosine", "nlist": 1024, "m": 64, "nprobe": 16}
+        # and compare the options with `python index_report.py`.
+        "INDEX": {"type": "flat", "metric": "l2"},
         "OBJECTIVES": [
             "Variables and Data Types",
             "Control Flow",
             "Functions",
             "Object-Oriented Programming",
             "Error Handling"
-        ]
+        ],
+        # Terms of the (German) course text searched for every objective by the lexical index
+        "OBJECTIVE_KEYWORDS": {
+            "Variables and Data Types": "Variable Datentyp Zuweisung int float str bool list dict tuple set type",
+            "Control Flow": "Kontrollstruktur Bedingung Verzweigung Schleife if elif else for while break continue range",
+            "Functions": "Funktion Parameter Argument Rückgabewert def return lambda",
+            "Object-Oriented Programming": "Klasse Objekt Instanz Methode Attribut Vererbung class self __init__",
+            "Error Handling": "Fehler Ausnahme Fehlerbehandlung try except finally raise Exception",
+        }
     },
-}
\ No newline at end of file
+}
+
+####### RETRIEVAL CONFIGURATION #############
+
+# Number of chunks retrieved per learning objective when building a question prompt.
+RETRIEVAL_TOP_K = 6
+# Maximum number of course-content tokens (tiktoken, cl100k_base) sent with a prompt.
+RETRIEVAL_TOKEN_BUDGET = 3000
+# "hybrid" fuses FAISS (vector) and BM25 (lexical) results by reciprocal-rank fusion, "vector"
+# uses FAISS only and "lexical" answers locally from the BM25 index. In "lexical" mode (and during
+# an embedding outage) no query is embedded: multi-course sessions search every shard instead of
+# routing by embedding, and answers are matched to objectives by shared words.
+RETRIEVAL_MODE = "hybrid"
+RRF_K = 60
+# In hybrid mode, query embeddings fail fast (no retries) after this timeout, and a failure
+# switches retrieval to lexical-only for EMBEDDING_OUTAGE_SECONDS.
+QUERY_EMBEDDING_TIMEOUT_SECONDS = 5
+EMBEDDING_OUTAGE_SECONDS = 60
+# Smaller budget for the end-of-recap summary, which only needs the chunks of the weak objectives.
+SUMMARY_TOKEN_BUDGET = 1000
+# Cross-course sessions: every course index is a shard. A query is routed to the shards whose
+# embedding centroid is within SHARD_ROUTE_MARGIN of the best one (at most SHARD_ROUTE_MAX_SHARDS).
+SHARD_ROUTE_MAX_SHARDS = 2
+SHARD_ROUTE_MARGIN = 0.05
+# Course assets kept loaded per process (index, chunks and embeddings file sizes);
+# the least recently used courses are evicted above this limit.
+COURSE_ASSETS_MEMORY_LIMIT_MB = 1024
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Local embedding cache (SQLite). Set the path to None to disable it.
+EMBEDDING_CACHE_PATH = ".cache/embeddings.sqlite3"
+EMBEDDING_CACHE_MAX_ENTRIES = 100_000
+# Batch embedding engine: token-sized batches sent concurrently within the API quota.
+EMBEDDING_BATCH_TOKENS = 8000
+EMBEDDING_MAX_CONCURRENCY = 4
+EMBEDDING_REQUESTS_PER_MINUTE = 3000
+EMBEDDING_TOKENS_PER_MINUTE = 1_000_000
+# Maximum number of tokens per course chunk when ingesting a PDF.
+CHUNK_SIZE = 1000
+
+####### CODE GRADING SANDBOX #############
+
+# Code answers are run in pre-warmed, resource-limited worker processes (see code_sandbox.py).
+SANDBOX_WORKERS = 4
+# Wall-clock limit of one run (the pool kills the worker), and CPU and memory limits of a worker.
+SANDBOX_TIMEOUT_SECONDS = 3
+SANDBOX_CPU_SECONDS = 2
+SANDBOX_MEMORY_MB = 256
+# Characters of a run's printed output kept for grading.
+SANDBOX_OUTPUT_CHARS = 10_000
+
+####### FEEDBACK CACHE #############
+
+# In-memory cache of feedback per (model, question, normalized answer). Set to 0 to disable it.
+FEEDBACK_CACHE_MAX_ENTRIES = 10_000
+FEEDBACK_CACHE_TTL_SECONDS = 24 * 3600
+# Cosine similarity above which a free-text answer reuses the feedback of a near-identical
+# cached answer to the same question. None only reuses feedback for identical answers.
+FEEDBACK_CACHE_SIMILARITY = None
@@ -0,0 +1,448 @@
+import os
+import time
+import itertools
+import threading
+import collections
+import numpy as np
+import openai
+
+from config import (
+    COURSES,
+    COURSE_ASSETS_MEMORY_LIMIT_MB,
+    EMBEDDING_MODEL,
+    EMBEDDING_OUTAGE_SECONDS,
+    QUERY_EMBEDDING_TIMEOUT_SECONDS,
+    RETRIEVAL_MODE,
+    RETRIEVAL_TOP_K,
+    RETRIEVAL_TOKEN_BUDGET,
+    RRF_K,
+    SHARD_ROUTE_MARGIN,
+    SHARD_ROUTE_MAX_SHARDS
+)
+from course_bundle import CourseBundle, bundle_fingerprint
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from metrics import record_span
+from pdf_rag import (
+    build_lexical_queries,
+    build_retrieval_queries,
+    configure_faiss_search,
+    embed_queries,
+    file_hash,
+    l2_normalize,
+    load_chunks_from_json,
+    load_embeddings_from_npy,
+    load_faiss_index,
+    search_many,
+    select_chunks,
+    select_context_chunks,
+    verify_artifacts
+)
+from prompts import label_chunks
+
+###############################################################################
+#                        PROCESS-WIDE COURSE ASSET REGISTRY
+###############################################################################
+
+ASSET_PATH_KEYS = ("CHUNKS_JSON_PATH", "EMBEDDINGS_NPY_PATH", "FAISS_INDEX_PATH")
+
+
+class CourseAssets:
+    """
+    Chunks, embeddings, FAISS index and BM25 lexical index (None in "vector" retrieval mode)
+    of one course, shared read-only by every session.
+
+    ``chunks`` is a tuple (or a course bundle's lazy sequence) and ``embeddings`` a read-only
+    memory map, so sessions cannot modify the shared copies. Searches on the shared index are
+    safe to run concurrently.
+    """
+    def __init__(self, course_name, chunks, embeddings, index, stats, hashes, lexical_index=None):
+        self.course_name = course_name
+        self.chunks = chunks
+        self.embeddings = embeddings
+        self.index = index
+        self.lexical_index = lexical_index
+        self.stats = stats
+        self.hashes = hashes
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory footprint: the size of the chunk, embedding and index files.
+        """
+        return sum(size for _, size in self.stats.values())
+
+
+# Loaded courses, least recently used first.
+_registry = collections.OrderedDict()
+_registry_lock = threading.Lock()
+_course_locks = {}
+
+
+def _file_stat(path):
+    """
+    Return the (mtime, size) pair used to cheaply detect file changes.
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _content_hash(key, path):
+    """
+    Identify the content of an asset file: bundles by their header, other files by their hash.
+    """
+    return bundle_fingerprint(path) if key == "BUNDLE_PATH" else file_hash(path)
+
+
+def _course_lock(course_name):
+    with _registry_lock:
+        return _course_locks.setdefault(course_name, threading.Lock())
+
+
+def _asset_paths(course_name):
+    """
+    Return the files the assets of a course are loaded from: its bundle (see course_bundle.py)
+    when one is configured and published, else the chunks JSON, embeddings .npy and FAISS index.
+    """
+    course_info = COURSES[course_name]
+    bundle_path = course_info.get("BUNDLE_PATH")
+    if bundle_path and os.path.isfile(bundle_path):
+        return {"BUNDLE_PATH": bundle_path}
+    return {key: course_info[key] for key in ASSET_PATH_KEYS}
+
+
+def _load_lexical_index(course_name, chunks, chunks_hash):
+    """
+    Load the course's published lexical index (LEXICAL_INDEX_PATH) if it was built from these
+    chunks, else build one in memory. Returns None in "vector" retrieval mode.
+    """
+    if RETRIEVAL_MODE == "vector":
+        return None
+    path = COURSES[course_name].get("LEXICAL_INDEX_PATH")
+    if path and os.path.isfile(path):
+        try:
+            lexical_index = LexicalIndex.load(path)
+            if len(lexical_index) == len(chunks) and lexical_index.source_hash in (None, chunks_hash):
+                return lexical_index
+            print(f"[WARNING] {path} is out of date, run python ingest.py to rebuild it.")
+        except (OSError, KeyError, ValueError) as error:
+            print(f"[WARNING] Could not load {path}: {error}")
+    start = time.perf_counter()
+    lexical_index = LexicalIndex.build(chunks, source_hash=chunks_hash)
+    print(f"[INFO] Built lexical index of course '{course_name}' in {time.perf_counter() - start:.2f}s.")
+    return lexical_index
+
+
+def _load_course_assets(course_name, paths, stats):
+    hashes = {key: _content_hash(key, path) for key, path in paths.items()}
+    if "BUNDLE_PATH" in paths:
+        bundle = CourseBundle(paths["BUNDLE_PATH"])
+        chunks, embeddings = bundle.chunks, bundle.embeddings
+        index = bundle.load_index(COURSES[course_name].get("INDEX"))
+        chunks_hash = bundle.metadata.get("source_hashes", {}).get("CHUNKS_JSON_PATH")
+    else:
+        chunks = tuple(load_chunks_from_json(paths["CHUNKS_JSON_PATH"]))
+        embeddings = load_embeddings_from_npy(paths["EMBEDDINGS_NPY_PATH"], mmap_mode="r")
+        index = configure_faiss_search(load_faiss_index(paths["FAISS_INDEX_PATH"]), COURSES[course_name].get("INDEX"))
+        chunks_hash = hashes["CHUNKS_JSON_PATH"]
+    verify_artifacts(chunks, embeddings, index, check_values=False)  # values are checked when publishing
+    lexical_index = _load_lexical_index(course_name, chunks, chunks_hash)
+    print(f"[INFO] Loaded shared assets for course '{course_name}'.")
+    return CourseAssets(course_name, chunks, embeddings, index, stats, hashes, lexical_index)
+
+
+def _evict_cold_courses(keep, memory_limit_mb=COURSE_ASSETS_MEMORY_LIMIT_MB):
+    """
+    Drop the least recently used courses (except ``keep``) until the loaded assets fit
+    under ``memory_limit_mb``. Sessions still holding evicted assets keep a working copy.
+    """
+    with _registry_lock:
+        total = sum(assets.nbytes for assets in _registry.values())
+        for name in list(_registry):
+            if not memory_limit_mb or total <= memory_limit_mb * 1024 * 1024:
+                break
+            if name == keep:
+                continue
+            total -= _registry.pop(name).nbytes
+            print(f"[INFO] Evicted assets of course '{name}' from memory.")
+
+
+def course_assets_exist(course_name):
+    """
+    Check whether the artifacts of a course (its bundle, or all three files) exist on disk.
+    """
+    return all(os.path.isfile(path) for path in _asset_paths(course_name).values())
+
+
+def get_course_assets(course_name):
+    """
+    Return the shared assets of a course from ``config.COURSES``, loading them once per process.
+
+    The files are re-checked on every call: an unchanged (mtime, size) returns the cached
+    assets immediately, and a changed one triggers a hash comparison so the course is only
+    reloaded when the content actually differs. While a new build is being published (its
+    files are renamed one by one), a set whose files disagree on the number of rows or the
+    embedding dimension is rejected and the previous assets are kept until the next call;
+    files of the same shape from different builds are not detected. A course bundle is a
+    single file, so it is always consistent.
+    """
+    paths = _asset_paths(course_name)
+
+    with _course_lock(course_name):
+        stats = {key: _file_stat(path) for key, path in paths.items()}
+        with _registry_lock:
+            assets = _registry.get(course_name)
+            if assets is not None:
+                _registry.move_to_end(course_name)
+        if assets is not None:
+            if stats == assets.stats:
+                return assets
+            if stats.keys() == assets.stats.keys():
+                hashes = {
+                    key: assets.hashes[key] if stats[key] == assets.stats[key] else _content_hash(key, path)
+                    for key, path in paths.items()
+                }
+                if hashes == assets.hashes:
+                    assets.stats = stats
+                    return assets
+            print(f"[INFO] Assets of course '{course_name}' changed on disk, reloading.")
+
+        try:
+            new_assets = _load_course_assets(course_name, paths, stats)
+        except ValueError as error:
+            if assets is None:
+                raise
+            print(f"[WARNING] Keeping the loaded assets of course '{course_name}': {error}")
+            return assets
+        assets = new_assets
+        with _registry_lock:
+            _registry[course_name] = assets
+            _registry.move_to_end(course_name)
+    _evict_cold_courses(keep=course_name)
+    return assets
+
+
+# Query embeddings in hybrid mode fail fast: the lexical results are a good enough fallback.
+QUERY_CLIENT_OPTIONS = {"timeout": QUERY_EMBEDDING_TIMEOUT_SECONDS, "max_retries": 0}
+
+# Until this time.monotonic() value, the embedding API is considered down and every
+# hybrid search runs lexical-only.
+_embedding_outage_until = 0.0
+
+
+def _retrieval_mode():
+    """
+    Return the retrieval mode to use now: RETRIEVAL_MODE, or "lexical" during an embedding outage.
+    """
+    if RETRIEVAL_MODE == "hybrid" and time.monotonic() < _embedding_outage_until:
+        return "lexical"
+    return RETRIEVAL_MODE
+
+
+def _start_embedding_outage(error):
+    global _embedding_outage_until
+    _embedding_outage_until = time.monotonic() + EMBEDDING_OUTAGE_SECONDS
+    print(f"[WARNING] Query embedding failed ({type(error).__name__}), "
+          f"using lexical retrieval for {EMBEDDING_OUTAGE_SECONDS}s.")
+
+
+def embed_course_queries(queries, model=EMBEDDING_MODEL):
+    """
+    Embed auxiliary queries of a request (e.g. objective matching) under the same rules as
+    retrieval: no request in "lexical" mode or during an embedding outage, and a short timeout
+    without retries. Returns the vectors, or None when they are not available; a failure
+    in "hybrid" mode starts an outage.
+    """
+    mode = _retrieval_mode()
+    if mode == "lexical":
+        return None
+    try:
+        return embed_queries(queries, model=model, client_options=QUERY_CLIENT_OPTIONS)
+    except openai.OpenAIError as error:
+        if mode == "hybrid":
+            _start_embedding_outage(error)
+        else:
+            print(f"[WARNING] Query embedding failed ({type(error).__name__}).")
+        return None
+
+
+def select_course_chunks(course_name, objectives, question_type=None, difficulty=None, token_budget=None):
+    """
+    Select the ids of the course chunks most relevant to the given objectives, question type
+    and difficulty, within ``token_budget`` tokens (RETRIEVAL_TOKEN_BUDGET by default).
+
+    In "hybrid" mode a failed or slow query embedding falls back to the lexical index, and
+    the following searches stay lexical-only for EMBEDDING_OUTAGE_SECONDS.
+    """
+    start = time.perf_counter()
+    assets = get_course_assets(course_name)
+    course_info = COURSES[course_name]
+    mode = _retrieval_mode()
+
+    def select(mode):
+        return select_context_chunks(
+            assets.index,
+            assets.chunks,
+            objectives,
+            question_type=question_type,
+            difficulty=difficulty,
+            top_k=RETRIEVAL_TOP_K,
+            token_budget=token_budget or RETRIEVAL_TOKEN_BUDGET,
+            model=EMBEDDING_MODEL,
+            embeddings=assets.embeddings,
+            rerank=course_info.get("INDEX", {}).get("type", "flat") != "flat",  # approximate indexes are re-ranked
+            lexical_index=assets.lexical_index,
+            objective_keywords=course_info.get("OBJECTIVE_KEYWORDS"),
+            mode=mode,
+            rrf_k=RRF_K,
+            client_options=QUERY_CLIENT_OPTIONS if mode == "hybrid" else None
+        )
+
+    try:
+        chunk_ids = select(mode)
+    except openai.APIError as error:
+        if mode != "hybrid":
+            raise
+        _start_embedding_outage(error)
+        mode = "lexical"
+        chunk_ids = select(mode)
+    record_span("retrieval", EMBEDDING_MODEL, time.perf_counter() - start, path="retrieve", course=course_name,
+                question_type=question_type, difficulty=difficulty, chunks=len(chunk_ids), mode=mode)
+    return chunk_ids
+
+
+def retrieve_content(course_name, objectives, question_type=None, difficulty=None, token_budget=None, labeled=False):
+    """
+    Build the prompt context from the chunks most relevant to the given objectives.
+    ``course_name`` may also be a list of courses, searched as shards (see select_shard_chunks).
+
+    With ``labeled`` every chunk is prefixed with its [n] label (see prompts.label_chunks)
+    and (content, chunk ids) is returned, the ids being (course, chunk id) pairs for shards.
+    """
+    if not isinstance(course_name, str):
+        if len(course_name) > 1:
+            keys = select_shard_chunks(course_name, objectives, question_type, difficulty, token_budget)
+            assets = {name: get_course_assets(name) for name in {name for name, _ in keys}}
+            texts = [assets[name].chunks[idx] for name, idx in keys]
+            return (label_chunks(texts), keys) if labeled else "\n".join(texts)
+        course_name = course_name[0]
+    chunks = get_course_assets(course_name).chunks
+    chunk_ids = select_course_chunks(course_name, objectives, question_type, difficulty, token_budget)
+    texts = [chunks[idx] for idx in chunk_ids]
+    return (label_chunks(texts), chunk_ids) if labeled else "\n".join(texts)
+
+
+###############################################################################
+#                       SHARDED MULTI-COURSE RETRIEVAL
+###############################################################################
+
+# Unit-length mean embedding of every course, by course name: (embeddings file stat, vector).
+# Centroids are tiny and kept when a course is evicted, so routing never opens an index.
+_centroids = {}
+
+
+def course_centroid(course_name, block_rows=4096):
+    """
+    Return the normalized mean of the normalized chunk embeddings of a course, read block
+    by block from the memory-mapped embeddings (or bundle) file and cached until the file changes.
+    """
+    paths = _asset_paths(course_name)
+    path = paths.get("BUNDLE_PATH") or paths["EMBEDDINGS_NPY_PATH"]
+    stat = _file_stat(path)
+    cached = _centroids.get(course_name)
+    if cached is not None and cached[0] == stat:
+        return cached[1]
+    if "BUNDLE_PATH" in paths:
+        embeddings = CourseBundle(path).embeddings
+    else:
+        embeddings = load_embeddings_from_npy(path, mmap_mode="r")
+    total = np.zeros(embeddings.shape[1], dtype=np.float64)
+    for start in range(0, len(embeddings), block_rows):
+        total += l2_normalize(embeddings[start : start + block_rows]).sum(axis=0)
+    centroid = l2_normalize(total)[0]
+    _centroids[course_name] = (stat, centroid)
+    return centroid
+
+
+def route_courses(course_names, queries, max_shards=SHARD_ROUTE_MAX_SHARDS, margin=SHARD_ROUTE_MARGIN,
+                  client_options=None):
+    """
+    Pick the course shards to search for ``queries``: the courses whose centroid is most
+    similar to any query, within ``margin`` of the best one and at most ``max_shards``.
+    This embeds the queries, so it is only used outside "lexical" mode (see _search_shards).
+    """
+    course_names = list(course_names)
+    if len(course_names) <= 1 or not queries:
+        return course_names[:max_shards]
+    query_vectors = l2_normalize(embed_queries(queries, model=EMBEDDING_MODEL, client_options=client_options))
+    centroids = np.stack([course_centroid(name) for name in course_names])
+    scores = (query_vectors @ centroids.T).max(axis=0)
+    ranking = np.argsort(-scores, kind="stable")
+    return [course_names[i] for i in ranking[:max_shards] if scores[i] >= scores[ranking[0]] - margin]
+
+
+def _search_shards(course_names, objectives, queries, mode):
+    """
+    Rank the chunks of the relevant course shards for ``queries``, best first.
+    Returns (shards searched, ranked (course_name, chunk_id) keys, {key: chunk}).
+    """
+    client_options = QUERY_CLIENT_OPTIONS if mode == "hybrid" else None
+    # Lexical searches are local and cheap: every course is searched instead of routing.
+    shards = list(course_names) if mode == "lexical" else route_courses(course_names, queries, client_options=client_options)
+    vector_ranked, lexical_ranked, candidates = [], [], {}
+    for name in shards:
+        assets = get_course_assets(name)
+        if not queries:
+            candidates.update({(name, idx): chunk for idx, chunk in enumerate(assets.chunks)})
+            continue
+        if mode != "lexical":
+            results = search_many(queries, assets.index, embeddings=assets.embeddings, top_k=RETRIEVAL_TOP_K,
+                                  model=EMBEDDING_MODEL, rerank=True, client_options=client_options)
+            vector_ranked += [(score, name, idx) for idx, score in results]
+            candidates.update({(name, idx): assets.chunks[idx] for idx, _ in results})
+        if mode != "vector" and assets.lexical_index is not None:
+            lexical_queries = build_lexical_queries(objectives, COURSES[name].get("OBJECTIVE_KEYWORDS"))
+            results = assets.lexical_index.search_many(lexical_queries, top_k=RETRIEVAL_TOP_K)
+            lexical_ranked += [(score, name, idx) for idx, score in results]
+            candidates.update({(name, idx): assets.chunks[idx] for idx, _ in results})
+    # BM25 scores of different courses are not comparable: the lexical ranking interleaves
+    # the courses' own rankings, then it is fused with the (comparable) cosine ranking.
+    vector_ranked.sort(key=lambda result: -result[0])
+    rankings = [[(name, idx) for _, name, idx in vector_ranked]]
+    if lexical_ranked:
+        per_course = {name: [] for name in shards}
+        for _, name, idx in sorted(lexical_ranked, key=lambda result: -result[0]):
+            per_course[name].append((name, idx))
+        rankings.append([key for keys in itertools.zip_longest(*per_course.values()) for key in keys if key is not None])
+    rankings = [ranking for ranking in rankings if ranking]
+    if len(rankings) > 1:
+        ranked = [key for key, _ in reciprocal_rank_fusion(rankings, RRF_K)]
+    else:
+        ranked = rankings[0] if rankings else list(candidates)
+    return shards, ranked, candidates
+
+
+def select_shard_chunks(course_names, objectives, question_type=None, difficulty=None, token_budget=None):
+    """
+    Select the chunks most relevant to the objectives over several courses.
+
+    The query is routed to the relevant course shards (see route_courses), which are opened
+    lazily; every shard is searched with exact cosine re-ranking so the scores of different
+    indexes are comparable, and the merged results (fused with the lexical results in
+    "hybrid" mode) are packed under ``token_budget``.
+    Returns (course_name, chunk_id) pairs, grouped by course in index order (see pdf_rag.select_chunks).
+    """
+    start = time.perf_counter()
+    queries = build_retrieval_queries(objectives, question_type, difficulty)
+    mode = _retrieval_mode()
+    try:
+        shards, ranked, candidates = _search_shards(course_names, objectives, queries, mode)
+    except openai.APIError as error:
+        if mode != "hybrid":
+            raise
+        _start_embedding_outage(error)
+        mode = "lexical"
+        shards, ranked, candidates = _search_shards(course_names, objectives, queries, mode)
+    keys = select_chunks(candidates, ranked, token_budget or RETRIEVAL_TOKEN_BUDGET)
+    record_span("retrieval", EMBEDDING_MODEL, time.perf_counter() - start, path="retrieve_shards",
+                course=",".join(shards), question_type=question_type, difficulty=difficulty, chunks=len(keys), mode=mode)
+    return keys
@@ -0,0 +1,299 @@
+"""
+Course bundle: one memory-mapped file holding the chunks, vectors and metadata of a course.
+
+Convert the chunks JSON + .npy + .index layout of a course (or of all courses) to its BUNDLE_PATH:
+    python course_bundle.py ["<course name>"] [--float16]
+
+Show the metadata of a bundle:
+    python course_bundle.py --info path/to/lecture.bundle
+
+Layout (little endian): an 8-byte magic, the format version and metadata length (uint32),
+the metadata as JSON, then 64-byte aligned sections described in ``metadata["sections"]``
+as [offset from the first aligned byte after the metadata, length]:
+
+- ``offsets``: uint64[num_chunks + 1], start of every chunk in ``text`` (the last is its end)
+- ``text``: the UTF-8 chunk texts, concatenated
+- ``vectors``: float32 or float16[num_chunks, dim], the chunk embeddings
+- ``norms``: float32[num_chunks], the L2 norm of every vector
+- ``index`` (optional): a serialized FAISS index, for approximate (non-flat) index types
+
+Opening a bundle maps the file and reads only the header: chunks and vectors are read lazily
+from the mapping, and exact (flat) searches run on the mapped vectors, so they are not
+duplicated into a FAISS index.
+"""
+import os
+import sys
+import mmap
+import json
+import struct
+import hashlib
+import argparse
+import operator
+import collections.abc
+import numpy as np
+import faiss
+
+from config import COURSES, EMBEDDING_MODEL
+from pdf_rag import (
+    DEFAULT_INDEX_CONFIG,
+    configure_faiss_search,
+    file_hash,
+    load_chunks_from_json,
+    load_embeddings_from_npy,
+    load_faiss_index,
+    verify_artifacts
+)
+
+###############################################################################
+#                           BUNDLE FORMAT
+###############################################################################
+
+MAGIC = b"ARIABNDL"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sII")  # magic, format version, metadata length
+ALIGNMENT = 64
+VECTOR_DTYPES = ("float32", "float16")
+# Files of the three-file layout a bundle is converted from.
+SOURCE_PATH_KEYS = ("CHUNKS_JSON_PATH", "EMBEDDINGS_NPY_PATH", "FAISS_INDEX_PATH")
+SEARCH_BLOCK_ROWS = 65536
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_course_bundle(bundle_path, chunks, embeddings, index_config=None, index=None,
+                        dtype="float32", metadata=None):
+    """
+    Write a course bundle, replacing ``bundle_path`` atomically.
+
+    ``index`` is stored only for approximate index types; exact (flat) searches use the
+    bundle vectors. ``metadata`` adds fields (embedding model, source hashes, ...).
+    """
+    if dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unsupported vector dtype: {dtype}")
+    index_config = {**DEFAULT_INDEX_CONFIG, **(index_config or {})}
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    texts = [chunk.encode("utf-8") for chunk in chunks]
+    offsets = np.zeros(len(texts) + 1, dtype="<u8")
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+
+    sections = {
+        "offsets": offsets.tobytes(),
+        "text": b"".join(texts),
+        "vectors": embeddings.astype(f"<{'f4' if dtype == 'float32' else 'f2'}").tobytes(),
+        "norms": np.linalg.norm(embeddings, axis=1).astype("<f4").tobytes(),
+    }
+    if index_config["type"] != "flat" and index is not None:
+        sections["index"] = faiss.serialize_index(index).tobytes()
+
+    # Section offsets are relative to the data start, the first aligned byte after the metadata
+    section_offsets, offset = {}, 0
+    for name, data in sections.items():
+        section_offsets[name] = [offset, len(data)]
+        offset = _align(offset + len(data))
+    meta_bytes = json.dumps({
+        **(metadata or {}),
+        "format_version": FORMAT_VERSION,
+        "num_chunks": len(texts),
+        "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        "dtype": dtype,
+        "index_config": index_config,
+        "sections": section_offsets,
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    data_start = _align(HEADER.size + len(meta_bytes))
+
+    tmp_path = f"{bundle_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(meta_bytes)))
+        f.write(meta_bytes)
+        for name, data in sections.items():
+            f.write(b"\0" * (data_start + section_offsets[name][0] - f.tell()))
+            f.write(data)
+    os.replace(tmp_path, bundle_path)
+    print(f"[INFO] Course bundle with {len(texts)} chunks ({dtype}) saved to {bundle_path}")
+
+
+def bundle_fingerprint(bundle_path):
+    """
+    Return the SHA-256 hex digest of the header and metadata of a bundle. The metadata holds
+    the hashes of the files the bundle was built from, so this identifies its content without
+    reading the whole file.
+    """
+    with open(bundle_path, "rb") as f:
+        header = f.read(HEADER.size)
+        _, _, metadata_length = HEADER.unpack(header)
+        return hashlib.sha256(header + f.read(metadata_length)).hexdigest()
+
+
+class BundleChunks(collections.abc.Sequence):
+    """
+    Read-only sequence of the chunk texts of a bundle, decoded from the mapping on access.
+    """
+    def __init__(self, offsets, text):
+        self._offsets = offsets
+        self._text = text
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        idx = operator.index(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("chunk index out of range")
+        return str(self._text[int(self._offsets[idx]) : int(self._offsets[idx + 1])], "utf-8")
+
+
+class FlatVectorIndex:
+    """
+    Exact search over the mapped bundle vectors, in blocks of SEARCH_BLOCK_ROWS rows.
+
+    Provides the part of the FAISS index API used by pdf_rag (``search``, ``ntotal``, ``d``
+    and ``metric_type``): cosine indexes return inner products of normalized vectors,
+    L2 indexes squared distances, like IndexFlatIP and IndexFlatL2.
+    """
+    def __init__(self, vectors, norms, metric="l2"):
+        self.vectors = vectors
+        self.norms = norms
+        self.ntotal, self.d = vectors.shape
+        self.metric_type = faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.d)
+        cosine = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        # Smaller keys are better: squared distances, or negated similarities
+        best_keys = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        query_norms = np.einsum("qd,qd->q", queries, queries)
+        for start in range(0, self.ntotal, SEARCH_BLOCK_ROWS):
+            block = np.asarray(self.vectors[start : start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+            norms = self.norms[start : start + len(block)]
+            products = queries @ block.T
+            if cosine:
+                keys = -products / np.maximum(norms, 1e-12)
+            else:
+                keys = query_norms[:, None] - 2 * products + norms ** 2
+            keys = np.hstack([best_keys, keys])
+            ids = np.hstack([best_ids, np.broadcast_to(np.arange(start, start + len(block)), products.shape)])
+            top = np.argpartition(keys, k - 1, axis=1)[:, :k] if keys.shape[1] > k else np.argsort(keys, axis=1)
+            best_keys, best_ids = np.take_along_axis(keys, top, axis=1), np.take_along_axis(ids, top, axis=1)
+        order = np.argsort(best_keys, axis=1, kind="stable")
+        best_keys, best_ids = np.take_along_axis(best_keys, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+        return (-best_keys if cosine else np.maximum(best_keys, 0)), best_ids
+
+
+class CourseBundle:
+    """
+    A course bundle opened with mmap. Only the header is read when opening: ``chunks``
+    (a BundleChunks sequence) and ``embeddings`` (a read-only array) read the mapping lazily.
+    """
+    def __init__(self, bundle_path):
+        self.path = bundle_path
+        with open(bundle_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, metadata_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{bundle_path} is not a course bundle.")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{bundle_path} has the unsupported bundle version {version}.")
+        self.metadata = json.loads(self._mmap[HEADER.size : HEADER.size + metadata_length])
+        self._data_start = _align(HEADER.size + metadata_length)
+
+        num_chunks, dim = self.metadata["num_chunks"], self.metadata["dim"]
+        vector_dtype = "<f4" if self.metadata["dtype"] == "float32" else "<f2"
+        text_offset, text_length = self.metadata["sections"]["text"]
+        text_start = self._data_start + text_offset
+        self.chunks = BundleChunks(
+            self._section("offsets", "<u8"), memoryview(self._mmap)[text_start : text_start + text_length]
+        )
+        self.embeddings = self._section("vectors", vector_dtype).reshape(num_chunks, dim)
+        self.norms = self._section("norms", "<f4")
+
+    def _section(self, name, dtype):
+        offset, length = self.metadata["sections"][name]
+        dtype = np.dtype(dtype)
+        return np.frombuffer(self._mmap, dtype=dtype, count=length // dtype.itemsize, offset=self._data_start + offset)
+
+    def load_index(self, index_config=None):
+        """
+        Return the search index: the stored FAISS index for approximate index types (configured
+        with the search parameters of ``index_config``), else exact search on the mapped vectors.
+        """
+        stored_config = self.metadata["index_config"]
+        if "index" in self.metadata["sections"]:
+            index = faiss.deserialize_index(np.array(self._section("index", np.uint8)))
+            return configure_faiss_search(index, {**stored_config, **(index_config or {})})
+        return FlatVectorIndex(self.embeddings, self.norms, stored_config.get("metric", "l2"))
+
+
+###############################################################################
+#                           CONVERTERS
+###############################################################################
+
+def convert_course_to_bundle(course_name, dtype=None):
+    """
+    Write the BUNDLE_PATH of a course from its chunks JSON, embeddings .npy and FAISS index.
+    ``dtype`` defaults to the course's BUNDLE_DTYPE (float32).
+    """
+    course_info = COURSES[course_name]
+    if not course_info.get("BUNDLE_PATH"):
+        raise ValueError(f"Course '{course_name}' has no BUNDLE_PATH.")
+    paths = {key: course_info[key] for key in SOURCE_PATH_KEYS}
+    chunks = load_chunks_from_json(paths["CHUNKS_JSON_PATH"])
+    embeddings = load_embeddings_from_npy(paths["EMBEDDINGS_NPY_PATH"])
+    index = load_faiss_index(paths["FAISS_INDEX_PATH"])
+    verify_artifacts(chunks, embeddings, index)
+    write_course_bundle(
+        course_info["BUNDLE_PATH"],
+        chunks,
+        embeddings,
+        index_config=course_info.get("INDEX"),
+        index=index,
+        dtype=dtype or course_info.get("BUNDLE_DTYPE", "float32"),
+        metadata={
+            "course": course_name,
+            "embedding_model": EMBEDDING_MODEL,
+            "source_hashes": {key: file_hash(path) for key, path in paths.items()},
+        }
+    )
+
+
+def bundle_is_current(course_name):
+    """
+    Check whether the bundle of a course exists and was converted from its current files.
+    """
+    course_info = COURSES[course_name]
+    bundle_path = course_info.get("BUNDLE_PATH")
+    if not bundle_path or not os.path.isfile(bundle_path):
+        return False
+    try:
+        metadata = CourseBundle(bundle_path).metadata
+    except ValueError:
+        return False
+    return metadata.get("source_hashes") == {key: file_hash(course_info[key]) for key in SOURCE_PATH_KEYS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("course", nargs="?", choices=list(COURSES.keys()), help="Defaults to all courses.")
+    parser.add_argument("--float16", action="store_true", help="Store the vectors as float16 (half the size).")
+    parser.add_argument("--info", metavar="BUNDLE", help="Print the metadata of a bundle and exit.")
+    args = parser.parse_args()
+
+    if args.info:
+        print(json.dumps(CourseBundle(args.info).metadata, indent=2, ensure_ascii=False))
+        return 0
+    for course_name in [args.course] if args.course else COURSES:
+        if not COURSES[course_name].get("BUNDLE_PATH"):
+            print(f"[WARNING] Course '{course_name}' has no BUNDLE_PATH, skipping it.")
+            continue
+        convert_course_to_bundle(course_name, dtype="float16" if args.float16 else None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
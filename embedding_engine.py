@@ -0,0 +1,138 @@
+import time
+import random
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+import openai
+
+from config import (
+    EMBEDDING_BATCH_TOKENS,
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_REQUESTS_PER_MINUTE,
+    EMBEDDING_TOKENS_PER_MINUTE
+)
+
+###############################################################################
+#                       RATE-LIMITED BATCH EMBEDDING ENGINE
+###############################################################################
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# The embeddings endpoint accepts at most this many inputs per request.
+MAX_BATCH_ITEMS = 2048
+
+
+class RateLimiter:
+    """
+    Sliding one-minute window over requests and tokens, shared by all worker threads.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute, window=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self._events = collections.deque()
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        """
+        Block until one request of ``tokens`` tokens fits in both budgets, then record it.
+        A single request larger than the token budget is let through once the window is empty.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= self.window:
+                    self._tokens_in_window -= self._events.popleft()[1]
+                fits = (
+                    len(self._events) < self.requests_per_minute
+                    and (self._tokens_in_window + tokens <= self.tokens_per_minute or not self._events)
+                )
+                if fits:
+                    self._events.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                wait = self.window - (now - self._events[0][0])
+            time.sleep(max(wait, 0.01))
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model):
+    """
+    Return the process-wide rate limiter of an embedding model, configured in ``config.py``.
+    """
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            _rate_limiters[model] = RateLimiter(EMBEDDING_REQUESTS_PER_MINUTE, EMBEDDING_TOKENS_PER_MINUTE)
+        return _rate_limiters[model]
+
+
+def make_token_batches(token_counts, max_batch_tokens=EMBEDDING_BATCH_TOKENS, max_batch_items=MAX_BATCH_ITEMS):
+    """
+    Split consecutive inputs into (start, end, tokens) batches of at most ``max_batch_tokens``
+    tokens. An input larger than the limit gets a batch of its own.
+    """
+    batches = []
+    start, batch_tokens = 0, 0
+    for i, tokens in enumerate(token_counts):
+        if i > start and (batch_tokens + tokens > max_batch_tokens or i - start >= max_batch_items):
+            batches.append((start, i, batch_tokens))
+            start, batch_tokens = i, 0
+        batch_tokens += tokens
+    if start < len(token_counts):
+        batches.append((start, len(token_counts), batch_tokens))
+    return batches
+
+
+def _create_with_retry(client, batch, model, tokens, rate_limiter, max_retries, base_delay, max_delay):
+    for attempt in range(max_retries + 1):
+        # Every attempt is a request of its own and takes its own place in the budgets
+        rate_limiter.acquire(tokens)
+        try:
+            return client.embeddings.create(input=batch, model=model)
+        except RETRYABLE_ERRORS as error:
+            if attempt == max_retries:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))  # full jitter
+            print(f"[WARNING] Embedding request failed ({type(error).__name__}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+def embed_texts(client, texts, token_counts, model="text-embedding-ada-002",
+                max_batch_tokens=EMBEDDING_BATCH_TOKENS, max_concurrency=EMBEDDING_MAX_CONCURRENCY,
+                rate_limiter=None, max_retries=6, base_delay=1.0, max_delay=60.0):
+    """
+    Embed ``texts`` with concurrent, token-sized batches and return a (len(texts), dim) float32 array.
+
+    Batches run on up to ``max_concurrency`` threads within the model's requests- and
+    tokens-per-minute budgets (which every retry counts against), retry transient errors with
+    jittered exponential backoff, and write their vectors in input order into one preallocated array.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    rate_limiter = rate_limiter or get_rate_limiter(model)
+    batches = make_token_batches(token_counts, max_batch_tokens)
+    result = {"array": None}
+    result_lock = threading.Lock()
+
+    def run_batch(start, end, tokens):
+        response = _create_with_retry(client, texts[start:end], model, tokens, rate_limiter, max_retries, base_delay, max_delay)
+        data = sorted(response.data, key=lambda item: item.index)
+        with result_lock:
+            if result["array"] is None:
+                result["array"] = np.empty((len(texts), len(data[0].embedding)), dtype=np.float32)
+        result["array"][start:end] = [item.embedding for item in data]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(batches)))) as executor:
+        futures = [executor.submit(run_batch, *batch) for batch in batches]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    return result["array"]
@@ -0,0 +1,111 @@
+"""
+Recall-vs-latency report of the FAISS index options for a course, against the exact Flat baseline.
+
+Usage:
+    python index_report.py "<course name>" [--k 5] [--queries 200] [--synthetic 100000] [--json report.json]
+
+``--synthetic N`` grows the course embeddings to N noisy copies, to see how the options
+behave at the size of a whole degree programme before building one.
+"""
+import argparse
+import json
+import time
+import numpy as np
+import faiss
+
+from config import COURSES
+from pdf_rag import create_faiss_index, configure_faiss_search, l2_normalize, load_embeddings_from_npy
+
+# (label, index config, search parameter name, values to sweep)
+CANDIDATES = [
+    ("hnsw M=16", {"type": "hnsw", "metric": "cosine", "M": 16}, "ef_search", [16, 32, 64, 128, 256]),
+    ("hnsw M=32", {"type": "hnsw", "metric": "cosine", "M": 32}, "ef_search", [16, 32, 64, 128, 256]),
+    ("ivfpq m=64", {"type": "ivfpq", "metric": "cosine", "m": 64}, "nprobe", [1, 4, 16, 64]),
+    ("ivfpq m=96", {"type": "ivfpq", "metric": "cosine", "m": 96}, "nprobe", [1, 4, 16, 64]),
+]
+
+
+def synthetic_embeddings(embeddings, size, noise=0.05, seed=0):
+    """
+    Grow ``embeddings`` to ``size`` rows by adding Gaussian noise to random copies.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(embeddings), size=size)
+    vectors = np.asarray(embeddings, dtype=np.float32)[rows]
+    vectors += rng.normal(scale=noise * np.abs(vectors).mean(), size=vectors.shape).astype(np.float32)
+    return vectors
+
+
+def measure(index, queries, truth, k):
+    """
+    Return recall@k against ``truth`` and the p50/p95 single-query latency in milliseconds.
+    """
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        _, found = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(found[0]) & set(expected))
+    return {
+        "recall": hits / (len(queries) * k),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def build_report(embeddings, k=5, num_queries=200, seed=0):
+    """
+    Compare every candidate configuration with the exact cosine Flat index.
+    """
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(embeddings), size=min(num_queries, len(embeddings)), replace=False)
+    queries = l2_normalize(synthetic_embeddings(np.asarray(embeddings)[query_rows], len(query_rows), seed=seed + 1))
+
+    baseline = create_faiss_index(embeddings, {"type": "flat", "metric": "cosine"})
+    _, truth = baseline.search(queries, k)
+    rows = [{"index": "flat", "param": None, "value": None, **measure(baseline, queries, truth, k)}]
+
+    for label, index_config, param, values in CANDIDATES:
+        start = time.perf_counter()
+        index = create_faiss_index(embeddings, index_config)
+        build_seconds = time.perf_counter() - start
+        if index_config["type"] == "ivfpq" and not isinstance(index, faiss.IndexIVF):
+            continue  # too few vectors to train IVF-PQ, the flat fallback is already the baseline
+        for value in values:
+            configure_faiss_search(index, {param: value})
+            rows.append({
+                "index": label,
+                "param": param,
+                "value": value,
+                "build_s": build_seconds,
+                **measure(index, queries, truth, k),
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("course", choices=list(COURSES.keys()))
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--synthetic", type=int, default=None)
+    parser.add_argument("--json", default=None, help="Also write the report rows to this JSON file.")
+    args = parser.parse_args()
+
+    embeddings = load_embeddings_from_npy(COURSES[args.course]["EMBEDDINGS_NPY_PATH"])
+    if args.synthetic:
+        embeddings = synthetic_embeddings(embeddings, args.synthetic)
+
+    rows = build_report(embeddings, k=args.k, num_queries=args.queries)
+    print(f"\n{'index':<12} {'param':<10} {'value':>6} {'recall@' + str(args.k):>9} {'p50 ms':>8} {'p95 ms':>8}")
+    for row in rows:
+        print(f"{row['index']:<12} {row['param'] or '-':<10} {row['value'] or '-':>6} "
+              f"{row['recall']:>9.3f} {row['p50_ms']:>8.3f} {row['p95_ms']:>8.3f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Headless course ingestion: build, verify and publish the artifacts of a course (or of all courses).
+
+Build or update the chunks, embeddings, FAISS index, manifest, bundle and lexical (BM25) index
+of the courses in config.COURSES:
+    python ingest.py ["<course name>"] [--force]
+
+Check the published artifacts without building anything:
+    python ingest.py ["<course name>"] --check
+
+Builds hold a per-course file lock, so concurrent runs never write the same files; every file
+is written to a temporary file and renamed into place once the new set is consistent.
+The web app only loads published artifacts and never runs OCR or embedding itself.
+"""
+import os
+import sys
+import time
+import argparse
+import contextlib
+
+from config import CHUNK_SIZE, COURSES, EMBEDDING_MODEL
+from course_bundle import SOURCE_PATH_KEYS, CourseBundle, bundle_is_current, convert_course_to_bundle
+from lexical_index import LexicalIndex
+from pdf_rag import (
+    file_hash,
+    ingest_pdf_incremental,
+    load_chunks_from_json,
+    load_embeddings_from_npy,
+    load_faiss_index,
+    manifest_is_current,
+    verify_artifacts
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+###############################################################################
+#                           CROSS-PROCESS BUILD LOCK
+###############################################################################
+
+@contextlib.contextmanager
+def build_lock(lock_path, poll_seconds=1.0):
+    """
+    Hold an exclusive lock on ``lock_path`` shared by all processes on this machine,
+    waiting for another build to finish first. The lock is released when the process exits.
+    """
+    with open(lock_path, "a+") as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"[INFO] Waiting for the build holding {lock_path}...")
+                fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(poll_seconds)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def course_lock_path(course_name):
+    return f"{COURSES[course_name]['MANIFEST_PATH']}.lock"
+
+
+###############################################################################
+#                           BUILD AND VERIFY
+###############################################################################
+
+def verify_course(course_name):
+    """
+    Load the published artifacts of a course and check that they are consistent.
+    Raises FileNotFoundError or ValueError.
+    """
+    course_info = COURSES[course_name]
+    paths = [course_info[key] for key in SOURCE_PATH_KEYS]
+    paths += [course_info.get("BUNDLE_PATH"), course_info.get("LEXICAL_INDEX_PATH")]
+    missing = [path for path in paths if path and not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError(f"Missing artifacts: {', '.join(missing)}")
+    verify_artifacts(
+        load_chunks_from_json(course_info["CHUNKS_JSON_PATH"]),
+        load_embeddings_from_npy(course_info["EMBEDDINGS_NPY_PATH"], mmap_mode="r"),
+        load_faiss_index(course_info["FAISS_INDEX_PATH"])
+    )
+    if course_info.get("BUNDLE_PATH"):
+        bundle = CourseBundle(course_info["BUNDLE_PATH"])
+        verify_artifacts(bundle.chunks, bundle.embeddings, bundle.load_index())
+    if course_info.get("LEXICAL_INDEX_PATH") and not lexical_index_is_current(course_name):
+        raise ValueError(f"{course_info['LEXICAL_INDEX_PATH']} was not built from the current chunks.")
+
+
+def lexical_index_is_current(course_name):
+    """
+    Check whether the lexical index of a course exists and was built from its current chunks.
+    """
+    course_info = COURSES[course_name]
+    path = course_info.get("LEXICAL_INDEX_PATH")
+    if not (path and os.path.isfile(path) and os.path.isfile(course_info["CHUNKS_JSON_PATH"])):
+        return False
+    try:
+        source_hash = LexicalIndex.load(path).source_hash
+    except (OSError, KeyError, ValueError):
+        return False
+    return source_hash == file_hash(course_info["CHUNKS_JSON_PATH"])
+
+
+def build_lexical_index(course_name):
+    """
+    Build the BM25 index of a course from its chunks JSON and save it to LEXICAL_INDEX_PATH.
+    """
+    course_info = COURSES[course_name]
+    chunks_path = course_info["CHUNKS_JSON_PATH"]
+    lexical_index = LexicalIndex.build(load_chunks_from_json(chunks_path), source_hash=file_hash(chunks_path))
+    lexical_index.save(course_info["LEXICAL_INDEX_PATH"])
+
+
+def course_is_current(course_name):
+    """
+    Check whether the artifacts of a course exist and were built from the PDF as it is now
+    (the bundle, if configured, is checked separately with bundle_is_current).
+    """
+    course_info = COURSES[course_name]
+    manifest_path = course_info.get("MANIFEST_PATH")
+    return (
+        all(os.path.isfile(course_info[key]) for key in SOURCE_PATH_KEYS)
+        and os.path.isfile(manifest_path)
+        and manifest_is_current(course_info.get("PDF_FILE_PATH"), manifest_path)
+    )
+
+
+def build_course(course_name, force=False):
+    """
+    Build or update the artifacts of a course under its build lock, unless they are current.
+    With ``force`` everything is rebuilt from the PDF instead of patched (see
+    pdf_rag.ingest_pdf_incremental). The bundle (BUNDLE_PATH) and lexical index (LEXICAL_INDEX_PATH) are rebuilt from the
+    other files whenever they change.
+    Returns the ingestion stats, or None if the PDF did not have to be ingested.
+    """
+    course_info = COURSES[course_name]
+    with build_lock(course_lock_path(course_name)):
+        # Checked under the lock: another process may just have finished the same build
+        sources_current = not force and course_is_current(course_name)
+        bundle_current = not course_info.get("BUNDLE_PATH") or bundle_is_current(course_name)
+        lexical_current = not course_info.get("LEXICAL_INDEX_PATH") or lexical_index_is_current(course_name)
+        if sources_current and bundle_current and lexical_current:
+            print(f"[INFO] Artifacts of course '{course_name}' are up to date.")
+            return None
+        start = time.perf_counter()
+        stats = None
+        if not sources_current:
+            stats = ingest_pdf_incremental(
+                course_info.get("PDF_FILE_PATH"),
+                course_info.get("CHUNKS_JSON_PATH"),
+                course_info.get("EMBEDDINGS_NPY_PATH"),
+                course_info.get("FAISS_INDEX_PATH"),
+                course_info.get("MANIFEST_PATH"),
+                chunk_size=CHUNK_SIZE,
+                model=EMBEDDING_MODEL,
+                index_config=course_info.get("INDEX"),
+                rebuild=force
+            )
+        if course_info.get("BUNDLE_PATH") and not (sources_current and bundle_current):
+            convert_course_to_bundle(course_name)
+        if course_info.get("LEXICAL_INDEX_PATH") and not (sources_current and lexical_current):
+            build_lexical_index(course_name)
+        verify_course(course_name)
+        print(f"[INFO] Published artifacts of course '{course_name}' in {time.perf_counter() - start:.1f}s.")
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("course", nargs="?", choices=list(COURSES.keys()), help="Defaults to all courses.")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild everything from the PDF, even if the artifacts are up to date.")
+    parser.add_argument("--check", action="store_true", help="Only verify the published artifacts.")
+    args = parser.parse_args()
+
+    failed = []
+    for course_name in [args.course] if args.course else COURSES:
+        try:
+            if args.check:
+                verify_course(course_name)
+                print(f"[INFO] Artifacts of course '{course_name}' are consistent.")
+            else:
+                build_course(course_name, force=args.force)
+        except Exception as error:
+            print(f"[WARNING] Course '{course_name}' failed: {error}")
+            failed.append(course_name)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import os
+import re
+import math
+import keyword
+import builtins
+import collections
+import numpy as np
+
+###############################################################################
+#                       CODE-AWARE GERMAN TOKENIZER
+###############################################################################
+
+# Words and Python identifiers (letters, digits and underscores, not starting with a digit).
+WORD_PATTERN = re.compile(r"[^\W\d]\w*")
+CAMEL_CASE_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+# Python keywords and builtins are matched exactly, never stemmed or dropped as stopwords.
+CODE_WORDS = frozenset(keyword.kwlist + keyword.softkwlist + dir(builtins))
+STOPWORDS = frozenset("""
+    aber alle allem allen aller alles also am an auch auf aus bei beim bin bis bzw da damit dann
+    das dass dem den denen der des dich die dies diese diesem diesen dieser dieses dir doch dort du
+    durch ein eine einem einen einer eines er es etwa euch für hat hatte hier ich ihr im ist ja
+    jede jedem jeden jeder jedes kann kein keine man mit muss nach nicht noch nun nur ob oder ohne
+    sehr sein seine sich sie sind so soll sowie über um und uns unter vom von vor war was weil
+    welche welchem welchen welcher wenn wer werden wie wieder will wir wird wo zu zum zur
+    the of an to
+""".split()) - CODE_WORDS
+
+
+def stem_german(word):
+    """
+    Stem a lowercase German word with the CISTEM algorithm (Weissweiler & Fraser, 2017),
+    case-insensitive variant.
+    """
+    word = word.replace("ü", "u").replace("ö", "o").replace("ä", "a").replace("ß", "ss")
+    word = re.sub(r"^ge(.{4,})", r"\1", word)
+    word = word.replace("sch", "$").replace("ei", "%").replace("ie", "&")
+    word = re.sub(r"(.)\1", r"\1*", word)
+    while len(word) > 3:
+        if len(word) > 5:
+            word, found = re.subn(r"e[mr]$", "", word)
+            if found:
+                continue
+            word, found = re.subn(r"nd$", "", word)
+            if found:
+                continue
+        word, found = re.subn(r"t$", "", word)
+        if found:
+            continue
+        word, found = re.subn(r"[esn]$", "", word)
+        if not found:
+            break
+    word = re.sub(r"(.)\*", r"\1\1", word)
+    return word.replace("$", "sch").replace("%", "ei").replace("&", "ie")
+
+
+def tokenize(text):
+    """
+    Split text into index terms.
+
+    Identifiers with underscores or inner capitals (``__init__``, ``read_csv``, ``ValueError``)
+    and Python keywords/builtins are kept whole (lowercased) and also split into their parts;
+    other words are lowercased, German stopwords dropped and the rest stemmed.
+    """
+    terms = []
+    for word in WORD_PATTERN.findall(text):
+        lower = word.lower()
+        if "_" in word or lower in CODE_WORDS or (not word.isupper() and any(c.isupper() for c in word[1:])):
+            terms.append(lower)
+            parts = [part.lower() for piece in word.split("_") for part in CAMEL_CASE_PATTERN.findall(piece)]
+            if len(parts) > 1:
+                terms.extend(part for part in parts if len(part) > 1)
+        elif lower not in STOPWORDS and len(lower) > 1:
+            terms.append(stem_german(lower))
+    return terms
+
+
+###############################################################################
+#                           BM25 INVERTED INDEX
+###############################################################################
+
+LEXICAL_INDEX_VERSION = 1
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the chunks of a course.
+
+    The postings of every term (document ids and their precomputed BM25 weights) are stored
+    in flat arrays, so scoring a query only adds up the weights of its terms' postings.
+    """
+    def __init__(self, terms, offsets, doc_ids, weights, doc_count, source_hash=None):
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.doc_count = doc_count
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return self.doc_count
+
+    @classmethod
+    def build(cls, chunks, source_hash=None, k1=BM25_K1, b=BM25_B):
+        postings = collections.defaultdict(list)
+        doc_lengths = []
+        for doc_id, chunk in enumerate(chunks):
+            counts = collections.Counter(tokenize(chunk))
+            doc_lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                postings[term].append((doc_id, count))
+
+        doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avg_length = float(doc_lengths.mean()) if len(doc_lengths) and doc_lengths.mean() else 1.0
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(postings[term]) for term in terms], out=offsets[1:])
+        doc_ids = np.empty(offsets[-1], dtype=np.int32)
+        weights = np.empty(offsets[-1], dtype=np.float32)
+        for i, term in enumerate(terms):
+            ids, counts = np.asarray(postings[term], dtype=np.float32).T
+            idf = math.log(1 + (len(doc_lengths) - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = k1 * (1 - b + b * doc_lengths[ids.astype(np.int64)] / avg_length)
+            doc_ids[offsets[i] : offsets[i + 1]] = ids
+            weights[offsets[i] : offsets[i + 1]] = idf * counts * (k1 + 1) / (counts + norm)
+        return cls(terms, offsets, doc_ids, weights, len(doc_lengths), source_hash)
+
+    def scores(self, query):
+        """
+        Return the BM25 score of every chunk for ``query``.
+        """
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        for term in tokenize(query):
+            i = self.terms.get(term)
+            if i is not None:
+                start, end = self.offsets[i], self.offsets[i + 1]
+                scores[self.doc_ids[start:end]] += self.weights[start:end]
+        return scores
+
+    def search_many(self, queries, top_k=3):
+        """
+        Search several queries and return de-duplicated (chunk_id, score) pairs, each chunk
+        with its best score over all queries, best first. Chunks matching no term are left out.
+        """
+        best = {}
+        for query in queries:
+            scores = self.scores(query)
+            top = np.argsort(-scores, kind="stable")[:top_k]
+            for idx in top[scores[top] > 0]:
+                best[int(idx)] = max(best.get(int(idx), 0.0), float(scores[idx]))
+        return sorted(best.items(), key=lambda item: -item[1])
+
+    def save(self, path):
+        """
+        Save the index as a compressed .npz file, replacing ``path`` atomically.
+        """
+        terms = sorted(self.terms, key=self.terms.get)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                version=np.int64(LEXICAL_INDEX_VERSION),
+                doc_count=np.int64(self.doc_count),
+                source_hash=np.str_(self.source_hash or ""),
+                terms=np.array(terms, dtype=str),
+                offsets=self.offsets,
+                doc_ids=self.doc_ids,
+                weights=self.weights
+            )
+        os.replace(tmp_path, path)
+        print(f"[INFO] Lexical index with {len(terms)} terms saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != LEXICAL_INDEX_VERSION:
+                raise ValueError(f"{path} has an unsupported lexical index version.")
+            index = cls(data["terms"].tolist(), data["offsets"], data["doc_ids"], data["weights"],
+                        int(data["doc_count"]), str(data["source_hash"]) or None)
+        print(f"[INFO] Loaded lexical index from {path}, with {len(index.terms)} terms.")
+        return index
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuse ranked lists of chunk ids: every list adds 1 / (k + rank) to the score of its chunks.
+    Returns (chunk_id, score) pairs, best first.
+    """
+    scores = collections.defaultdict(float)
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking, start=1):
+            scores[idx] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
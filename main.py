@@ -1,4 +1,3 @@
-import os
 import streamlit as st
 from openai_client import OpenAIClient
 from services import (
@@ -10,20 +9,102 @@ from services import (
     hide_spinner
 )
 from config import *
+from course_assets import course_assets_exist, get_course_assets, retrieve_content
+from metrics import start_metrics_server
+from prefetch import QuestionPrefetcher
+from question_bank import get_question_bank
+from question_history import QuestionHistory
+from session_summary import ObjectiveScores, match_objective
+from structured_questions import STRUCTURED_QUESTIONS, CodeQuestion, question_from_dict
 
-from pdf_rag import (
-    process_pdf_for_rag,
-    save_chunks_to_json,
-    load_chunks_from_json,
-    embed_chunks_openai,
-    create_faiss_index,
-    save_faiss_index,
-    load_faiss_index,
-    save_embeddings_to_npy,
-    load_embeddings_from_npy
-)
+def generate_question(ai_client, course_name, question_type, difficulty, question_history,
+                      course_objectives, selected_objectives, review_courses=(), **kwargs):
+    """
+    Draw a question from the course's question bank, or generate one from the retrieved
+    course context when the bank has run out.
+
+    ``question_history`` is the session's QuestionHistory: bank questions similar to earlier
+    ones are skipped, and only its short do-not-repeat list is sent to the model. A generated
+    question similar to an earlier one (or an unusable one, e.g. with a failing reference
+    solution) is regenerated up to QUESTION_REPEAT_RETRIES times. Only uses its arguments
+    (no session state), so it can also run on a prefetch thread.
+
+    Generated questions are structured (see structured_questions.STRUCTURED_QUESTIONS) and
+    carry their answer key, so answers can be graded locally. Bank questions without a key
+    are returned as text, or a text stream with ``stream=True``.
+
+    With ``review_courses`` the context is retrieved from the shards of all the courses and
+    the (single-course) question bank is not used.
+    """
+    if not review_courses:
+        bank_entry = get_question_bank(course_name).draw(
+            selected_objectives or course_objectives, question_type, difficulty, exclude=question_history
+        )
+        if bank_entry is not None:
+            if bank_entry.get("answer_key"):
+                return question_from_dict(bank_entry["answer_key"])
+            return iter([bank_entry["question"]]) if kwargs.get("stream") else bank_entry["question"]
+
+    content, chunk_ids = retrieve_content(
+        [course_name, *review_courses], selected_objectives or course_objectives, question_type, difficulty, labeled=True
+    )
+    for attempt in range(QUESTION_REPEAT_RETRIES + 1):
+        try:
+            question = ai_client.question_generator(
+                content,
+                question_type,
+                difficulty,
+                question_history.prompt_items(),
+                course_objectives,
+                selected_objectives,
+                chunk_ids=chunk_ids,
+                **kwargs
+            )
+        except ValueError as error:
+            if attempt == QUESTION_REPEAT_RETRIES:
+                raise
+            print(f"[WARNING] Unusable generated question (attempt {attempt + 1} of {QUESTION_REPEAT_RETRIES + 1}): {error}")
+            continue
+        if not question_history.is_repeat(str(question)):
+            return question
+        print(f"[WARNING] Generated question repeats an earlier one (attempt {attempt + 1} of {QUESTION_REPEAT_RETRIES + 1}).")
+    return question
+
+def question_objective(course_name, objectives, objective_keywords):
+    """
+    Return the objective of the current question, found once per question: the objective
+    its bank entry was generated for, or else match_objective (which may embed the question).
+    """
+    if st.session_state.question_objective is None:
+        st.session_state.question_objective = (
+            get_question_bank(course_name).objective_of(st.session_state.question)
+            or match_objective(st.session_state.question, objectives, objective_keywords)
+        )
+    return st.session_state.question_objective
+
+
+def show_question(question):
+    """
+    Display a new question: show a structured question, or stream a text question.
+    Returns the question text and its answer key (None for questions graded by the model).
+    """
+    if isinstance(question, STRUCTURED_QUESTIONS):
+        st.write(str(question))
+        return str(question), question
+    return st.write_stream(question), None
+
+def prefetch_key(course_name, question_type, difficulty, selected_objectives, question_history, review_courses=()):
+    """
+    Describe the inputs of the next question; a prefetch is only used if they did not change.
+    """
+    return (
+        course_name, tuple(review_courses), question_type, difficulty, tuple(selected_objectives or ()), len(question_history)
+    )
 
 def main():
+    # Prometheus /metrics endpoint (started once per process)
+    start_metrics_server()
+
     # Page title and intro
     st.title(APP_TITLE)
     st.markdown(APP_INTRO)
@@ -33,22 +114,24 @@ def main():
         st.session_state.recap_in_progress = False
     if 'questions_answered' not in st.session_state:
         st.session_state.questions_answered = 0
-    if 'content' not in st.session_state:
-        st.session_state.content = None
     if 'question' not in st.session_state:
         st.session_state.question = None
+    if 'answer_key' not in st.session_state:
+        st.session_state.answer_key = None
+    if 'question_objective' not in st.session_state:
+        st.session_state.question_objective = None
     if 'questions_asked' not in st.session_state:
         st.session_state.questions_asked = []
+    if 'question_history' not in st.session_state:
+        st.session_state.question_history = QuestionHistory()
     if 'received_feedback' not in st.session_state:
         st.session_state.received_feedback = []
-    if 'chunks' not in st.session_state:
-        st.session_state.chunks = None
-    if 'embeddings' not in st.session_state:
-        st.session_state.embeddings = None
-    if 'faiss_index' not in st.session_state:
-        st.session_state.faiss_index = None
+    if 'objective_scores' not in st.session_state:
+        st.session_state.objective_scores = ObjectiveScores()
     if 'user_answer' not in st.session_state:
         st.session_state.user_answer = ""
+    if 'prefetcher' not in st.session_state:
+        st.session_state.prefetcher = QuestionPrefetcher()
 
     # ---------------- Course & Model Selection ----------------
     # 1) Select Course
@@ -59,8 +142,18 @@ def main():
     # 2) Retrieve course data from config
     course_info = COURSES[course_name]
 
+    # Optionally review other courses in the same session (their indexes are searched as shards)
+    other_courses = [name for name in COURSES if name != course_name]
+    review_courses = st.multiselect("Also review these courses:", other_courses) if other_courses else []
+
     # Display learning objectives if available
-    course_objectives = course_info.get("OBJECTIVES", [])
+    course_objectives = course_info.get("OBJECTIVES", []) + [
+        objective for name in review_courses for objective in COURSES[name].get("OBJECTIVES", [])
+    ]
+    objective_keywords = {
+        objective: keywords for name in [course_name, *review_courses]
+        for objective, keywords in COURSES[name].get("OBJECTIVE_KEYWORDS", {}).items()
+    }
     if course_objectives:
         selected_objectives = st.multiselect("Pick one or more learning objectives to focus on:", course_objectives)
     else:
@@ -87,64 +180,59 @@ def main():
 
     question_type = st.selectbox(
         "Choose the type of questions you prefer",
-        ["Multiple-Choice Questions", "Code Tracing and Correction", "Code Completion"]
+        QUESTION_TYPES
     )
 
     difficulty_level = st.selectbox(
         "Choose the difficulty level of the questions",
-        ["Easy", "Medium", "Hard"]
+        DIFFICULTY_LEVELS
     )
 
     # ---------------- AI Client ----------------
     ai_client = OpenAIClient(
         model=chosen_model,
-        setup_instructions=SETUP_INSTRUCTIONS
+        setup_instructions=SETUP_INSTRUCTIONS,
+        course_name=course_name
     )
 
     # ---------------- Start Recap ----------------
     if not st.session_state.recap_in_progress:
         if st.button("Start Recap"):
+            # Course artifacts are built offline (python ingest.py), never on a student's request
+            missing_courses = [name for name in [course_name, *review_courses] if not course_assets_exist(name)]
+            if missing_courses:
+                st.error(f"The materials of {', '.join(missing_courses)} are not ready yet. "
+                         "Please try again later or contact your instructor.")
+                print(f"[WARNING] Missing artifacts for {missing_courses}, run `python ingest.py` to build them.")
+                return
+
             show_spinner()
             # Mark recap as started
             st.session_state.recap_in_progress = True
 
-            # 1. Load or process PDF -> chunks
-            if os.path.isfile(course_info.get("CHUNKS_JSON_PATH")):
-                chunks = load_chunks_from_json(course_info.get("CHUNKS_JSON_PATH"))
-            else:
-                chunks = process_pdf_for_rag(pdf_path=course_info.get("PDF_FILE_PATH"), chunk_size=1000)
-                save_chunks_to_json(chunks, course_info.get("CHUNKS_JSON_PATH"))
-
-            st.session_state.chunks = chunks
-            st.session_state.content = "\n".join(chunks)  # Combined text
-
-            # 2. Load or create embeddings + FAISS index
-            if os.path.isfile(course_info.get("EMBEDDINGS_NPY_PATH")) and os.path.isfile(course_info.get("FAISS_INDEX_PATH")):
-                embeddings = load_embeddings_from_npy(course_info.get("EMBEDDINGS_NPY_PATH"))
-                faiss_index = load_faiss_index(course_info.get("FAISS_INDEX_PATH"))
-            else:
-                embeddings = embed_chunks_openai(chunks, model="text-embedding-ada-002")
-                save_embeddings_to_npy(embeddings, course_info.get("EMBEDDINGS_NPY_PATH"))
-                faiss_index = create_faiss_index(embeddings)
-                save_faiss_index(faiss_index, course_info.get("FAISS_INDEX_PATH"))
-
-            st.session_state.embeddings = embeddings
-            st.session_state.faiss_index = faiss_index
+            # 1. Chunks, embeddings and index are shared by all sessions of this process
+            get_course_assets(course_name)
 
-            # 3. Generate first question
-            st.session_state.question = ai_client.question_generator(
-                st.session_state.content,
+            # 2. Generate first question from the retrieved context
+            question_stream = generate_question(
+                ai_client,
+                course_name,
                 question_type,
                 difficulty_level,
-                st.session_state.questions_asked,
+                st.session_state.question_history,
                 course_objectives,
                 selected_objectives,
+                review_courses=review_courses,
                 temperature=temperature,
                 max_tokens=max_tokens,
-                frequency_penalty=frequency_penalty
+                frequency_penalty=frequency_penalty,
+                stream=True
             )
             hide_spinner()
+            st.session_state.question, st.session_state.answer_key = show_question(question_stream)
+            st.session_state.question_objective = None
             st.session_state.questions_asked.append(st.session_state.question)
+            st.session_state.question_history.add(st.session_state.question)
             st.rerun()  # Refresh the UI to show the question
 
     # ---------------- Q&A Section (Recap In Progress) ----------------
@@ -156,6 +244,27 @@ def main():
         # Show the question
         st.write(st.session_state.question)
 
+        # Generate the next question in the background while the student answers
+        next_key = prefetch_key(
+            course_name, question_type, difficulty_level, selected_objectives, st.session_state.question_history, review_courses
+        )
+        if st.session_state.questions_answered + 1 < number_of_questions:
+            st.session_state.prefetcher.start(
+                next_key,
+                generate_question,
+                ai_client,
+                course_name,
+                question_type,
+                difficulty_level,
+                st.session_state.question_history.copy(),
+                course_objectives,
+                selected_objectives,
+                review_courses=review_courses,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                frequency_penalty=frequency_penalty
+            )
+
         # Answer input
         user_answer = st.text_area(
             "Provide your Answer here",
@@ -173,22 +282,50 @@ def main():
         )
         if submit_btn:
             st.session_state.user_answer = user_answer
-            feedback = ai_client.get_model_feedback(
-                st.session_state.question,
-                user_answer,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                frequency_penalty=frequency_penalty
-            )
+
+            # MCQ choices and code answers are graded locally with the answer key; answers in words go to the model
+            answer_key = st.session_state.get("answer_key")
+            try:
+                graded = answer_key.grade(user_answer) if answer_key is not None else None
+            except ValueError as error:
+                print(f"[WARNING] Could not grade the answer locally: {error}")
+                graded = None
+            if graded is not None:
+                correctness, feedback = graded
+                st.write("Feedback:")
+                st.write(feedback)
+                if isinstance(answer_key, CodeQuestion) and correctness == "student answered incorrectly":
+                    # Only the execution report is sent to the model, to explain it
+                    feedback += "\n\n" + st.write_stream(ai_client.explain_execution_result(
+                        st.session_state.question,
+                        user_answer,
+                        feedback,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        frequency_penalty=frequency_penalty,
+                        stream=True
+                    ))
+            else:
+                # Stream the feedback while it is generated
+                st.write("AI Feedback:")
+                feedback = st.write_stream(ai_client.get_model_feedback(
+                    answer_key.with_answer_key() if answer_key is not None else st.session_state.question,
+                    user_answer,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    frequency_penalty=frequency_penalty,
+                    stream=True
+                ))
+                correctness = check_answer(feedback)
             st.session_state.feedback = feedback
             st.session_state.questions_answered += 1
 
-            # Display feedback
-            st.write("AI Feedback:", feedback)
-
             # Record question & correctness
-            correctness = check_answer(feedback)
             st.session_state.received_feedback.append(correctness or "No definite correctness found")
+            st.session_state.objective_scores.record(
+                question_objective(course_name, selected_objectives or course_objectives, objective_keywords),
+                correctness
+            )
             if DEBUG:
                 st.write("DEBUG:", dict(zip(st.session_state.questions_asked, st.session_state.received_feedback)))
 
@@ -200,42 +337,68 @@ def main():
                 show_spinner()
                 if len(st.session_state.questions_asked) > len(st.session_state.received_feedback):
                     st.session_state.received_feedback.append("Student skipped this question")
+                    st.session_state.objective_scores.record(
+                        question_objective(course_name, selected_objectives or course_objectives, objective_keywords),
+                        "Student skipped this question"
+                    )
                 # Clear old question, but keep recap state
                 st.session_state.question = None
+                st.session_state.answer_key = None
                 st.session_state.feedback = None
                 st.session_state.user_answer = ""
 
-                # Generate the NEXT question
-                new_question = ai_client.question_generator(
-                    st.session_state.content,
-                    question_type,
-                    difficulty_level,
-                    st.session_state.questions_asked,
-                    course_objectives,
-                    selected_objectives,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    frequency_penalty=frequency_penalty
-                )
+                # Use the prefetched NEXT question, or generate it now if the settings changed
+                new_question, answer_key = st.session_state.prefetcher.take(next_key, timeout=PREFETCH_WAIT_SECONDS), None
+                if new_question is None:
+                    generation_args = (
+                        ai_client,
+                        course_name,
+                        question_type,
+                        difficulty_level,
+                        st.session_state.question_history,
+                        course_objectives,
+                        selected_objectives
+                    )
+                    generation_kwargs = dict(
+                        review_courses=review_courses, temperature=temperature, max_tokens=max_tokens, frequency_penalty=frequency_penalty
+                    )
+                    question_stream = generate_question(*generation_args, stream=True, **generation_kwargs)
+                    hide_spinner()
+                    new_question, answer_key = show_question(question_stream)
+                    # A streamed question can only be checked once it is complete
+                    if answer_key is None and st.session_state.question_history.is_repeat(new_question):
+                        new_question = generate_question(*generation_args, **generation_kwargs)
+                else:
+                    hide_spinner()
+                if isinstance(new_question, STRUCTURED_QUESTIONS):
+                    new_question, answer_key = str(new_question), new_question
                 st.session_state.question = new_question
+                st.session_state.answer_key = answer_key
+                st.session_state.question_objective = None
                 st.session_state.questions_asked.append(st.session_state.question)
-                st.write(st.session_state.question)
-                hide_spinner()
+                st.session_state.question_history.add(st.session_state.question)
                 st.rerun()
         else:
             # ---------------- Completion ----------------
             if 'feedback' in st.session_state:
-                completion_text = ai_client.completion_message(
-                    st.session_state.content,
-                    st.session_state.questions_asked,
-                    st.session_state.received_feedback,
-                    course_objectives,
-                    selected_objectives,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    frequency_penalty=frequency_penalty
-                )
-                st.success(completion_text)
+                with st.container(border=True):
+                    # The score table is computed locally; only the recommendations are generated
+                    objective_scores = st.session_state.objective_scores
+                    st.markdown(objective_scores.to_markdown(course_objectives))
+                    completion_text = st.write_stream(ai_client.completion_message(
+                        retrieve_content(
+                            [course_name, *review_courses],
+                            objective_scores.focus_objectives(selected_objectives or course_objectives),
+                            token_budget=SUMMARY_TOKEN_BUDGET
+                        ),
+                        objective_scores,
+                        course_objectives,
+                        selected_objectives,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        frequency_penalty=frequency_penalty,
+                        stream=True
+                    ))
                 if COMPLETION_CELEBRATION:
                     celebration()
 
@@ -246,17 +409,24 @@ def main():
 
         # ---------------- End Recap ----------------
         if st.button('End Recap'):
-            completion_text = ai_client.completion_message(
-                st.session_state.content,
-                st.session_state.questions_asked,
-                st.session_state.received_feedback,
-                course_objectives,
-                selected_objectives,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                frequency_penalty=frequency_penalty
-            )
-            st.success(completion_text)
+            with st.container(border=True):
+                # The score table is computed locally; only the recommendations are generated
+                objective_scores = st.session_state.objective_scores
+                st.markdown(objective_scores.to_markdown(course_objectives))
+                completion_text = st.write_stream(ai_client.completion_message(
+                    retrieve_content(
+                        [course_name, *review_courses],
+                        objective_scores.focus_objectives(selected_objectives or course_objectives),
+                        token_budget=SUMMARY_TOKEN_BUDGET
+                    ),
+                    objective_scores,
+                    course_objectives,
+                    selected_objectives,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    frequency_penalty=frequency_penalty,
+                    stream=True
+                ))
             if COMPLETION_CELEBRATION:
                 celebration()
 
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import METRICS_HOST, METRICS_MAX_MB, METRICS_PATH, METRICS_PORT, MODEL_PRICES
+
+###############################################################################
+#                       CALL SPANS, TOKENS AND COST
+###############################################################################
+
+# Span fields that become Prometheus labels. Other fields only go to the metrics file.
+LABEL_NAMES = ("kind", "model", "path", "course", "question_type")
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens=0):
+    """
+    Return the estimated cost of a call in USD from MODEL_PRICES, or None for unknown models.
+    """
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return (prompt_tokens * prices["prompt"] + completion_tokens * prices.get("completion", 0.0)) / 1_000_000
+
+
+def escape_label_value(value):
+    """
+    Escape a Prometheus label value.
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRecorder:
+    """
+    Records one span per LLM, embedding or search call.
+
+    Every span is appended as a JSON line to ``path`` (if set), which is rotated to
+    ``path + ".1"`` once it reaches ``max_mb``, and aggregated per label set (see LABEL_NAMES)
+    into request, error, token, cost and duration series, exported in the Prometheus text
+    format by ``render_prometheus``. The instance is safe to share between threads.
+    """
+    def __init__(self, path=None, max_mb=METRICS_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024) if max_mb else None
+        self._series = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def _rotate_if_full(self):
+        if self.max_bytes is None or self._file.tell() < self.max_bytes:
+            return
+        self._file.close()
+        os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+
+    def record(self, kind, model, duration, prompt_tokens=0, completion_tokens=0, error=None, **fields):
+        """
+        Record one call of ``duration`` seconds and return its span.
+
+        ``prompt_tokens``/``completion_tokens`` are the tokens billed for the call; extra
+        ``fields`` (path, course, question_type, counted_prompt_tokens, ...) are stored as-is.
+        """
+        span = {
+            "time": time.time(),
+            "kind": kind,
+            "model": model,
+            "duration_s": duration,
+            "prompt_tokens": prompt_tokens or 0,
+            "completion_tokens": completion_tokens or 0,
+            "cost_usd": estimate_cost(model, prompt_tokens or 0, completion_tokens or 0),
+            "error": error,
+            **fields,
+        }
+        labels = tuple(str(span.get(name) or "") for name in LABEL_NAMES)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {
+                    "requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                    "cost_usd": 0.0, "duration_sum": 0.0, "buckets": [0] * len(DURATION_BUCKETS),
+                }
+            series["requests"] += 1
+            series["errors"] += error is not None
+            series["prompt_tokens"] += span["prompt_tokens"]
+            series["completion_tokens"] += span["completion_tokens"]
+            series["cost_usd"] += span["cost_usd"] or 0.0
+            series["duration_sum"] += duration
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    series["buckets"][i] += 1
+            if self._file is not None:
+                self._file.write(json.dumps(span, ensure_ascii=False) + "\n")
+                self._rotate_if_full()
+        return span
+
+    def render_prometheus(self, prefix="recap"):
+        """
+        Return all series in the Prometheus text exposition format.
+        """
+        with self._lock:
+            series = {labels: dict(values, buckets=list(values["buckets"])) for labels, values in self._series.items()}
+
+        def label_text(labels, **extra):
+            pairs = list(zip(LABEL_NAMES, labels)) + list(extra.items())
+            return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+        lines = []
+        for name, key, help_text in (
+            ("calls_total", "requests", "Number of calls."),
+            ("call_errors_total", "errors", "Number of failed calls."),
+            ("prompt_tokens_total", "prompt_tokens", "Prompt (input) tokens billed."),
+            ("completion_tokens_total", "completion_tokens", "Completion (output) tokens billed."),
+            ("cost_usd_total", "cost_usd", "Estimated cost in USD."),
+        ):
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} counter"]
+            lines += [f"{prefix}_{name}{label_text(labels)} {values[key]}" for labels, values in series.items()]
+
+        lines += [f"# HELP {prefix}_call_duration_seconds Wall time of calls.",
+                  f"# TYPE {prefix}_call_duration_seconds histogram"]
+        for labels, values in series.items():
+            for bound, count in zip(DURATION_BUCKETS, values["buckets"]):
+                lines.append(f"{prefix}_call_duration_seconds_bucket{label_text(labels, le=str(bound))} {count}")
+            lines.append(f"{prefix}_call_duration_seconds_bucket{label_text(labels, le='+Inf')} {values['requests']}")
+            lines.append(f"{prefix}_call_duration_seconds_sum{label_text(labels)} {values['duration_sum']}")
+            lines.append(f"{prefix}_call_duration_seconds_count{label_text(labels)} {values['requests']}")
+        return "\n".join(lines) + "\n"
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Return the process-wide metrics recorder, writing spans to METRICS_PATH.
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = MetricsRecorder(METRICS_PATH)
+        return _recorder
+
+
+def record_span(kind, model, duration, **fields):
+    """
+    Record a call span with the process-wide recorder, see ``MetricsRecorder.record``.
+    """
+    return get_metrics().record(kind, model, duration, **fields)
+
+
+###############################################################################
+#                           PROMETHEUS ENDPOINT
+###############################################################################
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = get_metrics().render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Serve ``/metrics`` on ``port`` from a daemon thread, once per process.
+    Does nothing if the port is not set; warns once if it is already in use.
+    """
+    global _server
+    with _server_lock:
+        if _server is not None or not port:
+            return _server
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as error:
+            print(f"[WARNING] Could not start the metrics endpoint on port {port}: {error}")
+            _server = False
+            return None
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        print(f"[INFO] Prometheus metrics served on http://{host}:{port}/metrics")
+        return _server
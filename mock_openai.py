@@ -0,0 +1,316 @@
+"""
+Deterministic local stand-in for the OpenAI chat completions and embeddings endpoints.
+
+Usage:
+    python mock_openai.py [--port 8765] [--latency-ms 300] [--tokens-per-second 80] [--error-rate 0.0]
+
+Point the app at it (the OpenAI SDK reads both variables):
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=mock streamlit run main.py
+
+The same prompt always gets the same answer and the same text always gets the same
+embedding, so benchmark runs are comparable between commits.
+"""
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from pdf_rag import count_tokens
+
+FILLER_WORDS = (
+    "the", "value", "list", "loop", "function", "returns", "variable", "each", "item", "string",
+    "index", "result", "code", "line", "call", "input", "output", "python", "number", "check",
+)
+
+###############################################################################
+#                           DETERMINISTIC RESPONSES
+###############################################################################
+
+def mock_embedding(text, dim=1536):
+    """
+    Return a unit-length float32 vector derived from the hash of ``text``.
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def mock_structured_mcq(rng):
+    """
+    Return a canned MCQ as JSON in the structured_questions.MCQ_RESPONSE_FORMAT schema.
+    """
+    texts = ["It is immutable", "It keeps insertion order", "It cannot hold strings", "It has a fixed length"]
+    return json.dumps({
+        "stem": f"Which statement about list number {rng.randint(1, 10**6)} is true?",
+        "options": [
+            {"key": key, "text": text, "explanation": f"{rng.choice(FILLER_WORDS)} {rng.choice(FILLER_WORDS)}"}
+            for key, text in zip("ABCD", texts)
+        ],
+        "correct_key": "B",
+        "source_chunks": [1, 2],
+    })
+
+
+def mock_structured_code_question(rng):
+    """
+    Return a canned code question as JSON in the structured_questions.CODE_RESPONSE_FORMAT schema.
+    """
+    start = rng.randint(1, 1000)
+    return json.dumps({
+        "question": (
+            "Complete the function so that it returns the sum of the numbers, and print the result.\n"
+            f"```python\ndef total(numbers):\n    ...\n\nprint(total(range({start}, {start} + 3)))\n```"
+        ),
+        "answer_kind": "code",
+        "reference_code": f"def total(numbers):\n    return sum(numbers)\n\nprint(total(range({start}, {start} + 3)))\n",
+        "tests": "assert total([1, 2]) == 3\nassert total([]) == 0",
+        "source_chunks": [1],
+    })
+
+
+def mock_completion(prompt, max_tokens=150, completion_words=120, response_format=None):
+    """
+    Return a canned answer in the shape the app expects for the kind of ``prompt``
+    (question, feedback or summary), padded with filler words up to ``max_tokens``.
+    Requests with a JSON schema ``response_format`` get a structured question instead.
+    """
+    rng = random.Random(prompt)
+    if (response_format or {}).get("type") == "json_schema":
+        if response_format["json_schema"]["name"] == "code_question":
+            return mock_structured_code_question(rng)
+        return mock_structured_mcq(rng)
+    if "Student's Answer" in prompt:
+        head = "The answer provided is correct." if rng.random() < 0.6 else "The answer provided is incorrect."
+    elif "Multiple-Choice Question" in prompt:
+        head = (
+            f"Question: Which statement about list number {rng.randint(1, 10**6)} is true?\n\n"
+            "    A) It is immutable\n    B) It keeps insertion order\n"
+            "    C) It cannot hold strings\n    D) It has a fixed length"
+        )
+    elif "Code Tracing and Correction question" in prompt or "Code Completion question" in prompt:
+        head = (
+            "What does this code print, and how would you fix it if it should print the sum?\n"
+            f"```python\nx = {rng.randint(1, 1000)}\nfor i in range(3):\n    x = i\nprint(x)\n```"
+        )
+    else:
+        head = "Here is an analysis of your session."
+    words = max(0, min(completion_words, max_tokens - count_tokens(head) - 1))
+    return head + "\n\n" + " ".join(rng.choice(FILLER_WORDS) for _ in range(words))
+
+
+###############################################################################
+#                               MOCK SERVER
+###############################################################################
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        error_status = mock.draw_error()
+        if error_status is not None:
+            headers = {"retry-after-ms": "100"} if error_status == 429 else {}
+            self.send_json(error_status, {"error": {"message": "Injected mock error", "type": "mock_error"}}, headers)
+        elif self.path.endswith("/chat/completions"):
+            mock.chat_completion(self, body)
+        elif self.path.endswith("/embeddings"):
+            mock.embeddings(self, body)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_events(self, events):
+        """
+        Send server-sent events, closing the connection afterwards to mark the end of the body.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for event in events:
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class MockOpenAIServer:
+    """
+    Threaded HTTP server for ``/v1/chat/completions`` (plain and streamed) and ``/v1/embeddings``.
+
+    Chat responses start after ``latency_ms`` and then arrive at ``tokens_per_second``;
+    embedding responses take ``embedding_latency_ms``. A seeded ``error_rate`` fraction of
+    requests fails with alternating 429 and 500 errors. Served requests and tokens are
+    counted, see ``counters``.
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=300, tokens_per_second=80, completion_words=120,
+                 embedding_latency_ms=50, error_rate=0.0, embedding_dim=1536, seed=0):
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.completion_words = completion_words
+        self.embedding_latency_ms = embedding_latency_ms
+        self.error_rate = error_rate
+        self.embedding_dim = embedding_dim
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ("requests", "errors", "chat_requests", "embedding_requests",
+             "prompt_tokens", "completion_tokens", "embedding_tokens"),
+            0
+        )
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def start(self):
+        """
+        Serve on a daemon thread and return the server.
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def counters(self):
+        """
+        Return a snapshot of the request, error and token counters.
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._counters[name] += amount
+
+    def draw_error(self):
+        """
+        Return the status code of an injected error for the next request, or None.
+        """
+        with self._lock:
+            self._counters["requests"] += 1
+            if self._rng.random() >= self.error_rate:
+                return None
+            self._counters["errors"] += 1
+            return 429 if self._counters["errors"] % 2 else 500
+
+    def chat_completion(self, handler, body):
+        prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+        text = mock_completion(prompt, body.get("max_tokens") or 4096, self.completion_words, body.get("response_format"))
+        usage = {"prompt_tokens": count_tokens(prompt), "completion_tokens": count_tokens(text)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        self._count(chat_requests=1, prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
+        response_id, created, model = f"chatcmpl-mock-{hashlib.sha1(prompt.encode()).hexdigest()[:12]}", int(time.time()), body.get("model")
+
+        time.sleep(self.latency_ms / 1000)
+        if not body.get("stream"):
+            time.sleep(usage["completion_tokens"] / self.tokens_per_second)
+            handler.send_json(200, {
+                "id": response_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        def events():
+            for i, word in enumerate(text.split(" ")):
+                delta = word if i == 0 else " " + word
+                time.sleep(count_tokens(delta) / self.tokens_per_second)
+                yield {
+                    "id": response_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+                }
+            yield {
+                "id": response_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield {
+                    "id": response_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [], "usage": usage,
+                }
+        handler.send_events(events())
+
+    def embeddings(self, handler, body):
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        tokens = sum(count_tokens(text) for text in texts)
+        self._count(embedding_requests=1, embedding_tokens=tokens)
+        time.sleep(self.embedding_latency_ms / 1000)
+
+        data = []
+        for i, text in enumerate(texts):
+            vector = mock_embedding(text, self.embedding_dim)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        handler.send_json(200, {
+            "object": "list", "data": data, "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=80)
+    parser.add_argument("--completion-words", type=int, default=120)
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        tokens_per_second=args.tokens_per_second,
+        completion_words=args.completion_words,
+        embedding_latency_ms=args.embedding_latency_ms,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    print(f"[INFO] Mock OpenAI server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,147 +1,210 @@
-import os
-from dotenv import load_dotenv
-import openai
+import time
+import asyncio
 
-# 1. Load .env variables
-load_dotenv()  # This will read OPENAI_API_KEY from the .env file
+from metrics import record_span
+from openai_pool import get_async_client, get_client
+from pdf_rag import count_tokens
+from prompts import (
+    Prompt,
+    build_execution_feedback_prompt,
+    build_feedback_prompt,
+    build_question_prompt,
+    build_summary_prompt,
+    count_segment_tokens
+)
+from response_cache import get_response_cache
+from structured_questions import CODE_RESPONSE_FORMAT, MCQ_RESPONSE_FORMAT, CodeQuestion, MCQQuestion
 
 class OpenAIClient:
-    def __init__(self, model, setup_instructions):
+    def __init__(self, model, setup_instructions, course_name=None):
         """
         Initializes the OpenAIClient with a specified model and setup instructions.
-        """
-        load_dotenv(override=True)
-
-        # If you prefer setting the API key here directly from env:
-        # openai.api_key = os.getenv("OPENAI_API_KEY", "YOUR_DEFAULT_KEY")
 
+        Requests go through the process-wide clients of ``openai_pool``, so creating an
+        OpenAIClient on every Streamlit rerun is cheap. ``course_name`` labels the metrics
+        spans of its requests.
+        """
         self.model = model
         self.setup_instructions = setup_instructions
+        self.course_name = course_name
 
-    def get_response(self, prompt, temperature=0.7, max_tokens=150, frequency_penalty=0.0, **kwargs):
+    def get_response(self, prompt, temperature=0.7, max_tokens=150, frequency_penalty=0.0, stream=False,
+                     asynchronous=False, span_fields=None, response_format=None, **kwargs):
         """
         Generic chat completion request using OpenAI ChatCompletion.
+
+        With ``stream=True`` a generator of text deltas is returned instead of the full text,
+        ready to be passed to ``st.write_stream`` (which returns the collected text).
+        With ``asynchronous=True`` a coroutine returning the full text is returned instead,
+        to run many requests in parallel with ``openai_pool.gather``.
+
+        Every request is recorded as a metrics span with ``span_fields`` (path, question type, ...),
+        the prompt size counted before sending, the billed token usage and the wall time.
+        ``prompt`` may be a string or a ``prompts.Prompt``, whose segment sizes are recorded too.
+        ``response_format`` (e.g. a JSON schema) is passed on to the API as-is.
         """
         messages = [
             {"role": "system", "content": self.setup_instructions},
-            {"role": "user", "content": prompt}
+            {"role": "user", "content": str(prompt)}
         ]
-        response = openai.chat.completions.create(model=self.model,
+        request = dict(model=self.model,
         messages=messages,
         temperature=temperature,
         max_tokens=max_tokens,
         frequency_penalty=frequency_penalty)
+        if response_format is not None:
+            request["response_format"] = response_format
+        segment_tokens = {"system": count_segment_tokens(self.setup_instructions)}
+        if isinstance(prompt, Prompt):
+            segment_tokens.update(prompt.segment_tokens())
+        else:
+            segment_tokens["prompt"] = count_tokens(prompt)
+        span_fields = {
+            "course": self.course_name,
+            "counted_prompt_tokens": sum(segment_tokens.values()),
+            "prompt_segments": segment_tokens,
+            **(span_fields or {})
+        }
+        if asynchronous:
+            return self.aget_response(request, span_fields)
+
+        start = time.perf_counter()
+        try:
+            if stream:
+                response = get_client().chat.completions.create(stream=True, stream_options={"include_usage": True}, **request)
+            else:
+                response = get_client().chat.completions.create(**request)
+        except Exception as error:
+            self.record_chat_span(start, span_fields, error=error)
+            raise
+        if stream:
+            return self.iter_deltas(response, start, span_fields)
+        self.record_chat_span(start, span_fields, usage=response.usage)
         return response.choices[0].message.content
 
-    def generate_mcq_question(self, content, difficulty, questions_asked, course_objectives, selected_objectives, **kwargs):
-        """
-        Generate one MCQ question based on the given content and difficulty.
-        """
-        # Format objectives to show them clearly
-        objectives_list_str = "\n".join(f"• {obj}" for obj in course_objectives)
-        objectives_str = ", ".join(selected_objectives)
-        objective_focus_str = f"The student wants to focus on: {objectives_str}" if selected_objectives else "No specific objective chosen"
-
-        prompt = f"""
-        You are given a file filled with educational content. 
-        Here are the overall course objectives:
-        {objectives_list_str}
-        
-        {objective_focus_str}
-        
-        Your task is to generate one {difficulty} Multiple-Choice Question (MCQ).
-        It must be directly related to the content provided and not include information outside its scope. 
-        The primary objectives to focus on are: {objectives_str}. Ensure your question targets this objective specifically.
-        
-        Please follow this format:
-        
-        Question:
-        
-            A) Option A
-            B) Option B
-            C) Option C
-            D) Option D
-        
-        Here is the educational content:
-        
-        {content}
-        
-        Based on the content provided, generate an appropriate {difficulty} question without providing the solution.
-        
-        Do not repeat any of the following questions:
-        
-        {questions_asked}
-        """
-        return self.get_response(prompt, **kwargs)
+    async def aget_response(self, request, span_fields=None):
+        """
+        Send a chat completion request with the shared async client and return the text.
+        """
+        start = time.perf_counter()
+        try:
+            response = await get_async_client().chat.completions.create(**request)
+        except Exception as error:
+            self.record_chat_span(start, span_fields or {}, error=error)
+            raise
+        self.record_chat_span(start, span_fields or {}, usage=response.usage)
+        return response.choices[0].message.content
+
+    def iter_deltas(self, response, start=None, span_fields=None):
+        """
+        Yield the text deltas of a streamed chat completion.
+        When ``start`` is given, the span of the request is recorded once the stream ends.
+        """
+        usage, parts, first_token, error = None, [], None, None
+        try:
+            for event in response:
+                if getattr(event, "usage", None) is not None:
+                    usage = event.usage
+                if event.choices and event.choices[0].delta.content:
+                    if first_token is None and start is not None:
+                        first_token = time.perf_counter() - start
+                    parts.append(event.choices[0].delta.content)
+                    yield event.choices[0].delta.content
+        except Exception as stream_error:
+            error = stream_error
+            raise
+        finally:
+            if start is not None:
+                self.record_chat_span(start, span_fields or {}, usage=usage, error=error,
+                                      completion_text="".join(parts), first_token_s=first_token)
+
+    def record_chat_span(self, start, span_fields, usage=None, error=None, completion_text=None, **extra):
+        """
+        Record the metrics span of a chat request started at ``start`` (``time.perf_counter``).
+        Without a usage report from the API, tokens are counted locally.
+        """
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        elif error is None:
+            prompt_tokens = span_fields.get("counted_prompt_tokens", 0)
+            completion_tokens = count_tokens(completion_text or "")
+        else:
+            prompt_tokens, completion_tokens = 0, 0
+        record_span(
+            "chat",
+            self.model,
+            time.perf_counter() - start,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            error=type(error).__name__ if error is not None else None,
+            **span_fields,
+            **extra
+        )
+
+    def generate_question(self, question_type, content, difficulty, questions_asked, course_objectives, selected_objectives, **kwargs):
+        """
+        Generate one question of ``question_type`` from the shared prompt templates (see prompts.py).
+        """
+        prompt = build_question_prompt(question_type, content, difficulty, questions_asked, course_objectives, selected_objectives)
+        span_fields = {"path": "question", "question_type": question_type, "difficulty": difficulty}
+        return self.get_response(prompt, span_fields=span_fields, **kwargs)
+
+    def generate_mcq_question(self, content, difficulty, questions_asked, course_objectives, selected_objectives,
+                              chunk_ids=None, **kwargs):
+        """
+        Generate one MCQ question with its answer key, as a ``structured_questions.MCQQuestion``.
+
+        The model answers in the MCQ_RESPONSE_FORMAT JSON schema, so the response is parsed
+        whole and ``stream`` is ignored. ``content`` should be labeled (see prompts.label_chunks)
+        with ``chunk_ids`` the ids of its chunks, in order. Raises ValueError for an unusable
+        response; with ``asynchronous=True`` a coroutine is returned.
+        """
+        kwargs.pop("stream", None)
+        response = self.generate_question("Multiple-Choice Questions", content, difficulty, questions_asked,
+                                          course_objectives, selected_objectives,
+                                          response_format=MCQ_RESPONSE_FORMAT, **kwargs)
+        if not kwargs.get("asynchronous"):
+            return MCQQuestion.from_json(response, chunk_ids)
+
+        async def parse_response():
+            return MCQQuestion.from_json(await response, chunk_ids)
+        return parse_response()
+
+    def generate_code_question(self, question_type, content, difficulty, questions_asked, course_objectives,
+                               selected_objectives, chunk_ids=None, **kwargs):
+        """
+        Generate one code question with a runnable reference solution, as a
+        ``structured_questions.CodeQuestion`` whose reference has been run in the sandbox.
+
+        Like ``generate_mcq_question``: the response is parsed whole (``stream`` is ignored),
+        ValueError is raised for an unusable question (including a failing reference solution)
+        and with ``asynchronous=True`` a coroutine is returned.
+        """
+        kwargs.pop("stream", None)
+        response = self.generate_question(question_type, content, difficulty, questions_asked,
+                                          course_objectives, selected_objectives,
+                                          response_format=CODE_RESPONSE_FORMAT, **kwargs)
+        if not kwargs.get("asynchronous"):
+            return CodeQuestion.from_json(response, chunk_ids).check_reference()
+
+        async def parse_response():
+            question = CodeQuestion.from_json(await response, chunk_ids)
+            return await asyncio.to_thread(question.check_reference)
+        return parse_response()
 
     def generate_code_tracing_question(self, content, difficulty, questions_asked, course_objectives, selected_objectives, **kwargs):
         """
-        Generate one Code Tracing and Correction question.
-        """
-        objectives_list_str = "\n".join(f"• {obj}" for obj in course_objectives)
-        objectives_str = ", ".join(selected_objectives)
-        objective_focus_str = f"The student wants to focus on: {objectives_str}" if selected_objectives else "No specific objective chosen"
-
-        prompt = f"""
-        You are given a file filled with educational content.
-        Here are the overall course objectives:
-        {objectives_list_str}
-        
-        {objective_focus_str}
-        
-        Your task is to generate one {difficulty} Code Tracing and Correction question.
-        The question should be directly related to the content provided and not include information outside its scope.
-        The primary objectives to focus on are: {objectives_str}. Ensure your question targets this objective specifically.
-        
-        Provide a code snippet and ask the student to either identify an existing error or bug in the code, 
-        or identify the output and the purpose of the code snippet.
-        
-        Here is the educational content:
-        
-        {content}
-        
-        Based on the content provided, generate an appropriate {difficulty} question asking the student a single task 
-        without providing the solution.
-        
-        Do not repeat any of the following questions:
-        
-        {questions_asked}
-        """
-        return self.get_response(prompt, **kwargs)
+        Generate one Code Tracing and Correction question, see ``generate_code_question``.
+        """
+        return self.generate_code_question("Code Tracing and Correction", content, difficulty, questions_asked,
+                                           course_objectives, selected_objectives, **kwargs)
 
     def generate_code_completion_question(self, content, difficulty, questions_asked, course_objectives, selected_objectives, **kwargs):
         """
-        Generate one Code Completion question.
-        """
-        objectives_list_str = "\n".join(f"• {obj}" for obj in course_objectives)
-        objectives_str = ", ".join(selected_objectives)
-        objective_focus_str = f"The student wants to focus on: {objectives_str}" if selected_objectives else "No specific objective chosen"
-
-        prompt = f"""
-        You are given a file filled with educational content.
-        Here are the overall course objectives:
-        {objectives_list_str}
-        
-        {objective_focus_str}
-        
-        Your task is to generate one {difficulty} Code Completion question.
-        The question should be directly related to the content provided and not include information outside its scope.
-        The primary objectives to focus on are: {objectives_str}. Ensure your question targets this objective specifically.
-        
-        Provide a partial code snippet and ask the student to complete the missing parts or functionalities of the code.
-        
-        Here is the educational content:
-        
-        {content}
-        
-        Based on the content provided, generate an appropriate {difficulty} question 
-        asking the student to complete the code without providing the solution.
-        
-        Do not repeat any of the following questions:
-        
-        {questions_asked}
-        """
-        return self.get_response(prompt, **kwargs)
+        Generate one Code Completion question, see ``generate_code_question``.
+        """
+        return self.generate_code_question("Code Completion", content, difficulty, questions_asked,
+                                           course_objectives, selected_objectives, **kwargs)
 
     def question_generator(self, content, question_type, difficulty, questions_asked, course_objectives, selected_objectives, **kwargs):
         """
@@ -150,6 +213,9 @@ class OpenAIClient:
         Expecting potential extra kwargs:
           - course_objectives: (List[str])
           - selected_objectives: (str)
+          - stream: (bool) ignored, questions are generated as structured objects
+          - chunk_ids: (list) ids of the labeled content chunks, cited by the questions
+          - asynchronous: (bool) return a coroutine, see ``get_response``
         """
         if question_type == "Multiple-Choice Questions":
             return self.generate_mcq_question(content, difficulty, questions_asked,course_objectives, selected_objectives, **kwargs)
@@ -160,60 +226,43 @@ class OpenAIClient:
         else:
             raise ValueError("Unsupported question type")
 
-    def get_model_feedback(self, question, user_response, **kwargs):
+    def get_model_feedback(self, question, user_response, use_cache=True, **kwargs):
         """
         Generates feedback for a student's answer using ChatCompletion.
+
+        Feedback is cached per model, question and normalized answer, so repeated answers
+        (e.g. the same MCQ option) are answered without a model call.
         """
-        prompt = f"""You are a helpful teacher's assistant that provides feedback and corrections for student answers. 
-        Given a question and a student's answer, provide a concise explanation and correction if necessary. 
-        Ensure that your response is clear, easy to understand, and stays within the scope of the question.
-        
-        Question: {question}
-        Student's Answer: {user_response}
-        
-        Start your response by stating whether the answer provided is correct or incorrect, 
-        then follow up with feedback and corrections if necessary.
+        cache = get_response_cache() if use_cache and not kwargs.get("asynchronous") else None
+        if cache is not None:
+            cached = cache.get(self.model, question, user_response)
+            if cached is not None:
+                return iter([cached]) if kwargs.get("stream") else cached
+
+        prompt = build_feedback_prompt(question, user_response)
+        response = self.get_response(prompt, span_fields={"path": "feedback"}, **kwargs)
+        if cache is None:
+            return response
+        if kwargs.get("stream"):
+            return cache.wrap_stream(self.model, question, user_response, response)
+        cache.put(self.model, question, user_response, response)
+        return response
+
+    def explain_execution_result(self, question, user_response, report, **kwargs):
         """
-        return self.get_response(prompt, **kwargs)
+        Explain why a code answer graded by running it (see structured_questions.CodeQuestion)
+        is wrong. Only the question, the answer and the execution report are sent.
+        """
+        prompt = build_execution_feedback_prompt(question, user_response, report)
+        return self.get_response(prompt, span_fields={"path": "execution_feedback"}, **kwargs)
 
-    def completion_message(self, content, questions, feedback, course_objectives, selected_objectives, **kwargs):
+    def completion_message(self, content, objective_scores, course_objectives, selected_objectives, **kwargs):
         """
         Provides a final summary/analysis of the student's performance.
+
+        Only the per-objective score record (see session_summary.ObjectiveScores) and the given
+        course content are sent, so the prompt has the same size whatever the session length.
         """
-        student_progress = str(dict(zip(questions, feedback)))
-
-        prompt = f"""Based on the questions asked to the student and the feedback received on their solutions, 
-        please provide a detailed analysis of the student's skills concerning the content provided. 
-        Your response should be addressed to the student and highlight both areas of strength and areas needing improvement 
-        to enhance their learning progress.
-        
-        Here is the educational content:
-        {content}
-        
-        These are the course’s learning objectives:
-        {', '.join(course_objectives)}
-        
-        The student specifically chose to focus on:
-        {', '.join(selected_objectives)}
-        
-        Below are the questions asked and the feedback received:
-        {student_progress}
-        
-        Please address the following:
-        
-        1. Overall Objectives:
-           • For each of the listed objectives above, note if the student practiced it in this session or not.
-           • If an objective wasn’t tested in any question, mention that it remains unassessed.
-        
-        2. Performance Analysis:
-           • Strengths: Summarize the key strengths observed in the student's answers.
-           • Improvements: Identify any areas needing clarification or correction. 
-           • Specific Focus: Discuss the student's performance on their chosen objective(s): “{', '.join(selected_objectives)}.”
-        
-        3. Recommendations:
-           • Provide actionable next steps for the student to improve their understanding and skills, 
-             especially regarding their chosen objective(s).
-        
-        Your response should be addressed to the student
-        """
-        return self.get_response(prompt, **kwargs)
\ No newline at end of file
+        student_progress = objective_scores.to_prompt(course_objectives)
+        prompt = build_summary_prompt(content, student_progress, course_objectives, selected_objectives)
+        return self.get_response(prompt, span_fields={"path": "summary"}, **kwargs)
\ No newline at end of file
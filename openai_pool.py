@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import openai
+from dotenv import load_dotenv
+
+from config import (
+    OPENAI_CONNECT_TIMEOUT_SECONDS,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_MAX_RETRIES,
+    OPENAI_TIMEOUT_SECONDS
+)
+
+# Read OPENAI_API_KEY from the .env file once per process.
+load_dotenv()
+
+###############################################################################
+#                       SHARED OPENAI CLIENTS
+###############################################################################
+
+_lock = threading.Lock()
+_client = None
+_loop = None
+_async_client = None
+_semaphore = None
+
+
+def _client_options():
+    return {
+        "timeout": openai.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+        "max_retries": OPENAI_MAX_RETRIES,
+    }
+
+
+def get_client():
+    """
+    Return the process-wide synchronous OpenAI client.
+
+    It keeps one pool of keep-alive connections for every module, thread and Streamlit
+    session, with the timeouts and retries configured in ``config.py``.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = openai.OpenAI(**_client_options())
+        return _client
+
+
+def _get_loop():
+    """
+    Return the event loop that runs all async requests, started on a daemon thread on first use.
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openai-async", daemon=True).start()
+        return _loop
+
+
+def get_async_client():
+    """
+    Return the process-wide AsyncOpenAI client. Only use it in coroutines run through
+    ``submit``, ``run`` or ``gather``, since its connection pool belongs to the shared loop.
+    """
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            _async_client = openai.AsyncOpenAI(**_client_options())
+        return _async_client
+
+
+async def _limited(coroutine):
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    async with _semaphore:
+        return await coroutine
+
+
+def submit(coroutine):
+    """
+    Schedule a coroutine on the shared loop and return a ``concurrent.futures.Future``.
+    At most OPENAI_MAX_CONCURRENCY submitted coroutines run at the same time.
+    """
+    return asyncio.run_coroutine_threadsafe(_limited(coroutine), _get_loop())
+
+
+def run(coroutine, timeout=None):
+    """
+    Run a coroutine on the shared loop and wait for its result.
+    """
+    return submit(coroutine).result(timeout=timeout)
+
+
+def gather(coroutines, return_exceptions=False, timeout=None):
+    """
+    Run coroutines concurrently on the shared loop and return their results in order.
+
+    With ``return_exceptions=True`` a failed coroutine yields its exception instead of
+    raising it. Must not be called from the shared loop itself.
+    """
+    futures = [submit(coroutine) for coroutine in coroutines]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result(timeout=timeout))
+        except Exception as error:
+            if not return_exceptions:
+                for pending in futures:
+                    pending.cancel()
+                raise
+            results.append(error)
+    return results
@@ -1,11 +1,19 @@
 import os
 import re
 import json
+import time
+import hashlib
+import functools
+import collections
+import concurrent.futures
 import PyPDF2
 import faiss
-from openai import OpenAI
+from embedding_cache import get_embedding_cache
+from embedding_engine import EMBEDDING_BATCH_TOKENS, embed_texts
+from lexical_index import reciprocal_rank_fusion
+from metrics import record_span
+from openai_pool import get_client
 
-client = OpenAI()
 import numpy as np
 import pytesseract
 import tiktoken
@@ -16,55 +24,291 @@ from PIL import Image
 #                           PDF CHUNKING FUNCTIONS
 ###############################################################################
 
-def tokenize_and_chunk(text, chunk_size=500, model="cl100k_base"):
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="cl100k_base"):
     """
-    Tokenize and split text into chunks based on the token limit, avoiding sentence splitting.
+    Return the tiktoken encoding for ``model``, loading it only once per process.
+    """
+    return tiktoken.get_encoding(model)
+
+
+def count_tokens(text, model="cl100k_base"):
     """
-    encoding = tiktoken.get_encoding(model)
-    sentences = re.split(r"(?<=[.!?])\s+", text.strip())
-    chunks = []
-    current_chunk = ""
+    Count the tokens of ``text`` with the given tiktoken encoding.
+    """
+    return len(get_encoding(model).encode(text))
+
+
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[.!?])\s+")
+# Numbered heading lines such as "3.2 For- und While-Schleifen", used as section provenance.
+SECTION_HEADING_PATTERN = re.compile(r"^[ \t]*(\d+(?:\.\d+)*\.?[ \t]+[^\W\d][^\n]{0,80}?)[ \t]*$", re.MULTILINE)
+
 
-    for sentence in sentences:
-        current_chunk_tokens = len(encoding.encode(current_chunk))
+def _iter_pages(pages):
+    """
+    Normalize an iterable of page texts or (page_number, text) pairs to (page_number, text).
+    """
+    for page_number, page in enumerate(pages, start=1):
+        if isinstance(page, tuple):
+            yield page
+        else:
+            yield page_number, page
+
+
+def iter_sentences(pages, section_pattern=SECTION_HEADING_PATTERN):
+    """
+    Stream (sentence, page_number, section) triples from an iterable of page texts.
+
+    Pages are joined with newlines exactly like a combined text would be, so sentences that
+    run across a page break stay whole; they are attributed to the page they start on.
+    Only the sentence still in progress is buffered between pages.
+    """
+    pending = ""
+    pending_page = None
+    pending_section = None
+    section = None
+    started = False
+
+    for page_number, text in _iter_pages(pages):
+        headings = [(m.start(), m.group(1)) for m in section_pattern.finditer(text)] if section_pattern else []
+
+        if not started or not pending:
+            # Whitespace after the text start or after a sentence boundary is swallowed by the split.
+            stripped = text.lstrip()
+            if not stripped:
+                section = headings[-1][1] if headings else section
+                continue
+            buffer, base = stripped, len(stripped) - len(text)
+            started = True
+        else:
+            buffer, base = f"{pending}\n{text}", len(pending) + 1
+
+        starts = [0] + [m.end() for m in SENTENCE_SPLIT_PATTERN.finditer(buffer)]
+        ends = [m.start() for m in SENTENCE_SPLIT_PATTERN.finditer(buffer)] + [len(buffer)]
+        heading_iter = iter(headings)
+        next_heading = next(heading_iter, None)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            if pending and start < base:
+                sentence_page, sentence_section = pending_page, pending_section
+            else:
+                while next_heading is not None and next_heading[0] + base <= start:
+                    section = next_heading[1]
+                    next_heading = next(heading_iter, None)
+                sentence_page, sentence_section = page_number, section
+            if i < len(starts) - 1:
+                yield buffer[start:end], sentence_page, sentence_section
+            else:
+                pending, pending_page, pending_section = buffer[start:end], sentence_page, sentence_section
+        for _, heading in ([next_heading] if next_heading else []) + list(heading_iter):
+            section = heading
+
+    pending = pending.rstrip()
+    if pending:
+        yield pending, pending_page, pending_section
+
+
+def iter_chunks(pages, chunk_size=500, overlap=0, model="cl100k_base", section_pattern=SECTION_HEADING_PATTERN):
+    """
+    Stream token-limited chunks with page and section provenance from an iterable of page texts.
+
+    Each sentence is encoded once on its own and, when it is appended to a chunk, once with its
+    joining space, so the running token count is exact and chunking stays linear in the text size.
+    With ``overlap`` > 0 every new chunk starts with the trailing sentences of the previous chunk
+    that fit in ``overlap`` tokens. With ``overlap`` = 0 the chunk texts match ``tokenize_and_chunk``.
+
+    Yields dicts with ``text``, ``page_start``, ``page_end`` and ``section`` keys.
+    """
+    encoding = get_encoding(model)
+    # (sentence, tokens as first sentence, tokens when appended, page, section)
+    current = []
+    current_tokens = 0
+
+    def make_chunk(sentences):
+        return {
+            "text": " ".join(entry[0] for entry in sentences).strip(),
+            "page_start": sentences[0][3],
+            "page_end": sentences[-1][3],
+            "section": sentences[0][4],
+        }
+
+    for sentence, page_number, section in iter_sentences(pages, section_pattern):
         sentence_tokens = len(encoding.encode(sentence))
 
-        if current_chunk_tokens + sentence_tokens > chunk_size:
-            if current_chunk.strip():
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence
+        if current_tokens + sentence_tokens > chunk_size:
+            if any(entry[0].strip() for entry in current):
+                yield make_chunk(current)
+            carried = []
+            carried_tokens = 0
+            for entry in reversed(current if overlap > 0 else []):
+                if carried_tokens + entry[2] > overlap or carried_tokens + entry[2] + sentence_tokens > chunk_size:
+                    break
+                carried.insert(0, entry)
+                carried_tokens += entry[2]
+            current = carried
+            current_tokens = carried_tokens
+            if current:
+                # The first carried sentence no longer has a joining space in front of it.
+                current_tokens += current[0][1] - current[0][2]
+
+        if current:
+            joined_tokens = len(encoding.encode(" " + sentence))
+            current.append((sentence, sentence_tokens, joined_tokens, page_number, section))
+            current_tokens += joined_tokens
         else:
-            current_chunk += (" " + sentence if current_chunk else sentence)
+            current.append((sentence, sentence_tokens, sentence_tokens, page_number, section))
+            current_tokens = sentence_tokens
 
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
+    if current and any(entry[0].strip() for entry in current):
+        yield make_chunk(current)
 
-    return chunks
+
+def tokenize_and_chunk(text, chunk_size=500, model="cl100k_base"):
+    """
+    Tokenize and split text into chunks based on the token limit, avoiding sentence splitting.
+    """
+    return [chunk["text"] for chunk in iter_chunks([text], chunk_size=chunk_size, model=model, section_pattern=None)]
+
+
+def text_layer_is_sufficient(text, min_chars=200, min_letter_ratio=0.5):
+    """
+    Decide whether a page's PyPDF2 text layer is good enough to skip OCR.
+
+    The text must have at least ``min_chars`` non-whitespace characters, and at least
+    ``min_letter_ratio`` of them must be letters or digits (garbled layers are mostly symbols).
+    """
+    visible = "".join(text.split())
+    if len(visible) < min_chars:
+        return False
+    letters = sum(char.isalnum() for char in visible)
+    return letters / len(visible) >= min_letter_ratio
 
 
-def process_pdf_for_rag(pdf_path, ocr_language="eng", poppler_path=None, chunk_size=500):
+def ocr_pdf_page(pdf_path, page_number, ocr_language="eng", poppler_path=None, dpi=200):
+    """
+    Render a single PDF page and OCR it. Runs in a worker process, so the rendered
+    image never leaves the worker.
+    """
+    images = convert_from_path(
+        pdf_path,
+        dpi=dpi,
+        first_page=page_number,
+        last_page=page_number,
+        poppler_path=poppler_path
+    )
+    return "\n".join(pytesseract.image_to_string(image, lang=ocr_language) for image in images)
+
+
+def pdf_page_hash(page):
+    """
+    Hash a PyPDF2 page by its content stream and embedded XObjects (images, forms),
+    so edits to either text or images change the hash.
+    """
+    digest = hashlib.sha256()
+    contents = page.get_contents()
+    if contents is not None:
+        digest.update(contents.get_data())
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources is not None else None
+    if xobjects is not None:
+        xobjects = xobjects.get_object()
+        for name in sorted(xobjects):
+            digest.update(name.encode("utf-8"))
+            digest.update(xobjects[name].get_object().get_data())
+    return digest.hexdigest()
+
+
+def _page_record(page_number, page_hash, raw_text, ocr_future):
+    if ocr_future is None:
+        return page_number, page_hash, raw_text
+    parts = [raw_text] if raw_text else []
+    ocr_text = ocr_future.result()
+    if ocr_text.strip():
+        parts.append(f"[Image {page_number} OCR]\n{ocr_text}")
+    return page_number, page_hash, "\n".join(parts)
+
+
+def iter_pdf_page_records(pdf_path, ocr_language="eng", poppler_path=None, ocr_workers=None,
+                          ocr_batch_size=None, min_text_chars=200, dpi=200, known_page_texts=None):
+    """
+    Stream (page_number, page_hash, text) for every page of a PDF in page order.
+
+    Pages whose hash is in ``known_page_texts`` reuse the stored text. Pages whose text layer
+    is sufficient are used as is; the others are rendered and OCRed in a process pool.
+    At most ``ocr_batch_size`` pages are in flight at once, so memory stays flat regardless
+    of the page count.
+    """
+    known_page_texts = known_page_texts or {}
+    ocr_workers = ocr_workers or os.cpu_count() or 1
+    ocr_batch_size = ocr_batch_size or 2 * ocr_workers
+    executor = None
+    window = collections.deque()
+    ocr_pages = 0
+
+    try:
+        with open(pdf_path, 'rb') as file:
+            reader = PyPDF2.PdfReader(file)
+            for page_number, page in enumerate(reader.pages, start=1):
+                page_hash = pdf_page_hash(page)
+                ocr_future = None
+                if page_hash in known_page_texts:
+                    raw_text = known_page_texts[page_hash]
+                else:
+                    raw_text = page.extract_text() or ""
+                    if not text_layer_is_sufficient(raw_text, min_text_chars):
+                        if executor is None:
+                            executor = concurrent.futures.ProcessPoolExecutor(max_workers=ocr_workers)
+                        ocr_future = executor.submit(ocr_pdf_page, pdf_path, page_number, ocr_language, poppler_path, dpi)
+                        ocr_pages += 1
+                window.append((page_number, page_hash, raw_text, ocr_future))
+
+                # Emit finished pages in order; block on the oldest page once the window is full.
+                while window and (len(window) >= ocr_batch_size or window[0][3] is None or window[0][3].done()):
+                    yield _page_record(*window.popleft())
+
+        while window:
+            yield _page_record(*window.popleft())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    print(f"[INFO] OCR was needed for {ocr_pages} pages of {pdf_path}.")
+
+
+def iter_pdf_pages(pdf_path, ocr_language="eng", poppler_path=None, ocr_workers=None,
+                   ocr_batch_size=None, min_text_chars=200, dpi=200):
+    """
+    Stream (page_number, text) pairs of a PDF in page order, skipping pages without text.
+    See ``iter_pdf_page_records`` for the OCR behaviour.
+    """
+    records = iter_pdf_page_records(
+        pdf_path,
+        ocr_language=ocr_language,
+        poppler_path=poppler_path,
+        ocr_workers=ocr_workers,
+        ocr_batch_size=ocr_batch_size,
+        min_text_chars=min_text_chars,
+        dpi=dpi
+    )
+    for page_number, _, text in records:
+        if text.strip():
+            yield page_number, text
+
+
+def process_pdf_for_rag(pdf_path, ocr_language="eng", poppler_path=None, chunk_size=500,
+                        ocr_workers=None, ocr_batch_size=None, min_text_chars=200):
     """
     Process a PDF for RAG by extracting text, images (OCR), and then chunking.
+
+    Pages are streamed from ``iter_pdf_pages`` straight into the chunker.
     """
-    extracted_text_list = []
-    with open(pdf_path, 'rb') as file:
-        reader = PyPDF2.PdfReader(file)
-        for page_idx, page in enumerate(reader.pages, start=1):
-            raw_text = page.extract_text()
-            if raw_text:
-                extracted_text_list.append(raw_text)
-
-    # Convert PDF pages to images for OCR
-    images = convert_from_path(pdf_path, poppler_path=poppler_path)
-    for i, image in enumerate(images, start=1):
-        ocr_text = pytesseract.image_to_string(image, lang=ocr_language)
-        if ocr_text.strip():
-            extracted_text_list.append(f"[Image {i} OCR]\n{ocr_text}")
-
-    combined_text = "\n".join(extracted_text_list)
-
-    # Tokenize/Chunk
-    chunks = tokenize_and_chunk(combined_text, chunk_size=chunk_size)
+    pages = iter_pdf_pages(
+        pdf_path,
+        ocr_language=ocr_language,
+        poppler_path=poppler_path,
+        ocr_workers=ocr_workers,
+        ocr_batch_size=ocr_batch_size,
+        min_text_chars=min_text_chars
+    )
+    chunks = [chunk["text"] for chunk in iter_chunks(pages, chunk_size=chunk_size)]
     print(f"[INFO] Processed PDF -> {len(chunks)} total chunks.")
     return chunks
 
@@ -73,32 +317,181 @@ def process_pdf_for_rag(pdf_path, ocr_language="eng", poppler_path=None, chunk_s
 #                       OPENAI EMBEDDING + FAISS FUNCTIONS
 ###############################################################################
 
-def embed_chunks_openai(chunks, model="text-embedding-ada-002", batch_size=20):
+def embed_chunks_openai(chunks, model="text-embedding-ada-002", max_batch_tokens=EMBEDDING_BATCH_TOKENS, use_cache=True):
     """
     Embed a list of text chunks using OpenAI embeddings.
+
+    Chunks already in the embedding cache are not sent to the API again. The others are
+    embedded by the rate-limited, concurrent batch engine in token-sized batches.
     """
-    print(f"[INFO] Embedding {len(chunks)} chunks with OpenAI model '{model}'...")
-    embeddings = []
-    for i in range(0, len(chunks), batch_size):
-        batch = chunks[i : i + batch_size]
-        response = client.embeddings.create(input=batch, model=model)
-        for r in response.data:
-            embeddings.append(r["embedding"])
-    embeddings = np.array(embeddings, dtype=np.float32)
+    if not chunks:
+        return np.empty((0, 0), dtype=np.float32)
+    cache = get_embedding_cache() if use_cache else None
+    cached = cache.get_many(chunks, model) if cache is not None else [None] * len(chunks)
+    missing_ids = [i for i, vector in enumerate(cached) if vector is None]
+    missing = [chunks[i] for i in missing_ids]
+
+    print(f"[INFO] Embedding {len(missing)} of {len(chunks)} chunks with OpenAI model '{model}'...")
+    if missing:
+        encoding = get_encoding("cl100k_base")
+        token_counts = [len(tokens) for tokens in encoding.encode_ordinary_batch(missing)]
+        start = time.perf_counter()
+        new_embeddings = embed_texts(get_client().with_options(max_retries=0), missing, token_counts, model=model, max_batch_tokens=max_batch_tokens)
+        record_span("embedding", model, time.perf_counter() - start, prompt_tokens=sum(token_counts),
+                    path="embed_chunks", texts=len(missing), cached=len(chunks) - len(missing))
+        if cache is not None:
+            cache.put_many(missing, model, new_embeddings)
+
+    dim = len(cached[0]) if not missing else new_embeddings.shape[1]
+    embeddings = np.empty((len(chunks), dim), dtype=np.float32)
+    for i, vector in enumerate(cached):
+        if vector is not None:
+            embeddings[i] = vector
+    if missing:
+        embeddings[missing_ids] = new_embeddings
     print(f"[INFO] Finished embedding. Shape: {embeddings.shape}")
     return embeddings
 
 
-def create_faiss_index(embeddings):
-    embedding_dim = embeddings.shape[1]
-    index = faiss.IndexFlatL2(embedding_dim)
-    index.add(embeddings)
-    print(f"[INFO] FAISS index created with {index.ntotal} vectors.")
+def embed_queries(queries, model="text-embedding-ada-002", client_options=None):
+    """
+    Embed search queries as a (len(queries), dim) float32 array, using the embedding cache.
+    All cache misses are sent in a single request; ``client_options`` (e.g. a shorter
+    ``timeout`` and ``max_retries``) override the shared client's settings for it.
+    """
+    cache = get_embedding_cache()
+    vectors = cache.get_many(queries, model) if cache is not None else [None] * len(queries)
+    missing_ids = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing_ids:
+        missing = [queries[i] for i in missing_ids]
+        start = time.perf_counter()
+        try:
+            client = get_client().with_options(**client_options) if client_options else get_client()
+            query_resp = client.embeddings.create(input=missing, model=model)
+        except Exception as error:
+            record_span("embedding", model, time.perf_counter() - start, error=type(error).__name__, path="embed_queries")
+            raise
+        record_span("embedding", model, time.perf_counter() - start, prompt_tokens=query_resp.usage.prompt_tokens,
+                    path="embed_queries", texts=len(missing), cached=len(queries) - len(missing))
+        new_vectors = [item.embedding for item in sorted(query_resp.data, key=lambda item: item.index)]
+        if cache is not None:
+            cache.put_many(missing, model, new_vectors)
+        for i, vector in zip(missing_ids, new_vectors):
+            vectors[i] = vector
+    return np.array(vectors, dtype=np.float32).reshape(len(queries), -1)
+
+
+# Index configuration used when a course does not define "INDEX" in config.py.
+DEFAULT_INDEX_CONFIG = {"type": "flat", "metric": "l2"}
+
+# IVF-PQ needs enough vectors to train its coarse quantizer and 2**nbits PQ centroids.
+MIN_TRAINING_POINTS_PER_CENTROID = 39
+
+
+def l2_normalize(vectors):
+    """
+    Return a float32 copy of ``vectors`` with every row scaled to unit length.
+    """
+    vectors = np.array(vectors, dtype=np.float32, copy=True).reshape(-1, np.shape(vectors)[-1])
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def prepare_vectors(index, vectors):
+    """
+    Prepare database or query vectors for ``index``: inner-product (cosine) indexes
+    expect unit-length vectors, L2 indexes take them as they are.
+    """
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return l2_normalize(vectors)
+    return np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, np.shape(vectors)[-1])
+
+
+def similarity_scores(index, distances):
+    """
+    Convert FAISS distances to scores where higher means more similar, whatever the metric.
+    """
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return distances
+    return -distances
+
+
+def configure_faiss_search(index, index_config=None):
+    """
+    Apply the search-time trade-offs of ``index_config`` to a built or loaded index:
+    ``nprobe`` (IVF lists visited per query) and ``ef_search`` (HNSW candidate list size).
+    Higher values raise recall and latency.
+    """
+    index_config = index_config or {}
+    if "nprobe" in index_config:
+        try:
+            faiss.extract_index_ivf(index).nprobe = index_config["nprobe"]
+        except RuntimeError:
+            pass
+    if "ef_search" in index_config and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = index_config["ef_search"]
     return index
 
 
+def create_faiss_index(embeddings, index_config=None):
+    """
+    Build a FAISS index over ``embeddings`` as described by ``index_config``:
+
+    - ``type``: "flat" (exact), "ivfpq" (inverted lists + product quantization) or "hnsw" (graph)
+    - ``metric``: "cosine" (L2-normalized vectors, inner product) or "l2"
+    - ivfpq: ``nlist``, ``m`` (sub-quantizers, must divide the dimension), ``nbits``,
+      ``train_size`` (sample used for training) and ``nprobe``
+    - hnsw: ``M``, ``ef_construction`` and ``ef_search``
+
+    IVF-PQ falls back to a flat index when there are too few vectors to train it.
+    """
+    index_config = {**DEFAULT_INDEX_CONFIG, **(index_config or {})}
+    index_type = index_config["type"]
+    metric = faiss.METRIC_INNER_PRODUCT if index_config["metric"] == "cosine" else faiss.METRIC_L2
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    num_vectors, embedding_dim = embeddings.shape
+
+    if index_type == "ivfpq":
+        nlist = index_config.get("nlist", max(1, int(np.sqrt(num_vectors))))
+        nbits = index_config.get("nbits", 8)
+        min_points = MIN_TRAINING_POINTS_PER_CENTROID * max(nlist, 2 ** nbits)
+        if num_vectors < min_points:
+            print(f"[WARNING] IVF-PQ needs at least {min_points} vectors, got {num_vectors}. Using a flat index.")
+            index_type = "flat"
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(embedding_dim) if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(embedding_dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(embedding_dim, index_config.get("M", 32), metric)
+        index.hnsw.efConstruction = index_config.get("ef_construction", 200)
+    elif index_type == "ivfpq":
+        quantizer = faiss.IndexFlatIP(embedding_dim) if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(embedding_dim)
+        index = faiss.IndexIVFPQ(quantizer, embedding_dim, nlist, index_config.get("m", 64), nbits, metric)
+    else:
+        raise ValueError(f"Unsupported index type: {index_type}")
+
+    vectors = prepare_vectors(index, embeddings)
+    if not index.is_trained:
+        train_size = min(num_vectors, index_config.get("train_size", 256 * nlist))
+        sample = np.random.default_rng(0).choice(num_vectors, size=train_size, replace=False)
+        index.train(vectors[np.sort(sample)])
+    index.add(vectors)
+    configure_faiss_search(index, index_config)
+    print(f"[INFO] FAISS {index_type} index created with {index.ntotal} vectors.")
+    return index
+
+
+def add_to_faiss_index(index, embeddings):
+    """
+    Append vectors to an index, normalizing them first for cosine indexes.
+    """
+    index.add(prepare_vectors(index, embeddings))
+
+
 def save_faiss_index(index, index_path):
-    faiss.write_index(index, index_path)
+    tmp_path = f"{index_path}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, index_path)
     print(f"[INFO] FAISS index saved to {index_path}")
 
 
@@ -111,24 +504,57 @@ def load_faiss_index(index_path):
 
 
 def save_embeddings_to_npy(embeddings, npy_path):
-    np.save(npy_path, embeddings)
+    tmp_path = f"{npy_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, embeddings)
+    os.replace(tmp_path, npy_path)
     print(f"[INFO] Embeddings saved to {npy_path}")
 
 
-def load_embeddings_from_npy(npy_path):
+def load_embeddings_from_npy(npy_path, mmap_mode=None):
     if not os.path.isfile(npy_path):
         raise FileNotFoundError(f"{npy_path} not found.")
-    embeddings = np.load(npy_path)
+    embeddings = np.load(npy_path, mmap_mode=mmap_mode)
     print(f"[INFO] Loaded embeddings from {npy_path}, shape: {embeddings.shape}")
     return embeddings
 
 
 def save_chunks_to_json(chunks, json_path):
-    with open(json_path, "w", encoding="utf-8") as f:
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(chunks, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, json_path)
     print(f"[INFO] Chunks saved to {json_path}")
 
 
+def verify_artifacts(chunks, embeddings, index, check_values=True, sample_size=8):
+    """
+    Check that chunks, embeddings and FAISS index describe the same rows, and with
+    ``check_values`` that all embeddings are finite (reads the whole matrix) and that
+    searching ``sample_size`` stored embeddings finds their own row, so index ids still
+    point at the right chunks. Raises ValueError listing every problem found.
+    """
+    problems = []
+    if not len(chunks):
+        problems.append("there are no chunks")
+    if np.ndim(embeddings) != 2 or len(embeddings) != len(chunks):
+        problems.append(f"{len(chunks)} chunks but embeddings of shape {np.shape(embeddings)}")
+    elif index.d != embeddings.shape[1]:
+        problems.append(f"index dimension {index.d} does not match embedding dimension {embeddings.shape[1]}")
+    if index.ntotal != len(chunks):
+        problems.append(f"{len(chunks)} chunks but {index.ntotal} index vectors")
+    if check_values and np.ndim(embeddings) == 2 and not np.isfinite(embeddings).all():
+        problems.append("embeddings contain NaN or infinite values")
+    if check_values and not problems:
+        rows = np.unique(np.linspace(0, len(chunks) - 1, min(sample_size, len(chunks))).astype(np.int64))
+        _, found = index.search(prepare_vectors(index, embeddings[rows]), min(10, index.ntotal))
+        misplaced = [int(row) for row, ids in zip(rows, found) if row not in ids]
+        if misplaced:
+            problems.append(f"searching the embeddings of rows {misplaced} does not find those rows in the index")
+    if problems:
+        raise ValueError("Inconsistent course artifacts: " + "; ".join(problems))
+
+
 def load_chunks_from_json(json_path):
     if not os.path.isfile(json_path):
         print(f"[WARNING] {json_path} not found. Returning empty list.")
@@ -139,14 +565,325 @@ def load_chunks_from_json(json_path):
     return chunks
 
 
-def search_faiss_index(query, index, chunks, embeddings, top_k=3, model="text-embedding-ada-002"):
-    query_resp = client.embeddings.create(input=[query], model=model)
-    query_embedding = np.array(query_resp.data[0].embedding, dtype=np.float32).reshape(1, -1)
+def merge_search_results(indices, scores):
+    """
+    Merge the (queries, k) result matrices of a multi-query search into unique chunk ids,
+    keeping each chunk's best score. Returns (chunk_id, score) pairs, best first.
+    """
+    ids = indices.ravel()
+    scores = scores.ravel()
+    valid = ids >= 0
+    ids, scores = ids[valid], scores[valid]
+    order = np.lexsort((-scores, ids))  # by id, best score first within an id
+    ids, scores = ids[order], scores[order]
+    first = np.ones(len(ids), dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    ids, scores = ids[first], scores[first]
+    ranking = np.argsort(-scores, kind="stable")
+    return [(int(idx), float(score)) for idx, score in zip(ids[ranking], scores[ranking])]
+
+
+def rerank_with_embeddings(query_vectors, indices, embeddings, top_k):
+    """
+    Re-score the candidate chunks of every query by exact cosine similarity against the
+    embeddings matrix and keep the best ``top_k`` per query. Only candidate rows are read,
+    so a memory-mapped matrix is never loaded in full.
+    """
+    queries = l2_normalize(query_vectors)
+    safe_indices = np.where(indices >= 0, indices, 0)
+    candidates = l2_normalize(np.asarray(embeddings[np.unique(safe_indices)], dtype=np.float32))
+    rows = np.searchsorted(np.unique(safe_indices), safe_indices)
+    scores = np.einsum("qd,qkd->qk", queries, candidates[rows])
+    scores[indices < 0] = -np.inf
+    best = np.argsort(-scores, axis=1)[:, :top_k]
+    return np.take_along_axis(indices, best, axis=1), np.take_along_axis(scores, best, axis=1)
+
+
+def search_many(queries, index, embeddings=None, top_k=3, model="text-embedding-ada-002", rerank=False, rerank_factor=4,
+                client_options=None):
+    """
+    Search the index for several queries at once.
+
+    All queries are embedded in one request and searched with one ``index.search`` call over
+    the query matrix. With ``rerank`` and an ``embeddings`` matrix, ``rerank_factor * top_k``
+    candidates per query are re-scored by exact cosine similarity, which recovers the recall
+    lost by approximate (IVF-PQ/HNSW) indexes. Returns de-duplicated (chunk_id, score) pairs,
+    each chunk with its best score over all queries, most similar first.
+    """
+    if not queries or index.ntotal == 0:
+        return []
+    start = time.perf_counter()
+    rerank = rerank and embeddings is not None
+    query_vectors = embed_queries(queries, model=model, client_options=client_options)
+    depth = min(top_k * rerank_factor if rerank else top_k, index.ntotal)
+
+    distances, indices = index.search(prepare_vectors(index, query_vectors), depth)
+    if rerank:
+        indices, scores = rerank_with_embeddings(query_vectors, indices, embeddings, top_k)
+    else:
+        scores = similarity_scores(index, distances)
+    results = merge_search_results(indices, scores)
+    record_span("search", type(index).__name__, time.perf_counter() - start,
+                path="search", queries=len(queries), top_k=top_k, rerank=rerank)
+    return results
+
+
+def search_faiss_index(query, index, chunks, embeddings=None, top_k=3, model="text-embedding-ada-002"):
+    """
+    Search the index for one query and return (chunk_text, score) pairs, most similar first.
+    When ``embeddings`` is given the candidates are re-ranked by exact cosine similarity.
+    """
+    results = search_many([query], index, embeddings=embeddings, top_k=top_k, model=model, rerank=embeddings is not None)
+    return [(chunks[idx], score) for idx, score in results]
+
+###############################################################################
+#                       RETRIEVAL CONTEXT FUNCTIONS
+###############################################################################
+
+# Extra search terms that steer retrieval towards chunks suited to a question type/difficulty.
+QUESTION_TYPE_QUERY_HINTS = {
+    "Multiple-Choice Questions": "key concepts, definitions and rules",
+    "Code Tracing and Correction": "code examples, program output and common errors",
+    "Code Completion": "code examples, syntax and typical usage",
+}
+
+DIFFICULTY_QUERY_HINTS = {
+    "Easy": "basic introduction",
+    "Medium": "",
+    "Hard": "advanced details and edge cases",
+}
+
+
+def build_retrieval_queries(objectives, question_type=None, difficulty=None):
+    """
+    Build one search query per objective, enriched with question type and difficulty hints.
+    """
+    hints = " ".join(
+        hint for hint in (
+            QUESTION_TYPE_QUERY_HINTS.get(question_type, ""),
+            DIFFICULTY_QUERY_HINTS.get(difficulty, ""),
+        ) if hint
+    )
+    if not objectives:
+        return [hints] if hints else []
+    return [f"{objective}: {hints}" if hints else objective for objective in objectives]
+
+
+def build_lexical_queries(objectives, objective_keywords=None):
+    """
+    Build one lexical (BM25) query per objective: the objective and its course keywords.
+    The English question type and difficulty hints are left out, they only add noise there.
+    """
+    objective_keywords = objective_keywords or {}
+    return [f"{objective} {objective_keywords.get(objective, '')}".strip() for objective in objectives or []]
+
 
-    distances, indices = index.search(query_embedding, top_k)
-    results = []
-    for i, idx in enumerate(indices[0]):
-        dist = distances[0][i]
-        chunk_text = chunks[idx]
-        results.append((chunk_text, dist))
-    return results
\ No newline at end of file
+def select_chunks(chunks, ranked_ids, token_budget, encoding_name="cl100k_base"):
+    """
+    Greedily select ranked chunk ids whose chunks fit together under ``token_budget`` tokens.
+
+    Chunks that do not fit are skipped so smaller, lower-ranked chunks can still be used.
+    The selected ids are returned in index order, which is document order for a full build;
+    chunks added by an incremental re-ingestion (see ingest_pdf_incremental) come last.
+    """
+    selected = []
+    used_tokens = 0
+    for idx in ranked_ids:
+        chunk_tokens = count_tokens(chunks[idx], encoding_name) + 1  # +1 for the joining newline
+        if used_tokens + chunk_tokens > token_budget:
+            continue
+        selected.append(idx)
+        used_tokens += chunk_tokens
+    return sorted(selected)
+
+
+def select_context_chunks(index, chunks, objectives, question_type=None, difficulty=None,
+                          top_k=6, token_budget=3000, model="text-embedding-ada-002",
+                          encoding_name="cl100k_base", embeddings=None, rerank=False,
+                          lexical_index=None, objective_keywords=None, mode="vector", rrf_k=60,
+                          client_options=None):
+    """
+    Select the ids of the chunks most relevant to the objectives, question type and
+    difficulty that fit under ``token_budget`` tokens, in index order (see select_chunks).
+
+    ``mode`` "vector" ranks the chunks with the FAISS index, "lexical" with ``lexical_index``
+    (a lexical_index.LexicalIndex, no embedding request) and "hybrid" fuses both rankings
+    by reciprocal-rank fusion.
+    """
+    queries = build_retrieval_queries(objectives, question_type, difficulty)
+    if not queries:
+        return select_chunks(chunks, range(len(chunks)), token_budget, encoding_name)
+
+    rankings = []
+    if mode != "lexical":
+        results = search_many(queries, index, embeddings=embeddings, top_k=top_k, model=model, rerank=rerank,
+                              client_options=client_options)
+        rankings.append([idx for idx, _ in results])
+    if mode != "vector" and lexical_index is not None:
+        lexical_queries = build_lexical_queries(objectives, objective_keywords) or queries
+        rankings.append([idx for idx, _ in lexical_index.search_many(lexical_queries, top_k=top_k)])
+    if len(rankings) > 1:
+        ranked_ids = [idx for idx, _ in reciprocal_rank_fusion(rankings, rrf_k)]
+    else:
+        ranked_ids = rankings[0] if rankings and rankings[0] else range(len(chunks))
+    return select_chunks(chunks, ranked_ids, token_budget, encoding_name)
+
+
+###############################################################################
+#                       INCREMENTAL RE-INGESTION FUNCTIONS
+###############################################################################
+
+MANIFEST_VERSION = 1
+
+
+def text_hash(text):
+    """
+    Return the SHA-256 hex digest of a text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Return the SHA-256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_manifest(manifest, manifest_path):
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+    print(f"[INFO] Ingestion manifest saved to {manifest_path}")
+
+
+def load_manifest(manifest_path):
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        print(f"[WARNING] {manifest_path} has an unsupported version, ignoring it.")
+        return None
+    return manifest
+
+
+def manifest_is_current(pdf_path, manifest_path):
+    """
+    Check whether the manifest was built from the PDF as it is on disk now.
+    """
+    manifest = load_manifest(manifest_path)
+    return manifest is not None and manifest.get("pdf_hash") == file_hash(pdf_path)
+
+
+def ingest_pdf_incremental(pdf_path, chunks_json_path, embeddings_npy_path, faiss_index_path, manifest_path,
+                           chunk_size=500, model="text-embedding-ada-002", index_config=None, rebuild=False,
+                           **pdf_kwargs):
+    """
+    Bring the course artifacts up to date with the PDF, redoing only the work for changed pages.
+
+    The manifest stores the hash and text of every page and the hash of every chunk, in index
+    order, together with the embedding model. Unchanged pages reuse their stored text (no OCR),
+    all pages are re-chunked (cheap and local), and only chunks whose hash is new are embedded.
+    The FAISS index and embeddings are patched in place: rows of vanished chunks are removed and
+    new rows are appended, so new chunks are no longer in document order (a full rebuild restores it). Without a manifest, existing artifacts are reused by chunk hash.
+    The index is rebuilt from the embeddings instead when ``index_config`` changed or when
+    rows must be removed from any index but a flat one: only a flat index renumbers the rows
+    after a removal (IVF-PQ keeps the old ids, HNSW does not support removals).
+
+    With ``rebuild`` the manifest and existing artifacts are ignored: every page is extracted
+    again and all artifacts are built from scratch, in document order (chunk embeddings still
+    come from the embedding cache).
+    """
+    index_config = {**DEFAULT_INDEX_CONFIG, **(index_config or {})}
+    manifest = None if rebuild else load_manifest(manifest_path)
+    if manifest is not None and (manifest.get("embedding_model") != model or manifest.get("chunk_size") != chunk_size):
+        print("[INFO] Embedding model or chunk size changed, rebuilding all chunks.")
+        manifest = None
+
+    known_page_texts = {page["hash"]: page["text"] for page in manifest["pages"]} if manifest else {}
+    old_chunks, old_embeddings, index = [], None, None
+    artifacts_exist = all(os.path.isfile(path) for path in (chunks_json_path, embeddings_npy_path, faiss_index_path))
+    if not rebuild and artifacts_exist and (manifest is not None or not os.path.isfile(manifest_path)):
+        old_chunks = load_chunks_from_json(chunks_json_path)
+        old_embeddings = load_embeddings_from_npy(embeddings_npy_path)
+        index = load_faiss_index(faiss_index_path)
+
+    # 1. Pages: reuse stored text for unchanged pages, extract/OCR the rest
+    pages = []
+    changed_pages = 0
+    for page_number, page_hash, text in iter_pdf_page_records(pdf_path, known_page_texts=known_page_texts, **pdf_kwargs):
+        changed_pages += page_hash not in known_page_texts
+        pages.append({"page": page_number, "hash": page_hash, "text": text})
+
+    # 2. Chunks: re-chunk everything and match them to existing index rows by hash
+    new_chunks = list(iter_chunks(((page["page"], page["text"]) for page in pages if page["text"].strip()), chunk_size=chunk_size))
+    rows_by_hash = collections.defaultdict(collections.deque)
+    for row, chunk in enumerate(old_chunks):
+        rows_by_hash[text_hash(chunk)].append(row)
+
+    kept_rows, added = set(), []
+    for chunk in new_chunks:
+        chunk["hash"] = text_hash(chunk["text"])
+        if rows_by_hash[chunk["hash"]]:
+            kept_rows.add(rows_by_hash[chunk["hash"]].popleft())
+        else:
+            added.append(chunk)
+    removed_rows = [row for row in range(len(old_chunks)) if row not in kept_rows]
+    if not new_chunks:
+        raise ValueError(f"No text could be extracted from {pdf_path}.")
+
+    # 3. Patch embeddings and index: drop vanished rows, append the new ones
+    chunk_records = {chunk["hash"]: chunk for chunk in new_chunks}
+    chunks = [chunk for row, chunk in enumerate(old_chunks) if row in kept_rows]
+    embeddings = old_embeddings[sorted(kept_rows)] if old_embeddings is not None else None
+    if added:
+        added_embeddings = embed_chunks_openai([chunk["text"] for chunk in added], model=model)
+        chunks.extend(chunk["text"] for chunk in added)
+        embeddings = added_embeddings if embeddings is None else np.vstack([embeddings, added_embeddings])
+
+    can_patch_index = (
+        index is not None
+        and manifest is not None
+        and manifest.get("index_config") == index_config
+        and not (removed_rows and not isinstance(index, faiss.IndexFlat))
+    )
+    if can_patch_index:
+        if removed_rows:
+            index.remove_ids(np.array(removed_rows, dtype=np.int64))
+        if added:
+            add_to_faiss_index(index, added_embeddings)
+    else:
+        index = create_faiss_index(embeddings, index_config)
+
+    # Every file is replaced atomically, and only once the new set is consistent
+    verify_artifacts(chunks, embeddings, index)
+    save_chunks_to_json(chunks, chunks_json_path)
+    save_embeddings_to_npy(embeddings, embeddings_npy_path)
+    save_faiss_index(index, faiss_index_path)
+    save_manifest({
+        "version": MANIFEST_VERSION,
+        "pdf_hash": file_hash(pdf_path),
+        "embedding_model": model,
+        "chunk_size": chunk_size,
+        "index_config": index_config,
+        "pages": pages,
+        "chunks": [
+            {key: chunk_records[text_hash(chunk)][key] for key in ("hash", "page_start", "page_end", "section")}
+            for chunk in chunks
+        ],
+    }, manifest_path)
+
+    stats = {
+        "changed_pages": changed_pages,
+        "added_chunks": len(added),
+        "removed_chunks": len(removed_rows),
+        "total_chunks": len(chunks),
+    }
+    print(f"[INFO] Incremental ingestion finished: {stats}")
+    return stats
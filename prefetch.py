@@ -0,0 +1,71 @@
+import concurrent.futures
+
+from config import PREFETCH_WORKERS
+
+###############################################################################
+#                       BACKGROUND QUESTION PREFETCHING
+###############################################################################
+
+# Shared by all sessions of the process, so the number of concurrent prefetches stays bounded.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+
+class QuestionPrefetcher:
+    """
+    Generates the next question of one session on a worker thread while the student answers.
+
+    Every prefetch is tagged with a key describing the inputs it was started with (question
+    type, difficulty, objectives, questions asked so far). A prefetch is only handed out for
+    the same key; starting one with a different key cancels the previous one.
+    The generate function runs outside the Streamlit script, so it must not touch
+    ``st.session_state``; pass it plain values instead.
+    """
+    def __init__(self):
+        self._key = None
+        self._future = None
+
+    def start(self, key, generate, *args, **kwargs):
+        """
+        Start generating in the background, unless a prefetch for ``key`` already exists.
+        """
+        if self._future is not None and self._key == key:
+            return
+        self.cancel()
+        self._key = key
+        self._future = _executor.submit(generate, *args, **kwargs)
+
+    def cancel(self):
+        """
+        Drop the current prefetch. A generation that already started finishes on its own,
+        but its result is discarded.
+        """
+        if self._future is not None:
+            self._future.cancel()
+        self._key = None
+        self._future = None
+
+    def take(self, key, timeout=None):
+        """
+        Return the prefetched question for ``key``, waiting up to ``timeout`` seconds if it is
+        being generated. Returns None if there is no prefetch for ``key``, if it is still queued
+        behind other sessions' prefetches (it is cancelled; generating inline is faster), or if
+        it failed or timed out, so the caller generates the question itself.
+        """
+        future, future_key = self._future, self._key
+        self._key = None
+        self._future = None
+        if future is None or future_key != key:
+            if future is not None:
+                future.cancel()
+            return None
+        if not future.done() and not future.running() and future.cancel():
+            print("[INFO] Question prefetch had not started yet, generating inline.")
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            print(f"[WARNING] Question prefetch did not finish within {timeout}s, generating inline.")
+            return None
+        except Exception as error:
+            print(f"[WARNING] Question prefetch failed: {error}")
+            return None
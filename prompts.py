@@ -0,0 +1,272 @@
+import string
+import textwrap
+import functools
+
+from pdf_rag import count_tokens
+
+###############################################################################
+#                           PROMPT ASSEMBLY
+###############################################################################
+
+@functools.lru_cache(maxsize=4096)
+def count_segment_tokens(text):
+    """
+    Count the tokens of a prompt segment. Segments repeat across requests (instructions,
+    objectives, course content), so the counts are cached.
+    """
+    return count_tokens(text)
+
+
+class Prompt:
+    """
+    A rendered prompt: its named segments in order, joined by blank lines.
+    """
+    def __init__(self, segments):
+        self.segments = segments
+        self.text = "\n\n".join(text for _, text in segments if text)
+
+    def __str__(self):
+        return self.text
+
+    def segment_tokens(self):
+        """
+        Return the token size of every segment, by segment name.
+        """
+        return {name: count_segment_tokens(text) for name, text in self.segments}
+
+
+class PromptTemplate:
+    """
+    Prompt made of named segments, compiled once: every segment is dedented and parsed into
+    literal text and fields when the template is created, so rendering only joins strings.
+
+    Segments are rendered in the given order. Put the segments shared by many requests
+    (instructions, course objectives, course content) first and the per-student ones last,
+    so the provider can reuse its cache of the prompt prefix.
+    """
+    def __init__(self, *segments):
+        self.segments = [(name, self._compile(template)) for name, template in segments]
+
+    @staticmethod
+    def _compile(template):
+        return [
+            (literal, field)
+            for literal, field, _, _ in string.Formatter().parse(textwrap.dedent(template).strip())
+        ]
+
+    def render(self, **values):
+        return Prompt([
+            (name, "".join(literal + (str(values[field]) if field is not None else "") for literal, field in parts))
+            for name, parts in self.segments
+        ])
+
+
+###############################################################################
+#                               TEMPLATES
+###############################################################################
+
+QUESTION_INSTRUCTIONS = """
+    You are given a file filled with educational content.
+    Generate exactly one question that is directly related to the content provided and does not
+    include information outside its scope. Never provide the solution.
+"""
+
+COURSE_OBJECTIVES = """
+    Here are the overall course objectives:
+    {course_objectives}
+"""
+
+COURSE_CONTENT = """
+    Here is the educational content:
+
+    {content}
+"""
+
+QUESTION_HISTORY = """
+    Do not repeat any of the following questions:
+
+    {questions_asked}
+"""
+
+QUESTION_TASKS = {
+    "Multiple-Choice Questions": """
+        Your task is to generate one {difficulty} Multiple-Choice Question (MCQ).
+        {objective_focus}
+        Ensure your question targets the chosen objectives specifically.
+
+        Answer with the question as a JSON object:
+        - stem: the question itself, without the options or the solution
+        - options: the four options A, B, C and D, each with its text and a short explanation
+          of why it is right or wrong
+        - correct_key: the key of the single correct option
+        - source_chunks: the [n] labels of the content parts the question is based on
+
+        Based on the content provided, generate an appropriate {difficulty} question. Only the
+        correct_key and the explanations may reveal the solution; they are never shown before the student answers.
+    """,
+    "Code Tracing and Correction": """
+        Your task is to generate one {difficulty} Code Tracing and Correction question.
+        {objective_focus}
+        Ensure your question targets the chosen objectives specifically.
+
+        Provide a code snippet and ask the student to either predict the exact output of the code,
+        or correct an existing error or bug in the code and answer with the complete corrected code.
+
+        Answer with the question as a JSON object:
+        - question: the task and the code snippet (in a ```python block) shown to the student
+        - answer_kind: "output" if the student predicts the output, "code" if they correct the code
+        - reference_code: a complete, runnable program: the snippet itself for "output", the corrected code for "code"
+        - tests: for "code", assert statements checking the corrected program (may be empty); "" for "output"
+        - source_chunks: the [n] labels of the content parts the question is based on
+        {code_rules}
+
+        Based on the content provided, generate an appropriate {difficulty} question asking the student a single task.
+        Only reference_code and tests may reveal the solution; they are never shown to the student.
+    """,
+    "Code Completion": """
+        Your task is to generate one {difficulty} Code Completion question.
+        {objective_focus}
+        Ensure your question targets the chosen objectives specifically.
+
+        Provide a partial code snippet and ask the student to complete the missing parts or functionalities
+        of the code, answering with the complete code.
+
+        Answer with the question as a JSON object:
+        - question: the task and the partial code snippet (in a ```python block) shown to the student
+        - answer_kind: "code"
+        - reference_code: the completed, runnable program
+        - tests: assert statements checking the completed program, e.g. by calling its functions
+        - source_chunks: the [n] labels of the content parts the question is based on
+        {code_rules}
+
+        Based on the content provided, generate an appropriate {difficulty} question
+        asking the student to complete the code. Only reference_code and tests may reveal the solution;
+        they are never shown to the student.
+    """,
+}
+
+# Reference solutions are run in a sandbox (see code_sandbox.py) to grade the answers.
+CODE_RULES = """
+        The program must be self-contained and deterministic: only the standard library, no input(),
+        files, network or randomness, and it must print its results.
+"""
+
+QUESTION_PROMPTS = {
+    question_type: PromptTemplate(
+        ("instructions", QUESTION_INSTRUCTIONS),
+        ("objectives", COURSE_OBJECTIVES),
+        ("content", COURSE_CONTENT),
+        ("task", task),
+        ("history", QUESTION_HISTORY),
+    )
+    for question_type, task in QUESTION_TASKS.items()
+}
+
+FEEDBACK_PROMPT = PromptTemplate(
+    ("instructions", """
+        You are a helpful teacher's assistant that provides feedback and corrections for student answers.
+        Given a question and a student's answer, provide a concise explanation and correction if necessary.
+        Ensure that your response is clear, easy to understand, and stays within the scope of the question.
+        Start your response by stating whether the answer provided is correct or incorrect,
+        then follow up with feedback and corrections if necessary.
+    """),
+    ("question", """
+        Question: {question}
+    """),
+    ("answer", """
+        Student's Answer: {user_response}
+    """),
+)
+
+EXECUTION_FEEDBACK_PROMPT = PromptTemplate(
+    ("instructions", """
+        You are a helpful teacher's assistant. A student's answer to a programming question was
+        checked by running it, and it is incorrect. Based only on the execution report below,
+        explain briefly what went wrong and give a hint on how to fix it, without repeating the report.
+    """),
+    ("question", """
+        Question: {question}
+    """),
+    ("answer", """
+        Student's Answer: {user_response}
+    """),
+    ("report", """
+        Execution report:
+        {report}
+    """),
+)
+
+SUMMARY_PROMPT = PromptTemplate(
+    ("instructions", """
+        You are given the score record of a student's recap session, per learning objective,
+        together with the course content of the objectives that need the most work.
+        Write a short summary addressed to the student:
+
+        1. Strengths: name the objectives they handled well.
+        2. Improvements: name the objectives needing work and the concepts of the content behind them.
+        3. Unassessed: list the objectives not practiced in this session, if any.
+        4. Recommendations: give two or three actionable next steps, especially for their chosen objective(s).
+
+        Base your analysis on the score record only and keep it concise.
+    """),
+    ("objectives", COURSE_OBJECTIVES),
+    ("content", COURSE_CONTENT),
+    ("progress", """
+        The student specifically chose to focus on:
+        {selected_objectives}
+
+        Score record of the session:
+        {student_progress}
+    """),
+)
+
+
+def label_chunks(chunks):
+    """
+    Join context chunks, each prefixed with its [n] label (from 1), so that structured
+    answers can cite the chunks they are based on.
+    """
+    return "\n".join(f"[{label}] {chunk}" for label, chunk in enumerate(chunks, start=1))
+
+
+def format_objectives(objectives):
+    return "\n".join(f"• {objective}" for objective in objectives)
+
+
+def build_question_prompt(question_type, content, difficulty, questions_asked, course_objectives, selected_objectives):
+    """
+    Render the question prompt of a question type. Only the task and history segments
+    depend on the student; everything before them is shared within a course.
+    """
+    if question_type not in QUESTION_PROMPTS:
+        raise ValueError("Unsupported question type")
+    objectives_str = ", ".join(selected_objectives or [])
+    return QUESTION_PROMPTS[question_type].render(
+        course_objectives=format_objectives(course_objectives),
+        content=content,
+        difficulty=difficulty,
+        objective_focus=f"The student wants to focus on: {objectives_str}." if objectives_str else "No specific objective chosen.",
+        questions_asked="\n".join(f"- {question}" for question in questions_asked) or "(none yet)",
+        code_rules=textwrap.dedent(CODE_RULES).strip(),
+    )
+
+
+def build_feedback_prompt(question, user_response):
+    return FEEDBACK_PROMPT.render(question=question, user_response=user_response)
+
+
+def build_execution_feedback_prompt(question, user_response, report):
+    return EXECUTION_FEEDBACK_PROMPT.render(question=question, user_response=user_response, report=report)
+
+
+def build_summary_prompt(content, student_progress, course_objectives, selected_objectives):
+    """
+    Render the summary prompt. ``student_progress`` is the aggregated score record of the
+    session (see session_summary.ObjectiveScores.to_prompt), not the full questions and feedback.
+    """
+    return SUMMARY_PROMPT.render(
+        course_objectives=format_objectives(course_objectives),
+        content=content,
+        selected_objectives=", ".join(selected_objectives or []) or "No specific objective chosen",
+        student_progress=student_progress,
+    )
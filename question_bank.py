@@ -0,0 +1,286 @@
+"""
+Offline question bank: pre-generated, validated questions per (objective, question type, difficulty).
+
+Build the bank of a course (or of all courses) before exam-prep peaks:
+    python question_bank.py ["<course name>"] [--per-combination 10]
+
+Sessions draw from the bank first and only generate live questions when it runs out.
+"""
+import os
+import re
+import gzip
+import json
+import random
+import argparse
+import threading
+import collections
+
+from config import (
+    AI_MODELS,
+    COURSES,
+    DIFFICULTY_LEVELS,
+    QUESTION_BANK_MODEL,
+    QUESTION_TYPES,
+    SETUP_INSTRUCTIONS
+)
+from course_assets import get_course_assets, select_course_chunks
+from openai_client import OpenAIClient
+from openai_pool import gather
+from pdf_rag import text_hash
+from prompts import label_chunks
+from question_history import QuestionHistory
+from structured_questions import STRUCTURED_QUESTIONS
+
+###############################################################################
+#                               VALIDATION
+###############################################################################
+
+MCQ_OPTION_PATTERN = re.compile(r"^\s*([A-D])\)", re.MULTILINE)
+CODE_PATTERN = re.compile(r"```|^\s*(def|class|for|while|if|print|return|import|try|with)\b|^\s*\w+\s*=", re.MULTILINE)
+SOLUTION_PATTERN = re.compile(r"^\s*(correct answer|answer|solution|lösung|richtige antwort)\s*:", re.IGNORECASE | re.MULTILINE)
+
+
+def validate_question(question, question_type, min_length=40, max_length=4000):
+    """
+    Return the reason a generated question is unusable, or None if it is valid.
+    """
+    if not question or not min_length <= len(question.strip()) <= max_length:
+        return "empty or unusual length"
+    if SOLUTION_PATTERN.search(question):
+        return "contains the solution"
+    if question_type == "Multiple-Choice Questions":
+        if set(MCQ_OPTION_PATTERN.findall(question)) != {"A", "B", "C", "D"}:
+            return "options A) to D) missing"
+    elif not CODE_PATTERN.search(question):
+        return "no code snippet"
+    return None
+
+
+###############################################################################
+#                               STORAGE
+###############################################################################
+
+class QuestionBank:
+    """
+    Read-only set of bank entries, indexed by (objective, question type, difficulty).
+
+    Entries are dicts with ``objective``, ``question_type``, ``difficulty``, ``question``
+    and ``chunk_hashes`` (content hashes of the course chunks the question was generated
+    from, which survive re-ingestion unlike row numbers). Structured questions also have an
+    ``answer_key``, see structured_questions.question_from_dict. ``resolve_chunk_ids`` adds
+    the current ``chunk_ids``.
+    """
+    def __init__(self, entries=()):
+        self._entries = collections.defaultdict(list)
+        self._objectives = {}
+        for entry in entries:
+            self._entries[(entry["objective"], entry["question_type"], entry["difficulty"])].append(entry)
+            self._objectives[entry["question"]] = entry["objective"]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def draw(self, objectives, question_type, difficulty, exclude=()):
+        """
+        Return a random entry for one of the objectives whose question is not in ``exclude``
+        (a set of questions or a ``QuestionHistory``), or None when the bank has run out.
+        """
+        candidates = [
+            entry
+            for objective in objectives
+            for entry in self._entries.get((objective, question_type, difficulty), ())
+            if entry["question"] not in exclude
+        ]
+        return random.choice(candidates) if candidates else None
+
+    def objective_of(self, question):
+        """
+        Return the objective a bank question was generated for, or None for other questions.
+        """
+        return self._objectives.get(question)
+
+
+def save_question_bank(entries, bank_path):
+    """
+    Write bank entries as gzip-compressed JSON lines, replacing the file atomically.
+    """
+    tmp_path = f"{bank_path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+    os.replace(tmp_path, bank_path)
+    print(f"[INFO] Question bank with {len(entries)} questions saved to {bank_path}")
+
+
+def resolve_chunk_ids(entries, chunks):
+    """
+    Return the entries whose chunks are all still part of the course, with ``chunk_ids`` (and
+    the answer key's ``source_chunk_ids``) set to the chunks' current rows. Entries citing a
+    chunk that changed or vanished since the bank was built are dropped.
+    """
+    rows_by_hash = {}
+    for row, chunk in enumerate(chunks):
+        rows_by_hash.setdefault(text_hash(chunk), row)
+    resolved = []
+    for entry in entries:
+        hashes = entry.get("chunk_hashes")
+        if hashes is None or any(chunk_hash not in rows_by_hash for chunk_hash in hashes):
+            continue
+        entry = dict(entry, chunk_ids=[rows_by_hash[chunk_hash] for chunk_hash in hashes])
+        if entry.get("answer_key"):
+            entry["answer_key"] = dict(entry["answer_key"], source_chunk_ids=entry["chunk_ids"])
+        resolved.append(entry)
+    if len(resolved) < len(entries):
+        print(f"[WARNING] Ignoring {len(entries) - len(resolved)} bank questions whose course chunks changed; "
+              f"rebuild the bank with python question_bank.py.")
+    return resolved
+
+
+def load_question_bank(bank_path, chunks=None):
+    """
+    Load a bank file; with the course's current ``chunks``, its entries are resolved
+    against them (see resolve_chunk_ids).
+    """
+    if not os.path.isfile(bank_path):
+        return QuestionBank()
+    with gzip.open(bank_path, "rt", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    bank = QuestionBank(entries if chunks is None else resolve_chunk_ids(entries, chunks))
+    print(f"[INFO] Loaded {len(bank)} bank questions from {bank_path}.")
+    return bank
+
+
+_banks = {}
+_banks_lock = threading.Lock()
+
+
+def get_question_bank(course_name):
+    """
+    Return the process-wide question bank of a course, reloading it when the file or the
+    course's chunks change. Courses without a bank get an empty one.
+    """
+    bank_path = COURSES[course_name].get("QUESTION_BANK_PATH")
+    mtime = os.path.getmtime(bank_path) if bank_path and os.path.isfile(bank_path) else None
+    if mtime is None:
+        return QuestionBank()
+    assets = get_course_assets(course_name)
+    with _banks_lock:
+        cached = _banks.get(course_name)
+        if cached is None or cached[0] != (mtime, assets.hashes):
+            cached = ((mtime, assets.hashes), load_question_bank(bank_path, assets.chunks))
+            _banks[course_name] = cached
+        return cached[1]
+
+
+###############################################################################
+#                               BATCH GENERATION
+###############################################################################
+
+def add_bank_question(combination, question):
+    """
+    Validate a generated question (text or structured) and add it to its combination's entries.
+    Returns the reason it was rejected, or None if it was added.
+    """
+    text = str(question)
+    problem = validate_question(text, combination["question_type"])
+    if problem is None and combination["history"].is_repeat(text):
+        problem = "duplicate"
+    if problem is None:
+        combination["history"].add(text)
+        chunk_ids = combination["chunk_ids"]
+        entry = {
+            "objective": combination["objective"],
+            "question_type": combination["question_type"],
+            "difficulty": combination["difficulty"],
+            "question": text,
+        }
+        if isinstance(question, STRUCTURED_QUESTIONS):
+            entry["answer_key"] = question.to_dict()
+            del entry["answer_key"]["source_chunk_ids"]  # rows change on re-ingestion, see resolve_chunk_ids
+            chunk_ids = question.source_chunk_ids or chunk_ids
+        entry["chunk_hashes"] = [combination["chunk_hashes"][idx] for idx in chunk_ids]
+        combination["entries"].append(entry)
+    return problem
+
+
+def build_question_bank(course_name, per_combination=10):
+    """
+    Generate the question bank of a course for every objective, question type and difficulty,
+    and save it to the course's QUESTION_BANK_PATH.
+
+    Every round requests one question for each unfinished combination, all in parallel over
+    the shared client (see openai_pool.gather), until each has ``per_combination`` valid,
+    distinct questions or used up twice as many attempts.
+    """
+    model_config = AI_MODELS[QUESTION_BANK_MODEL]
+    ai_client = OpenAIClient(model=model_config["model"], setup_instructions=SETUP_INSTRUCTIONS, course_name=course_name)
+    generation_kwargs = {key: model_config[key] for key in ("temperature", "max_tokens", "frequency_penalty") if key in model_config}
+    course_objectives = COURSES[course_name].get("OBJECTIVES", [])
+    chunks = get_course_assets(course_name).chunks
+
+    combinations = []
+    for objective in course_objectives:
+        for question_type in QUESTION_TYPES:
+            for difficulty in DIFFICULTY_LEVELS:
+                chunk_ids = select_course_chunks(course_name, [objective], question_type, difficulty)
+                combinations.append({
+                    "objective": objective,
+                    "question_type": question_type,
+                    "difficulty": difficulty,
+                    "chunk_ids": chunk_ids,
+                    "chunk_hashes": {idx: text_hash(chunks[idx]) for idx in chunk_ids},
+                    "content": label_chunks([chunks[idx] for idx in chunk_ids]),
+                    "entries": [],
+                    "history": QuestionHistory(max_items=per_combination),
+                })
+
+    for _ in range(2 * per_combination):
+        pending = [combination for combination in combinations if len(combination["entries"]) < per_combination]
+        if not pending:
+            break
+        questions = gather(
+            [
+                ai_client.question_generator(
+                    combination["content"],
+                    combination["question_type"],
+                    combination["difficulty"],
+                    combination["history"].prompt_items(),
+                    course_objectives,
+                    [combination["objective"]],
+                    chunk_ids=combination["chunk_ids"],
+                    asynchronous=True,
+                    **generation_kwargs
+                )
+                for combination in pending
+            ],
+            return_exceptions=True
+        )
+        for combination, question in zip(pending, questions):
+            if isinstance(question, Exception):
+                problem = f"request failed ({question})"
+            else:
+                problem = add_bank_question(combination, question)
+            if problem is not None:
+                print(f"[WARNING] Rejected question for {combination['objective']} / "
+                      f"{combination['question_type']} / {combination['difficulty']}: {problem}")
+
+    entries = [entry for combination in combinations for entry in combination["entries"]]
+    save_question_bank(entries, COURSES[course_name]["QUESTION_BANK_PATH"])
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("course", nargs="?", choices=list(COURSES.keys()), help="Defaults to all courses.")
+    parser.add_argument("--per-combination", type=int, default=10)
+    args = parser.parse_args()
+
+    for course_name in [args.course] if args.course else COURSES:
+        if not COURSES[course_name].get("QUESTION_BANK_PATH"):
+            print(f"[WARNING] Course '{course_name}' has no QUESTION_BANK_PATH, skipping it.")
+            continue
+        build_question_bank(course_name, per_combination=args.per_combination)
+
+
+if __name__ == "__main__":
+    main()
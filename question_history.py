@@ -0,0 +1,103 @@
+import re
+import hashlib
+import collections
+import numpy as np
+
+from config import (
+    QUESTION_HISTORY_ITEM_CHARS,
+    QUESTION_HISTORY_PROMPT_ITEMS,
+    QUESTION_REPEAT_THRESHOLD
+)
+
+###############################################################################
+#                       BOUNDED QUESTION HISTORY
+###############################################################################
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+SHINGLE_SIZE = 3
+NUM_HASHES = 64
+
+# Multiply-shift hash functions of the MinHash signatures (fixed seed, same in every process).
+_rng = np.random.default_rng(20240101)
+_HASH_A = _rng.integers(1, np.iinfo(np.int64).max, size=NUM_HASHES, dtype=np.uint64) | np.uint64(1)
+_HASH_B = _rng.integers(0, np.iinfo(np.int64).max, size=NUM_HASHES, dtype=np.uint64)
+
+
+def summarize_question(question, max_chars=QUESTION_HISTORY_ITEM_CHARS):
+    """
+    Shorten a question to its first ``max_chars`` characters on a single line.
+    """
+    text = " ".join(question.split())
+    return text if len(text) <= max_chars else text[: max_chars - 1].rstrip() + "…"
+
+
+def question_fingerprint(question):
+    """
+    Return the MinHash signature (NUM_HASHES uint32 values) of the word 3-grams of a question.
+    The share of equal values of two signatures estimates the Jaccard similarity of the questions.
+    """
+    tokens = TOKEN_PATTERN.findall(question.lower())
+    shingles = {" ".join(tokens[i : i + SHINGLE_SIZE]) for i in range(max(1, len(tokens) - SHINGLE_SIZE + 1))}
+    values = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles)
+    )
+    with np.errstate(over="ignore"):
+        hashed = (_HASH_A[:, None] * values[None, :] + _HASH_B[:, None]) >> np.uint64(32)
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+class QuestionHistory:
+    """
+    Compact record of the questions of a session: a MinHash fingerprint and a shortened copy
+    of the last ``max_items`` questions.
+
+    ``is_repeat`` (also available as ``question in history``) checks a new question locally
+    against all fingerprints, and ``prompt_items`` returns the fixed-size do-not-repeat list
+    sent to the model, so later questions of a session cost the same as the first.
+    """
+    def __init__(self, max_items=50, prompt_items=QUESTION_HISTORY_PROMPT_ITEMS,
+                 item_chars=QUESTION_HISTORY_ITEM_CHARS, threshold=QUESTION_REPEAT_THRESHOLD):
+        self.prompt_items_count = prompt_items
+        self.item_chars = item_chars
+        self.threshold = threshold
+        self._summaries = collections.deque(maxlen=max_items)
+        self._fingerprints = collections.deque(maxlen=max_items)
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def __contains__(self, question):
+        return self.is_repeat(question)
+
+    def add(self, question):
+        self._summaries.append(summarize_question(question, self.item_chars))
+        self._fingerprints.append(question_fingerprint(question))
+
+    def similarity(self, question):
+        """
+        Return the highest estimated similarity of ``question`` to an earlier question (0 if none).
+        """
+        if not self._fingerprints:
+            return 0.0
+        fingerprint = question_fingerprint(question)
+        return float((np.stack(self._fingerprints) == fingerprint).mean(axis=1).max())
+
+    def is_repeat(self, question):
+        return self.similarity(question) >= self.threshold
+
+    def prompt_items(self):
+        """
+        Return the shortened last questions to list in a prompt as "do not repeat".
+        """
+        return list(self._summaries)[-self.prompt_items_count:] if self.prompt_items_count else []
+
+    def copy(self):
+        """
+        Return an independent snapshot, e.g. for a prefetch thread.
+        """
+        other = QuestionHistory(self._fingerprints.maxlen, self.prompt_items_count, self.item_chars, self.threshold)
+        other._summaries.extend(self._summaries)
+        other._fingerprints.extend(self._fingerprints)
+        return other
@@ -0,0 +1,171 @@
+import re
+import time
+import threading
+import collections
+import numpy as np
+
+from config import (
+    EMBEDDING_MODEL,
+    FEEDBACK_CACHE_MAX_ENTRIES,
+    FEEDBACK_CACHE_SIMILARITY,
+    FEEDBACK_CACHE_TTL_SECONDS
+)
+from embedding_cache import text_key
+from pdf_rag import embed_queries
+
+###############################################################################
+#                       FEEDBACK RESPONSE CACHE
+###############################################################################
+
+MCQ_ANSWER_PATTERN = re.compile(r"^\s*\(?([A-Da-d])\s*[).:]?\s*$")
+
+
+def normalize_answer(answer):
+    """
+    Normalize a student answer for cache lookups: a lone MCQ option ("b", "B)", "(B)")
+    becomes its upper-case letter, anything else has its whitespace runs collapsed.
+    """
+    match = MCQ_ANSWER_PATTERN.match(answer or "")
+    if match:
+        return match.group(1).upper()
+    return " ".join((answer or "").split())
+
+
+class ResponseCache:
+    """
+    In-memory cache of model feedback, keyed by (model, question hash, normalized answer).
+
+    Entries expire after ``ttl`` seconds and the least recently used ones are evicted once
+    ``max_entries`` is exceeded. With a ``similarity_threshold``, a free-text answer without
+    an exact match reuses the feedback of a cached answer to the same question whose embedding
+    has at least that cosine similarity; MCQ option answers always need an exact match.
+    The instance is safe to share between threads.
+    """
+    def __init__(self, max_entries=10_000, ttl=24 * 3600, similarity_threshold=None, embedding_model=EMBEDDING_MODEL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embedding_model = embedding_model
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (expires_at, response, answer vector or None)
+        self._answers = collections.defaultdict(set)  # (model, question hash) -> normalized answers
+        self._lock = threading.Lock()
+
+    def _uses_similarity(self, answer):
+        return self.similarity_threshold is not None and len(answer) > 1
+
+    def _embed_answer(self, answer):
+        try:
+            vector = embed_queries([answer], model=self.embedding_model)[0]
+        except Exception as error:
+            print(f"[WARNING] Could not embed the answer for the feedback cache: {error}")
+            return None
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _drop(self, key):
+        del self._entries[key]
+        group = self._answers[key[:2]]
+        group.discard(key[2])
+        if not group:
+            del self._answers[key[:2]]
+
+    def get(self, model, question, answer):
+        """
+        Return the cached feedback for this answer to ``question`` by ``model``, or None.
+        """
+        question_hash, answer = text_key(question), normalize_answer(answer)
+        key = (model, question_hash, answer)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            candidates = [
+                (other, self._entries[(model, question_hash, other)])
+                for other in self._answers.get((model, question_hash), ())
+            ]
+        if self._uses_similarity(answer):
+            candidates = [(other, entry) for other, entry in candidates if entry[2] is not None and entry[0] > now]
+            vector = self._embed_answer(answer) if candidates else None
+            if vector is not None:
+                best_score, best = max(
+                    ((float(np.dot(vector, entry[2])), other) for other, entry in candidates),
+                    key=lambda item: item[0]
+                )
+                if best_score >= self.similarity_threshold:
+                    with self._lock:
+                        entry = self._entries.get((model, question_hash, best))
+                        if entry is not None:
+                            self._entries.move_to_end((model, question_hash, best))
+                            self.similar_hits += 1
+                            return entry[1]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, model, question, answer, response):
+        """
+        Store the feedback for this answer and evict expired or least recently used entries.
+        """
+        question_hash, answer = text_key(question), normalize_answer(answer)
+        vector = self._embed_answer(answer) if self._uses_similarity(answer) else None
+        key = (model, question_hash, answer)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, response, vector)
+            self._answers[key[:2]].add(answer)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def wrap_stream(self, model, question, answer, deltas):
+        """
+        Pass a stream of text deltas through and store the full text once it has completed.
+        """
+        parts = []
+        for delta in deltas:
+            parts.append(delta)
+            yield delta
+        self.put(model, question, answer, "".join(parts))
+
+    def stats(self):
+        """
+        Return the hit/miss counters and the number of stored entries.
+        """
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.similar_hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Return the process-wide feedback cache configured in ``config.py``, or None if disabled.
+    """
+    global _cache
+    if not FEEDBACK_CACHE_MAX_ENTRIES:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                max_entries=FEEDBACK_CACHE_MAX_ENTRIES,
+                ttl=FEEDBACK_CACHE_TTL_SECONDS,
+                similarity_threshold=FEEDBACK_CACHE_SIMILARITY
+            )
+        return _cache
@@ -0,0 +1,167 @@
+"""
+One-shot sandbox worker, started by code_sandbox.SandboxPool; not meant to be run by hand.
+
+Usage:
+    python -I -B sandbox_worker.py '{"cpu_seconds": 1, "memory_mb": 256, "output_chars": 10000}'
+
+The worker starts, applies its resource limits and waits for one job (a JSON line on stdin:
+``code``, ``tests``, ``stdin`` and a one-time ``nonce``). It runs the code and then every test
+statement in the same namespace, writes the result as one JSON line tagged with the nonce to a
+private copy of its original stdout, and exits. The code's own output (including writes to file
+descriptor 1 or ``sys.__stdout__``) never reaches that channel. Only the standard library is used.
+"""
+import io
+import os
+import sys
+import json
+import builtins
+import traceback
+import contextlib
+
+try:
+    import resource
+except ImportError:  # Windows: only the wall-clock timeout of the pool applies
+    resource = None
+
+SANDBOX_DIR = os.path.realpath(os.getcwd())
+# Files the code may read: the sandbox directory and the Python installation (for imports).
+READABLE_DIRS = tuple({os.path.realpath(path) for path in (SANDBOX_DIR, sys.prefix, sys.base_prefix, sys.exec_prefix)})
+BLOCKED_EVENTS = ("socket.", "subprocess.", "ctypes.", "os.exec", "os.fork", "os.forkpty", "os.posix_spawn",
+                  "os.spawn", "os.system", "os.kill", "os.killpg", "pty.", "webbrowser.", "urllib.", "http.", "ftplib.",
+                  "smtplib.", "signal.")
+
+
+###############################################################################
+#                               LIMITS
+###############################################################################
+
+def apply_limits(cpu_seconds, memory_mb, max_file_mb=1, max_files=32):
+    """
+    Limit the CPU time (on top of the time used so far), address space, file sizes and open
+    files of this process.
+    """
+    if resource is None:
+        return
+    used = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_limit = int(used.ru_utime + used.ru_stime) + int(cpu_seconds) + 1
+    limits = [
+        (resource.RLIMIT_CPU, cpu_limit),
+        (resource.RLIMIT_AS, memory_mb * 1024 * 1024),
+        (resource.RLIMIT_FSIZE, max_file_mb * 1024 * 1024),
+        (resource.RLIMIT_NOFILE, max_files),
+    ]
+    if hasattr(resource, "RLIMIT_NPROC"):
+        limits.append((resource.RLIMIT_NPROC, 0))
+    for name, limit in limits:
+        try:
+            resource.setrlimit(name, (limit, limit))
+        except (ValueError, OSError):
+            pass  # e.g. RLIMIT_AS on macOS
+
+
+def _inside(path, directories):
+    return any(path == directory or path.startswith(directory + os.sep) for directory in directories)
+
+
+def audit_hook(event, args):
+    """
+    Block network access, new processes and files outside the sandbox directory.
+    Audit hooks cannot be removed once installed.
+    """
+    if event.startswith(BLOCKED_EVENTS):
+        raise PermissionError(f"{event} is not allowed in the sandbox")
+    if event == "open" and isinstance(args[0], (str, bytes, os.PathLike)):
+        path = os.path.realpath(os.fsdecode(args[0]))
+        mode, flags = args[1] or "r", args[2] or 0
+        writing = any(char in str(mode) for char in "wax+") or flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT)
+        if not _inside(path, (SANDBOX_DIR,) if writing else READABLE_DIRS):
+            raise PermissionError(f"{path} is outside the sandbox")
+    elif event in ("os.remove", "os.rename", "os.rmdir", "os.mkdir", "shutil.rmtree", "os.chmod", "os.symlink", "os.link"):
+        path = args[0]
+        if isinstance(path, (str, bytes, os.PathLike)) and not _inside(os.path.realpath(os.fsdecode(path)), (SANDBOX_DIR,)):
+            raise PermissionError(f"{event} outside the sandbox is not allowed")
+
+
+###############################################################################
+#                               EXECUTION
+###############################################################################
+
+class LimitedOutput(io.StringIO):
+    """
+    Captured stdout that keeps only the first ``max_chars`` characters.
+    """
+    def __init__(self, max_chars):
+        super().__init__()
+        self.max_chars = max_chars
+        self.truncated = False
+
+    def write(self, text):
+        room = self.max_chars - self.tell()
+        if len(text) > room:
+            self.truncated = True
+            text = text[:max(room, 0)]
+        return super().write(text)
+
+
+def format_error(error):
+    """
+    Return the last line of the traceback of ``error``, e.g. "ZeroDivisionError: division by zero".
+    """
+    return traceback.format_exception_only(type(error), error)[-1].strip()
+
+
+def blocked_exit(*args):
+    raise PermissionError("os._exit is not allowed in the sandbox")
+
+
+def run_job(job, output_chars):
+    output = LimitedOutput(output_chars)
+    result = {"stdout": "", "error": None, "tests": [], "truncated": False}
+    # The code gets its own copy of the builtins, and everything the harness needs after it
+    # ran is bound here first, so patching the builtins module or this module changes nothing.
+    run, compile_code, error_type, add_test = exec, compile, BaseException, result["tests"].append
+    describe, getvalue = format_error, output.getvalue
+    namespace = {"__name__": "__main__", "__builtins__": dict(vars(builtins))}
+    sys.stdin = io.StringIO(job.get("stdin", ""))
+    sys.__stdout__, sys.__stderr__ = output, io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+        try:
+            run(compile_code(job["code"], "<answer>", "exec"), namespace)
+        except error_type as error:  # SystemExit and KeyboardInterrupt are results too
+            result["error"] = describe(error)
+        if result["error"] is None:
+            for test in job.get("tests", []):
+                try:
+                    run(compile_code(test, "<test>", "exec"), namespace)
+                    add_test({"test": test, "passed": True, "error": None})
+                except error_type as error:
+                    add_test({"test": test, "passed": False, "error": describe(error)})
+    result["stdout"], result["truncated"] = getvalue(), output.truncated
+    return result
+
+
+def main():
+    limits = json.loads(sys.argv[1])
+    # The result goes to a private copy of the pipe to the pool; file descriptor 1, which the
+    # code could write to directly, is pointed at /dev/null. Bound before running the code,
+    # which shares this interpreter's modules.
+    result_stream, dumps = os.fdopen(os.dup(1), "w", encoding="utf-8"), json.dumps
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    sys.stdout = io.StringIO()
+    apply_limits(limits["cpu_seconds"], limits["memory_mb"])
+    sys.addaudithook(audit_hook)
+    # os._exit would end the worker without a result (there is no audit event to block it)
+    os._exit = blocked_exit
+    if os.name in sys.modules:
+        sys.modules[os.name]._exit = blocked_exit
+    job = json.loads(sys.stdin.readline())
+    nonce = job.pop("nonce")
+    result = run_job(job, limits["output_chars"])
+    result_stream.write(f"{nonce} {dumps(result)}\n")
+    result_stream.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import numpy as np
+
+from config import EMBEDDING_MODEL
+from course_assets import embed_course_queries
+from lexical_index import tokenize
+from pdf_rag import l2_normalize
+
+###############################################################################
+#                       PER-OBJECTIVE SESSION RECORD
+###############################################################################
+
+# check_answer results (and the app's own markers) mapped to score record fields.
+RESULT_FIELDS = {
+    "student answered correctly": "correct",
+    "student answered incorrectly": "incorrect",
+    "Student skipped this question": "skipped",
+}
+GENERAL_OBJECTIVE = "General"
+
+
+def match_objective_by_words(question, objectives, objective_keywords=None):
+    """
+    Return the objective whose name and search keywords share the most index terms (see
+    lexical_index.tokenize) with the question; the first one on a tie.
+    """
+    objective_keywords = objective_keywords or {}
+    terms = set(tokenize(question))
+    overlaps = [len(terms & set(tokenize(f"{objective} {objective_keywords.get(objective, '')}"))) for objective in objectives]
+    return objectives[int(np.argmax(overlaps))]
+
+
+def match_objective(question, objectives, objective_keywords=None, model=EMBEDDING_MODEL):
+    """
+    Return the objective a question is most about, by embedding similarity.
+    With a single candidate no request is made. In "lexical" retrieval mode, during an
+    embedding outage or if embedding fails, the question is matched by shared words instead.
+    """
+    if not objectives:
+        return GENERAL_OBJECTIVE
+    if len(objectives) == 1:
+        return objectives[0]
+    vectors = embed_course_queries([question, *objectives], model=model)
+    if vectors is None:
+        return match_objective_by_words(question, objectives, objective_keywords)
+    vectors = l2_normalize(vectors)
+    return objectives[int(np.argmax(vectors[1:] @ vectors[0]))]
+
+
+class ObjectiveScores:
+    """
+    Small per-objective record of a session (asked, correct, incorrect, skipped, unclear),
+    updated after every answer. Strengths and weaknesses are computed locally, so the
+    end-of-recap summary only needs to send this record to the model.
+    """
+    FIELDS = ("asked", "correct", "incorrect", "skipped", "unclear")
+
+    def __init__(self):
+        self.scores = {}
+
+    def __len__(self):
+        return sum(score["asked"] for score in self.scores.values())
+
+    def record(self, objective, result):
+        """
+        Add one answered (or skipped) question of ``objective`` with its check_answer ``result``.
+        """
+        score = self.scores.setdefault(objective, dict.fromkeys(self.FIELDS, 0))
+        score["asked"] += 1
+        score[RESULT_FIELDS.get(result, "unclear")] += 1
+
+    def accuracy(self, objective):
+        score = self.scores[objective]
+        graded = score["correct"] + score["incorrect"] + score["skipped"]
+        return score["correct"] / graded if graded else None
+
+    def strengths(self, min_accuracy=0.75):
+        return [objective for objective in self.scores if (self.accuracy(objective) or 0) >= min_accuracy]
+
+    def weaknesses(self, max_accuracy=0.5):
+        return [
+            objective for objective in self.scores
+            if self.accuracy(objective) is not None and self.accuracy(objective) < max_accuracy
+        ]
+
+    def unassessed(self, course_objectives):
+        return [objective for objective in course_objectives if objective not in self.scores]
+
+    def focus_objectives(self, fallback):
+        """
+        Objectives the summary's course context should cover: the weak ones, else those
+        practiced in the session, else ``fallback``.
+        """
+        practiced = [objective for objective in self.scores if objective != GENERAL_OBJECTIVE]
+        return self.weaknesses() or practiced or list(fallback)
+
+    def to_prompt(self, course_objectives):
+        """
+        Render the record as a few lines of plain text for the summary prompt.
+        """
+        lines = [
+            f"- {objective}: {score['correct']} of {score['asked']} correct, {score['incorrect']} incorrect, "
+            f"{score['skipped']} skipped, {score['unclear']} unclear"
+            for objective, score in self.scores.items()
+        ] or ["- No questions were answered."]
+        lines.append(f"Strengths: {', '.join(self.strengths()) or 'none yet'}")
+        lines.append(f"Needs improvement: {', '.join(self.weaknesses()) or 'none'}")
+        lines.append(f"Not assessed: {', '.join(self.unassessed(course_objectives)) or 'none'}")
+        return "\n".join(lines)
+
+    def to_markdown(self, course_objectives):
+        """
+        Render the record as a Markdown table, shown before the model's recommendations.
+        """
+        lines = ["| Objective | Correct | Incorrect | Skipped |", "|---|---|---|---|"]
+        lines += [
+            f"| {objective} | {score['correct']} | {score['incorrect']} | {score['skipped']} |"
+            for objective, score in self.scores.items()
+        ]
+        unassessed = self.unassessed(course_objectives)
+        if unassessed:
+            lines.append(f"\nNot assessed in this session: {', '.join(unassessed)}")
+        return "\n".join(lines)
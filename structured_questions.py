@@ -0,0 +1,398 @@
+import re
+import ast
+import json
+import difflib
+import keyword
+import builtins
+
+from code_sandbox import get_sandbox_pool
+
+###############################################################################
+#                   STRUCTURED MULTIPLE-CHOICE QUESTIONS
+###############################################################################
+
+MCQ_KEYS = ("A", "B", "C", "D")
+
+# Structured output format of generated MCQs: the model must answer with this JSON object.
+# ``source_chunks`` are the [n] labels of the course content (see prompts.label_chunks).
+MCQ_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "multiple_choice_question",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "stem": {"type": "string"},
+                "options": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "key": {"type": "string", "enum": list(MCQ_KEYS)},
+                            "text": {"type": "string"},
+                            "explanation": {"type": "string"},
+                        },
+                        "required": ["key", "text", "explanation"],
+                        "additionalProperties": False,
+                    },
+                },
+                "correct_key": {"type": "string", "enum": list(MCQ_KEYS)},
+                "source_chunks": {"type": "array", "items": {"type": "integer"}},
+            },
+            "required": ["stem", "options", "correct_key", "source_chunks"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# A plain choice: "B", "b)", "(B)", "B.", "Answer: B", optionally followed by the option text.
+CHOICE_PATTERN = re.compile(r"^(?:(?:answer|antwort|option)\s*:?\s*)?\(?([a-d])(?:\)|\.|:|$)\s*(.*)$", re.IGNORECASE | re.DOTALL)
+
+
+def normalize_answer(text):
+    return " ".join(text.lower().split()).strip(" .")
+
+
+class MCQQuestion:
+    """
+    A generated multiple-choice question with its answer key: stem, options A to D, the
+    correct key, one explanation per option and the ids of the chunks it was generated from.
+
+    ``str(question)`` is the text shown to the student, which never includes the key, and
+    ``grade`` checks a plain choice locally, without a model call.
+    """
+    def __init__(self, stem, options, correct_key, explanations, source_chunk_ids=()):
+        self.stem = stem
+        self.options = options
+        self.correct_key = correct_key
+        self.explanations = explanations
+        self.source_chunk_ids = list(source_chunk_ids)
+
+    def __str__(self):
+        return "\n\n".join([self.stem] + [f"{key}) {text}" for key, text in self.options.items()])
+
+    @classmethod
+    def from_json(cls, text, chunk_ids=None):
+        """
+        Parse and check a structured model response (see MCQ_RESPONSE_FORMAT).
+        Its [n] source labels are mapped to ``chunk_ids[n - 1]``; unknown labels are dropped.
+        Raises ValueError if the response is not a usable question.
+        """
+        data = json.loads(text)
+        try:
+            options = {option["key"]: option for option in data["options"]}
+            if not data["stem"].strip():
+                raise ValueError("structured question has no stem")
+            if sorted(options) != list(MCQ_KEYS) or len(data["options"]) != len(MCQ_KEYS):
+                raise ValueError("structured question needs exactly the options A to D")
+            if data["correct_key"] not in options:
+                raise ValueError("structured question has no valid correct key")
+            chunk_ids = list(chunk_ids or [])
+            return cls(
+                data["stem"].strip(),
+                {key: options[key]["text"].strip() for key in MCQ_KEYS},
+                data["correct_key"],
+                {key: options[key]["explanation"].strip() for key in MCQ_KEYS},
+                [chunk_ids[label - 1] for label in data.get("source_chunks", []) if 1 <= label <= len(chunk_ids)]
+            )
+        except (KeyError, TypeError, AttributeError) as error:
+            raise ValueError(f"malformed structured question ({type(error).__name__}: {error})") from error
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["stem"], data["options"], data["correct_key"], data["explanations"], data.get("source_chunk_ids", ()))
+
+    def to_dict(self):
+        return {
+            "stem": self.stem,
+            "options": self.options,
+            "correct_key": self.correct_key,
+            "explanations": self.explanations,
+            "source_chunk_ids": self.source_chunk_ids,
+        }
+
+    def parse_choice(self, answer):
+        """
+        Return the option key of an answer that is only a choice ("B", "b)", "Answer: B",
+        "B) <option text>" or the text of one option), or None for any other free text.
+        """
+        answer = (answer or "").strip()
+        match = CHOICE_PATTERN.match(answer)
+        if match:
+            key, rest = match.group(1).upper(), normalize_answer(match.group(2))
+            if not rest or rest == normalize_answer(self.options[key]):
+                return key
+        normalized = normalize_answer(answer)
+        return next((key for key, text in self.options.items() if normalize_answer(text) == normalized), None)
+
+    def grade(self, answer):
+        """
+        Grade a plain choice locally. Returns (result, feedback), with the same results as
+        services.check_answer, or None when the answer is free text that needs the model.
+        """
+        key = self.parse_choice(answer)
+        if key is None:
+            return None
+        correct = self.correct_key
+        if key == correct:
+            return "student answered correctly", f"Correct! {key}) {self.options[key]}\n\n{self.explanations[key]}"
+        return "student answered incorrectly", (
+            f"Incorrect. You chose {key}) {self.options[key]}: {self.explanations[key]}\n\n"
+            f"The correct answer is {correct}) {self.options[correct]}: {self.explanations[correct]}"
+        )
+
+    def with_answer_key(self):
+        """
+        Return the question text followed by its answer key, for free-text follow-ups sent to
+        the model so its feedback agrees with the key.
+        """
+        lines = [str(self), "", f"Answer key: {self.correct_key} is correct."]
+        lines += [f"{key}) {explanation}" for key, explanation in self.explanations.items()]
+        return "\n".join(lines)
+
+
+###############################################################################
+#                   STRUCTURED CODE QUESTIONS, GRADED BY RUNNING THEM
+###############################################################################
+
+# Structured output format of generated code tracing and completion questions.
+CODE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "code_question",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "question": {"type": "string"},
+                "answer_kind": {"type": "string", "enum": ["output", "code"]},
+                "reference_code": {"type": "string"},
+                "tests": {"type": "string"},
+                "source_chunks": {"type": "array", "items": {"type": "integer"}},
+            },
+            "required": ["question", "answer_kind", "reference_code", "tests", "source_chunks"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+CODE_FENCE_PATTERN = re.compile(r"```[ \t]*(?:python|py)?[ \t]*\n(.*?)```", re.IGNORECASE | re.DOTALL)
+# A line that can only be code: a compound statement header ending in ":", an import, a line
+# that is just a call, or an assignment. Prose that mentions a call ("call sum(n)") is not.
+CODE_LINE_PATTERN = re.compile(
+    r"^\s*(?:(?:def|class|for|while|if|elif|else|try|except|finally|with)\b.*:\s*$|(?:import|from)\s+\w"
+    r"|[\w.]+\(.*\)\s*$|\w+(?:\[.*\])?\s*[-+*/%]?=(?!=))",
+    re.MULTILINE
+)
+OUTPUT_WORD_PATTERN = re.compile(r"[^\W\d_]{2,}")
+# Words that may appear in a printed output without making a prediction an answer in words
+OUTPUT_WORDS = frozenset(keyword.kwlist + dir(builtins))
+
+
+def split_tests(source):
+    """
+    Split test code into its top-level statements (e.g. one ``assert`` each).
+    Raises ValueError if it is not valid Python.
+    """
+    try:
+        tree = ast.parse(source or "")
+    except SyntaxError as error:
+        raise ValueError(f"tests are not valid Python: {error}") from error
+    return [ast.get_source_segment(source, node) for node in tree.body]
+
+
+def normalize_output(text):
+    """
+    Strip the whitespace around every line and the blank lines around the output, so
+    predicted outputs do not have to match the indentation or trailing spaces.
+    """
+    return "\n".join(line.strip() for line in (text or "").strip("\n").splitlines()).strip()
+
+
+def extract_code(answer):
+    """
+    Return the code of an answer: its fenced code blocks if it has any, else the whole answer.
+    """
+    blocks = CODE_FENCE_PATTERN.findall(answer or "")
+    return "\n".join(blocks) if blocks else (answer or "").strip("\n")
+
+
+def run_output(result):
+    """
+    Return what a run shows: its printed output followed by the error line of an exception, if any.
+    """
+    error = None if result["stopped"] else result["error"]
+    return normalize_output("\n".join(part for part in (normalize_output(result["stdout"]), error) if part))
+
+
+class CodeQuestion:
+    """
+    A generated code tracing or completion question with a runnable reference solution.
+
+    ``answer_kind`` "output" asks the student to predict what ``reference_code`` prints
+    (compared with ``expected_output``); "code" asks for a corrected or completed program,
+    which is run in the sandbox (see code_sandbox.py) and must print the same output as the
+    reference and pass its ``tests`` (assert statements). Only a wrong answer's execution
+    report is sent to the model, for an explanation.
+    """
+    def __init__(self, question, answer_kind, reference_code, tests=(), expected_output=None, source_chunk_ids=()):
+        self.question = question
+        self.answer_kind = answer_kind
+        self.reference_code = reference_code
+        self.tests = list(tests)
+        self.expected_output = expected_output
+        self.source_chunk_ids = list(source_chunk_ids)
+
+    def __str__(self):
+        return self.question
+
+    @classmethod
+    def from_json(cls, text, chunk_ids=None):
+        """
+        Parse a structured model response (see CODE_RESPONSE_FORMAT). The reference solution
+        still has to be checked with ``check_reference``. Raises ValueError for an unusable response.
+        """
+        data = json.loads(text)
+        try:
+            if not data["question"].strip() or not data["reference_code"].strip():
+                raise ValueError("structured code question has no question or reference code")
+            if data["answer_kind"] not in ("output", "code"):
+                raise ValueError("structured code question has no valid answer kind")
+            chunk_ids = list(chunk_ids or [])
+            return cls(
+                data["question"].strip(),
+                data["answer_kind"],
+                data["reference_code"],
+                split_tests(data["tests"]) if data["answer_kind"] == "code" else [],
+                source_chunk_ids=[chunk_ids[label - 1] for label in data.get("source_chunks", []) if 1 <= label <= len(chunk_ids)]
+            )
+        except (KeyError, TypeError, AttributeError) as error:
+            raise ValueError(f"malformed structured code question ({type(error).__name__}: {error})") from error
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["question"], data["answer_kind"], data["reference_code"], data.get("tests", ()),
+                   data.get("expected_output"), data.get("source_chunk_ids", ()))
+
+    def to_dict(self):
+        return {
+            "question": self.question,
+            "answer_kind": self.answer_kind,
+            "reference_code": self.reference_code,
+            "tests": self.tests,
+            "expected_output": self.expected_output,
+            "source_chunk_ids": self.source_chunk_ids,
+        }
+
+    def check_reference(self, pool=None):
+        """
+        Run the reference solution and store its output as ``expected_output``.
+        Raises ValueError if it does not finish, or (for "code" questions) fails or fails its tests.
+        """
+        result = (pool or get_sandbox_pool()).run(self.reference_code, self.tests)
+        if result["stopped"] or result["truncated"]:
+            raise ValueError(f"reference solution does not finish: {result['error'] or 'too much output'}")
+        if self.answer_kind == "code":
+            failed = [test["test"] for test in result["tests"] if not test["passed"]]
+            if result["error"] or failed:
+                raise ValueError(f"reference solution fails: {result['error'] or ', '.join(failed)}")
+            if not self.tests and not result["stdout"].strip():
+                raise ValueError("reference solution neither prints anything nor has tests")
+        self.expected_output = run_output(result)
+        return self
+
+    def grade(self, answer, pool=None):
+        """
+        Grade an answer locally. Returns (result, feedback), with the same results as
+        services.check_answer, where the feedback of a wrong answer is its execution report;
+        or None for an answer that cannot be checked by running it (e.g. an explanation in words).
+        """
+        if self.expected_output is None:
+            self.check_reference(pool)
+        if self.answer_kind == "output":
+            return self.grade_output(answer)
+        code = extract_code(answer)
+        try:
+            compile(code, "<answer>", "exec")
+        except (SyntaxError, ValueError) as error:
+            if not CODE_FENCE_PATTERN.search(answer or "") and not CODE_LINE_PATTERN.search(code):
+                return None  # an answer in words
+            return "student answered incorrectly", f"Incorrect. Your code does not compile: {error}"
+        result = (pool or get_sandbox_pool()).run(code, self.tests)
+        return self.grade_run(result)
+
+    def is_bare_output(self, answer):
+        """
+        Check whether an answer is only a predicted output: all its words are Python names
+        (True, None, ValueError, ...) or words of the expected output.
+        """
+        allowed = OUTPUT_WORDS | set(OUTPUT_WORD_PATTERN.findall(self.expected_output))
+        return all(word in allowed for word in OUTPUT_WORD_PATTERN.findall(answer))
+
+    def grade_output(self, answer):
+        """
+        Compare a predicted output with the expected one: the whole answer, its code block or,
+        for one-line answers, the text after the last colon ("It prints: 3") must match.
+        A different prediction is only graded here when it is clearly an output (a code block
+        or a bare output); for an answer in words ("It prints 2, because ...") None is returned,
+        so the model grades it against the reference solution.
+        """
+        answer = answer or ""
+        candidates = {normalize_output(answer), normalize_output(extract_code(answer))}
+        if "\n" not in answer.strip() and ":" in answer:
+            candidates.add(normalize_output(answer.rsplit(":", 1)[1]))
+        if self.expected_output in candidates:
+            return "student answered correctly", f"Correct! The code prints:\n```\n{self.expected_output}\n```"
+        if not CODE_FENCE_PATTERN.search(answer) and not self.is_bare_output(answer):
+            return None
+        diff = difflib.unified_diff(
+            self.expected_output.splitlines(), normalize_output(extract_code(answer)).splitlines(),
+            "expected output", "your answer", lineterm=""
+        )
+        return "student answered incorrectly", "Incorrect. The predicted output differs:\n```diff\n" + "\n".join(diff) + "\n```"
+
+    def grade_run(self, result):
+        """
+        Grade the sandbox run of a student's program against the reference output and tests.
+        """
+        if result["stopped"]:
+            return "student answered incorrectly", f"Incorrect. {result['error']}"
+        report = []
+        if result["error"]:
+            report.append(f"Your code stopped with: {result['error']}")
+        output = run_output(result)
+        # The output is only compared when the reference prints something
+        if self.expected_output and output != self.expected_output:
+            diff = difflib.unified_diff(self.expected_output.splitlines(), output.splitlines(),
+                                        "expected output", "your output", lineterm="")
+            report.append("The output differs:\n```diff\n" + "\n".join(diff) + "\n```")
+        failed = [test for test in result["tests"] if not test["passed"]]
+        # Checks that did not report a result count as failed
+        failed += [{"test": test, "error": "did not run"} for test in self.tests[len(result["tests"]):]
+                   if not result["error"]]
+        if failed:
+            report.append("Failed checks:\n" + "\n".join(f"- `{test['test']}`: {test['error']}" for test in failed))
+        if report:
+            return "student answered incorrectly", "Incorrect.\n\n" + "\n\n".join(report)
+        checks = f" and passes all {len(self.tests)} checks" if self.tests else ""
+        return "student answered correctly", f"Correct! Your code runs, prints the expected output{checks}."
+
+    def with_answer_key(self):
+        """
+        Return the question text followed by the reference solution, for answers in words
+        sent to the model so its feedback agrees with the reference.
+        """
+        return (f"{self.question}\n\nReference solution:\n```python\n{self.reference_code}\n```\n"
+                f"Output of the reference solution:\n```\n{self.expected_output}\n```")
+
+
+def question_from_dict(data):
+    """
+    Rebuild a structured question saved with ``to_dict`` (e.g. a question bank answer key).
+    """
+    return CodeQuestion.from_dict(data) if "reference_code" in data else MCQQuestion.from_dict(data)
+
+
+# Types of the structured questions, which carry their own answer key
+STRUCTURED_QUESTIONS = (MCQQuestion, CodeQuestion)